@@ -0,0 +1,184 @@
+"""
+记忆块创建链路的基准测试，使用本地假的 LLM / embedding 客户端，不产生任何网络请求
+
+对比两条链路:
+- legacy: 总结一次LLM调用 + dialogue_importance 一次LLM调用 + 两次embedding请求
+- fused: 总结和importance合并成一次LLM调用 + 一次批量embedding请求
+
+用法: python -m benchmarks.summarize_benchmark --blocks 20
+"""
+import argparse
+import itertools
+import json
+import time
+from typing import Dict, List
+
+from common_py.model.chat import ConversationEvent
+
+from memory_sdk import const
+from memory_sdk.embedding_cache import EmbeddingCache
+from memory_sdk.instance_memory_block import block_mgr, event_block
+from memory_sdk.instance_memory_block.block_mgr import BlockManager
+from memory_sdk.instance_memory_block.event_block import EventBlock
+
+
+class _Stats:
+    def __init__(self):
+        self.llm_calls = 0
+        self.embedding_requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def reset(self):
+        self.__init__()
+
+
+stats = _Stats()
+_summary_seq = itertools.count()
+
+# 模拟的服务延迟，单位秒
+LLM_base_latency = 0.4
+LLM_per_output_token_latency = 0.01
+Embedding_latency = 0.1
+
+
+def _count_tokens(text: str) -> int:
+    # 粗略估计，英文平均4个字符一个token
+    return max(1, len(text) // 4)
+
+
+class _FakeResponse:
+    def __init__(self, content: str):
+        self.content = content
+
+    def get_chat_content(self) -> str:
+        return self.content
+
+
+class FakeChatGPTClient:
+
+    def __init__(self, **kwargs):
+        pass
+
+    def generate(self, messages: List, **kwargs) -> _FakeResponse:
+        system_prompt = messages[0].content
+        summary = {
+            # 每次调用的summary不同，避免命中 embedding 缓存
+            "summary": f"Allen and Tina talked about failed interview #{next(_summary_seq)}, Tina encouraged Allen to keep trying.",
+            "participants": ["Allen", "Tina"],
+            "tags": ["interview", "encouragement"],
+        }
+        if system_prompt == const.summary_with_importance_tpl:
+            summary["importance"] = 6
+            content = json.dumps(summary)
+        elif system_prompt == const.summary_tpl:
+            content = json.dumps(summary)
+        elif system_prompt == const.dialogue_importance:
+            content = "Rating: 6"
+        else:
+            raise Exception(f"unexpected prompt in benchmark: {system_prompt[:50]}")
+        prompt_tokens = sum(_count_tokens(m.content) for m in messages)
+        completion_tokens = _count_tokens(content)
+        stats.llm_calls += 1
+        stats.prompt_tokens += prompt_tokens
+        stats.completion_tokens += completion_tokens
+        time.sleep(LLM_base_latency + completion_tokens * LLM_per_output_token_latency)
+        return _FakeResponse(content)
+
+
+class FakeOpenAIEmbedding:
+
+    def __call__(self, input, **kwargs):
+        stats.embedding_requests += 1
+        texts = input if isinstance(input, list) else [input]
+        stats.prompt_tokens += sum(_count_tokens(text) for text in texts)
+        time.sleep(Embedding_latency)
+        if isinstance(input, list):
+            return [[0.1] * 1536 for _ in texts]
+        return [0.1] * 1536
+
+
+class _FakeRedisPipeline:
+    """
+    embedding 缓存的 Redis 层在基准测试中始终未命中
+    """
+
+    def __init__(self):
+        self.commands = 0
+
+    def get(self, *args, **kwargs):
+        self.commands += 1
+
+    def set(self, *args, **kwargs):
+        self.commands += 1
+
+    def execute(self):
+        return [None] * self.commands
+
+
+class _FakeRedisClient:
+
+    def pipeline(self):
+        return _FakeRedisPipeline()
+
+
+def _build_events(rounds: int) -> List[ConversationEvent]:
+    events = []
+    now = int(time.time())
+    for i in range(rounds):
+        if i % 2 == 0:
+            speaker, speaker_name, role, message = "22202678", "Allen", "user", "I failed an interview today, what do you think went wrong?"
+        else:
+            speaker, speaker_name, role, message = "AID_tina", "Tina", "AI", "Don't lose heart, maybe that job just wasn't the right fit for you."
+        events.append(ConversationEvent(**{
+            "event_source": "conversation",
+            "role": role,
+            "speaker": speaker,
+            "speaker_name": speaker_name,
+            "message": message,
+            "occur_time": str(now + i),
+        }))
+    return events
+
+
+def _run(fused: bool, blocks: int, rounds: int) -> Dict[str, float]:
+    event_block.EventBlock_fused_summarize = fused
+    importance_mgr = BlockManager.__new__(BlockManager)  # 只使用 _dialogue_importance，不需要连接存储
+    stats.reset()
+    start = time.time()
+    for _ in range(blocks):
+        block = EventBlock(AID="AID_tina")
+        block.build_from_dialogue_event(_build_events(rounds))
+        if block.importance == 0:
+            block.importance = importance_mgr._dialogue_importance(block)
+    cost = time.time() - start
+    return {
+        "latency_per_block_ms": cost / blocks * 1000,
+        "llm_calls_per_block": stats.llm_calls / blocks,
+        "embedding_requests_per_block": stats.embedding_requests / blocks,
+        "prompt_tokens_per_block": stats.prompt_tokens / blocks,
+        "completion_tokens_per_block": stats.completion_tokens / blocks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=12)
+    args = parser.parse_args()
+
+    event_block.ChatGPTClient = FakeChatGPTClient
+    block_mgr.ChatGPTClient = FakeChatGPTClient
+    EmbeddingCache().embedding_client = FakeOpenAIEmbedding()
+    EmbeddingCache().redis_client = _FakeRedisClient()
+
+    legacy = _run(False, args.blocks, args.rounds)
+    fused = _run(True, args.blocks, args.rounds)
+    print(f"{'metric':<32}{'legacy':>12}{'fused':>12}{'saving':>10}")
+    for key in legacy:
+        saving = 1 - fused[key] / legacy[key] if legacy[key] else 0
+        print(f"{key:<32}{legacy[key]:>12.1f}{fused[key]:>12.1f}{saving:>10.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,7 @@
 import threading
+from typing import Dict, List, Optional
 
-from common_py.client.azure_mongo import MongoDBClient
-
-from memory_sdk.instance_memory_block.event_block import EventBlock
+from memory_sdk.instance_memory_block.event_block import EventBlock, load_blocks
 
 
 class Funcs:
@@ -10,14 +9,17 @@ class Funcs:
     _instance_lock = threading.Lock()
 
     def load_block_from_mongo(self, block_name: str) -> EventBlock:
-        mongo_client = MongoDBClient()
-        res = mongo_client.find_one_from_collection('AI_memory_block', {'name': block_name})
-        if not res:
+        block = load_blocks([block_name]).get(block_name, None)
+        if block is None:
             raise Exception(f"can not find block: {block_name}")
-        del res['origin_event']
-        block = EventBlock(**res)
         return block
 
+    def load_blocks(self, block_names: List[str], fields: Optional[List[str]] = None) -> Dict[str, EventBlock]:
+        """
+        路由脚本需要多个 block 时使用，一次查询取回
+        """
+        return load_blocks(block_names, fields)
+
     def __new__(cls, *args, **kwargs):
         if not hasattr(Funcs, "_instance"):
             with Funcs._instance_lock:
@@ -1,5 +1,5 @@
+import hashlib
 import logging
-import uuid
 from typing import List, Dict, Optional
 from common_py.client.azure_mongo import MongoDBClient
 from common_py.client.chroma import ChromaCollection, VectorRecordItem
@@ -29,19 +29,29 @@ class LUITriggerPo(BaseModel):
 
 
 def save_LUITriggerPo_to_vdb(po: LUITriggerPo, collection: ChromaCollection):
-    collection.delete(where={'trigger_id': po.trigger_id})
-    vector_records = []
+    # 记录id由 trigger_id 和语料内容生成，未变化的语料不重新写入，也就不会被重新embedding
+    new_records = {}
     for corpus_text in po.trigger_corpus:
+        new_records[_gen_corpus_record_id(po.trigger_id, corpus_text)] = corpus_text
+    exist_ids = set(item.id for item in collection.get(where={'trigger_id': po.trigger_id}))
+    stale_ids = [record_id for record_id in exist_ids if record_id not in new_records]
+    if len(stale_ids) > 0:
+        collection.delete(ids=stale_ids)
+    vector_records = []
+    for record_id, corpus_text in new_records.items():
+        if record_id in exist_ids:
+            continue
         vector_records.append(VectorRecordItem(
-            id=str(uuid.uuid4()),
+            id=record_id,
             meta={
                 "trigger_id": po.trigger_id,
                 "trigger_name": po.trigger_name,
             },
             documents=corpus_text
         ))
-    collection.upsert_many(vector_records)
-    logger.info(f"Save LUI trigger to vdb: {po.trigger_name}")
+    if len(vector_records) > 0:
+        collection.upsert_many(vector_records)
+    logger.info(f"Save LUI trigger to vdb: {po.trigger_name}, new corpus: {len(vector_records)}, removed: {len(stale_ids)}")
 
     # with ThreadPoolExecutor(max_workers=5) as executor:
     #     for corpus_text in po.trigger_corpus:
@@ -81,6 +91,10 @@ def load_all_trigger_po() -> (List[SceneTriggerPo], List[LUITriggerPo]):
     return scene_trigger_po_lst, lui_trigger_po_lst
 
 
+def _gen_corpus_record_id(trigger_id: str, corpus_text: str) -> str:
+    return hashlib.md5(f"{trigger_id}:{corpus_text}".encode('utf-8')).hexdigest()
+
+
 def _build_scene_trigger_po(trigger: Dict) -> SceneTriggerPo:
     return SceneTriggerPo(
         trigger_id=trigger['trigger_id'],
@@ -59,6 +59,22 @@ below and include them with {{}}. For example: {example_username} has ID {exampl
 breakfast" should be replaced with "{{{example_UID}}} had \
 breakfast". Here are all the possible mappings of username to user ID: \n'''
 
+# summary_tpl 的扩展版本，在同一次调用中给出 importance，省掉 dialogue_importance 的单独请求
+summary_with_importance_tpl = summary_tpl.replace(
+    '''    "tags": [""] # required
+}''',
+    '''    "tags": [""], # required
+    "importance": 1 # required
+}''').replace(
+    "DO NOT ADD FIELDS THAT ARE NOT MENTIONED IN THE FIELD",
+    ''''importance': This is an integer. On the scale of 1 to 10, where 1 is purely mundane (e.g., brushing teeth, \
+making bed, greet passers-by) and 10 is extremely poignant (e.g., a break up, college acceptance), rate the likely \
+poignancy of the event.
+
+DO NOT ADD FIELDS THAT ARE NOT MENTIONED IN THE FIELD''')
+
+few_shot_assistant_with_importance = few_shot_assistant[:few_shot_assistant.rindex("}")] + ''', "importance": 5 }'''
+
 # Judging the importance of the conversation
 dialogue_importance = '''On the scale of 1 to 10, where 1 is purely mundane (e.g., brushing teeth, making bed,greet passers-by) and 10 is extremely poignant (e.g., a break up, college acceptance), rate the likely poignancy of the following piece of memory.
 Memory: <user input>
@@ -98,6 +114,17 @@ Please response in json format:
 "questions": []
 }}"""
 
+gen_question_answer_batch = """Please generate targeted questions for each of the following summaries of chats between users so that each summary contains information that can answer its questions.
+Questions should not include the names of specific people
+Each summary is tagged with its index and the maximum number of questions for it.
+Here are the raw text of chats summaries:
+{chat_summaries}
+Please response in json format, the key is the index of the summary and the value is the list of its questions:
+{{
+"0": [],
+"1": []
+}}"""
+
 get_target_timestamp = """### Task objective
 Extract formatted time information from text input
 
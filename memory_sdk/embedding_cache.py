@@ -0,0 +1,192 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from common_py.client.embedding import OpenAIEmbedding
+from common_py.client.redis_client import RedisClient
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+Embedding_default_model = "text-embedding-ada-002"
+EmbeddingCache_local_capacity = 20000
+EmbeddingCache_local_ttl = 60 * 60
+EmbeddingCache_redis_ttl = 60 * 60 * 24 * 30
+
+
+def gen_embedding_cache_key(model: str, text: str) -> str:
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    return f"embedding_cache:{model}:{digest}"
+
+
+def pack_vector(vector: List[float]) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def unpack_vector(raw: bytes) -> List[float]:
+    return np.frombuffer(raw, dtype=np.float32).tolist()
+
+
+class _LocalLRU:
+    """
+    进程内带TTL的LRU，key -> (过期时间, 向量)
+    """
+
+    def __init__(self, capacity: int, ttl: int):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            item: Optional[Tuple[float, List[float]]] = self._data.get(key, None)
+            if item is None:
+                return None
+            expire_at, vector = item
+            if expire_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return vector
+
+    def put(self, key: str, vector: List[float]):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, vector)
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class EmbeddingCache:
+    """
+    OpenAIEmbedding 前面的内容寻址缓存，key 由模型名和文本哈希组成
+    两级缓存：进程内 LRU + Redis，Redis 中以 float32 字节存储向量，不使用 json
+    所有需要 embedding 的地方都应该通过 get / get_many 获取，批量接口只对未命中的文本发起一次请求
+    """
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        if not hasattr(self, "_ready"):
+            EmbeddingCache._ready = True
+            self.redis_client = RedisClient()
+            self.embedding_client = OpenAIEmbedding()
+            self.model: str = getattr(self.embedding_client, 'model', None) or Embedding_default_model
+            self.local = _LocalLRU(EmbeddingCache_local_capacity, EmbeddingCache_local_ttl)
+            self._counter_lock = threading.Lock()
+            self.counters: Dict[str, int] = {
+                "local_hit": 0,
+                "redis_hit": 0,
+                "miss": 0,
+                "redis_error": 0,
+            }
+
+    def get(self, text: str) -> List[float]:
+        return self.get_many([text])[0]
+
+    def get_many(self, texts: List[str]) -> List[List[float]]:
+        if len(texts) == 0:
+            return []
+        keys = [gen_embedding_cache_key(self.model, text) for text in texts]
+        result: List[Optional[List[float]]] = [self.local.get(key) for key in keys]
+        local_hit = sum(1 for vector in result if vector is not None)
+
+        redis_missing = [i for i, vector in enumerate(result) if vector is None]
+        redis_hit = 0
+        if len(redis_missing) > 0:
+            redis_hit = self._fill_from_redis(keys, redis_missing, result)
+
+        missing = [i for i, vector in enumerate(result) if vector is None]
+        if len(missing) > 0:
+            # 同一批次里重复的文本只请求一次
+            unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+            vectors = self._embedding(unique_texts)
+            text_vector = dict(zip(unique_texts, vectors))
+            for i in missing:
+                result[i] = text_vector[texts[i]]
+            self._write_back({keys[i]: result[i] for i in missing})
+
+        self._count(local_hit=local_hit, redis_hit=redis_hit, miss=len(missing))
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        with self._counter_lock:
+            stats = dict(self.counters)
+        stats["local_size"] = len(self.local)
+        return stats
+
+    def _fill_from_redis(self, keys: List[str], index_lst: List[int], result: List) -> int:
+        try:
+            pipeline = self.redis_client.pipeline()
+            for i in index_lst:
+                pipeline.get(keys[i])
+            raw_lst = pipeline.execute()
+        except Exception as e:
+            logger.warning(f"embedding cache read redis error: {e}")
+            self._count(redis_error=1)
+            return 0
+        hit = 0
+        for i, raw in zip(index_lst, raw_lst):
+            if not raw:
+                continue
+            vector = unpack_vector(raw)
+            result[i] = vector
+            self.local.put(keys[i], vector)
+            hit += 1
+        return hit
+
+    def _write_back(self, key_vector: Dict[str, List[float]]):
+        for key, vector in key_vector.items():
+            self.local.put(key, vector)
+        try:
+            pipeline = self.redis_client.pipeline()
+            for key, vector in key_vector.items():
+                pipeline.set(key, pack_vector(vector), ex=EmbeddingCache_redis_ttl)
+            pipeline.execute()
+        except Exception as e:
+            logger.warning(f"embedding cache write redis error: {e}")
+            self._count(redis_error=1)
+
+    def _embedding(self, texts: List[str]) -> List[List[float]]:
+        """
+        一次请求获取多段文本的向量，embedding 客户端不支持批量输入时退化为逐条请求
+        """
+        try:
+            res = self.embedding_client(input=texts)
+            if isinstance(res, list) and len(res) == len(texts) and all(isinstance(item, list) for item in res):
+                return res
+        except Exception as e:
+            logger.warning(f"batch embedding failed, fall back to one request per text: {e}")
+        return [self.embedding_client(input=text) for text in texts]
+
+    def _count(self, **kwargs):
+        with self._counter_lock:
+            for key, value in kwargs.items():
+                self.counters[key] += value
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(EmbeddingCache, "_instance"):
+            with EmbeddingCache._instance_lock:
+                if not hasattr(EmbeddingCache, "_instance"):
+                    EmbeddingCache._instance = object.__new__(cls)
+        return EmbeddingCache._instance
+
+
+class CachedEmbeddingFunction:
+    """
+    符合 chroma EmbeddingFunction 协议的适配器，向量库客户端支持自定义 embedding function 时传入即可走缓存
+    """
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        return EmbeddingCache().get_many(list(input))
@@ -0,0 +1,87 @@
+import threading
+from collections import deque
+from itertools import islice
+from typing import Deque, Dict, List, Optional, Type
+
+from common_py.model.base import BaseEvent
+
+
+class EventRingBuffer:
+    """
+    定长环形事件缓冲区，替代 MemoryManager 中无限增长的 list
+    每个事件分配一个单调递增的序号(seq)，序号不会因为覆盖而复用，zip_index 等外部索引都基于序号记录
+    同时按事件具体类型维护二级索引，"最近N条某类型事件" 只需要访问 N 个元素，而不是扫描整个缓冲区
+    """
+
+    def __init__(self, capacity: int):
+        if capacity <= 0:
+            raise ValueError(f"capacity must be positive, got {capacity}")
+        self.capacity = capacity
+        self._slots: List[Optional[BaseEvent]] = [None] * capacity
+        self._next_seq: int = 0  # 下一个写入事件的序号
+        self._type_index: Dict[Type[BaseEvent], Deque[int]] = {}
+        self._lock = threading.Lock()
+
+    def append(self, event: BaseEvent) -> int:
+        with self._lock:
+            seq = self._next_seq
+            pos = seq % self.capacity
+            evicted = self._slots[pos]
+            if evicted is not None:
+                # 被覆盖的事件一定是该类型索引中最老的一条
+                evicted_index = self._type_index.get(type(evicted))
+                if evicted_index and evicted_index[0] == seq - self.capacity:
+                    evicted_index.popleft()
+            self._slots[pos] = event
+            self._type_index.setdefault(type(event), deque()).append(seq)
+            self._next_seq += 1
+            return seq
+
+    def __len__(self) -> int:
+        return min(self._next_seq, self.capacity)
+
+    def first_seq(self) -> int:
+        """缓冲区内最老事件的序号"""
+        return max(0, self._next_seq - self.capacity)
+
+    def last_seq(self) -> int:
+        """缓冲区内最新事件的序号，空缓冲区返回 -1"""
+        return self._next_seq - 1
+
+    def is_full(self) -> bool:
+        return self._next_seq >= self.capacity
+
+    def get(self, seq: int) -> BaseEvent:
+        with self._lock:
+            if seq < self.first_seq() or seq > self.last_seq():
+                raise IndexError(f"seq {seq} out of buffer range [{self.first_seq()}, {self.last_seq()}]")
+            return self._slots[seq % self.capacity]
+
+    def slice_from(self, seq: int, end: Optional[int] = None) -> List[BaseEvent]:
+        """获取序号在 [seq, end) 区间且仍在缓冲区中的事件，按时间顺序，end 为空时取到最新事件"""
+        with self._lock:
+            start = max(seq, self.first_seq())
+            stop = self._next_seq if end is None else min(end, self._next_seq)
+            return [self._slots[i % self.capacity] for i in range(start, stop)]
+
+    def last(self, count: int) -> List[BaseEvent]:
+        """最近 count 条事件，按时间顺序"""
+        if count <= 0:
+            return []
+        return self.slice_from(self._next_seq - count)
+
+    def last_of_type(self, target_type: Type[BaseEvent], count: int) -> List[BaseEvent]:
+        """
+        最近 count 条 target_type 类型(含子类)的事件，按时间顺序
+        只访问匹配类型索引尾部的 count 个序号
+        """
+        if count <= 0:
+            return []
+        with self._lock:
+            seq_lst: List[int] = []
+            for typ, index in self._type_index.items():
+                if not issubclass(typ, target_type):
+                    continue
+                seq_lst.extend(islice(reversed(index), count))
+            seq_lst.sort()
+            return [self._slots[seq % self.capacity] for seq in seq_lst[-count:]]
@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Set, Tuple
+
+from common_py.model.base import BaseEvent
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+# 内存估算用的近似值，单位字节
+Estimate_float_in_list_bytes = 32  # python list 中的一个 float(指针 + float 对象)
+Estimate_event_bytes = 512  # 一个事件对象除消息文本之外的开销
+Estimate_vector_record_bytes = 1536 * 4 + 512  # 向量库中一条记录(float32 向量 + 元数据)
+
+Eviction_sweep_interval = 30  # 单位秒
+
+EvictionReason_idle_ttl = "idle_ttl"
+EvictionReason_max_entries = "max_entries"
+EvictionReason_byte_budget = "byte_budget"
+
+
+def estimate_events_bytes(events: List[BaseEvent]) -> int:
+    total = 0
+    for event in events:
+        total += Estimate_event_bytes + len(getattr(event, "message", "") or "")
+    return total
+
+
+def estimate_block_bytes(block) -> int:
+    """
+    EventBlock 的近似内存占用，主要是两个 1536 维向量和原始事件
+    """
+    return (len(block.embedding_1536D) + len(block.tags_embedding_1536D)) * Estimate_float_in_list_bytes \
+        + len(block.summary) + len(block.raw_summary) + estimate_events_bytes(block.origin_event)
+
+
+class EvictionPolicy:
+    """
+    常驻内存的记忆对象(海马体、长期记忆)的淘汰策略，按最近访问顺序维护所有 key
+    后台线程定期检查，依次按空闲超时、条目数上限、内存预算淘汰最久未访问的条目
+    淘汰调用与正常销毁相同的 evict 回调；正在销毁或 is_busy 返回 True 的条目被固定，不会被淘汰
+    """
+
+    def __init__(self, name: str, max_entries: int, idle_ttl: int, byte_budget: int,
+                 size_of: Callable[[str], int], is_busy: Callable[[str], bool], evict: Callable[[str], None]):
+        self.name = name
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.byte_budget = byte_budget
+        self._size_of = size_of
+        self._is_busy = is_busy
+        self._evict = evict
+        self._lock = threading.Lock()
+        self._last_access: OrderedDict = OrderedDict()
+        self._pinned: Dict[str, int] = {}
+        self._sizes: Dict[str, int] = {}
+        self.evicted_count: Dict[str, int] = {
+            EvictionReason_idle_ttl: 0,
+            EvictionReason_max_entries: 0,
+            EvictionReason_byte_budget: 0,
+        }
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def touch(self, key: str):
+        with self._lock:
+            self._last_access[key] = time.time()
+            self._last_access.move_to_end(key)
+
+    def remove(self, key: str):
+        with self._lock:
+            self._last_access.pop(key, None)
+            self._sizes.pop(key, None)
+
+    @contextmanager
+    def pinned(self, key: str):
+        """
+        销毁(刷写)过程中固定条目，避免被后台线程重复淘汰
+        """
+        with self._lock:
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pinned[key] -= 1
+                if self._pinned[key] == 0:
+                    del self._pinned[key]
+
+    def sweep(self) -> List[Tuple[str, str]]:
+        """
+        执行一次淘汰
+        :return: 被淘汰的 (key, 原因)
+        """
+        victims = self._select_victims()
+        for key, reason in victims:
+            try:
+                with self.pinned(key):
+                    self._evict(key)
+                self.remove(key)
+                with self._lock:
+                    self.evicted_count[reason] += 1
+                logger.info(f"[{self.name}] evict {key}, reason: {reason}")
+            except Exception as e:
+                logger.error(f"[{self.name}] evict {key} error: {e}")
+        return victims
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._last_access),
+                "bytes": sum(self._sizes.values()),
+                "pinned": len(self._pinned),
+                "max_entries": self.max_entries,
+                "byte_budget": self.byte_budget,
+                "evicted": dict(self.evicted_count),
+            }
+
+    def _select_victims(self) -> List[Tuple[str, str]]:
+        with self._lock:
+            order: List[Tuple[str, float]] = list(self._last_access.items())
+        sizes: Dict[str, int] = {}
+        for key, _ in order:
+            try:
+                sizes[key] = self._size_of(key)
+            except Exception as e:
+                logger.warning(f"[{self.name}] estimate size of {key} error: {e}")
+                sizes[key] = 0
+        with self._lock:
+            self._sizes = sizes
+            pinned: Set[str] = set(self._pinned.keys())
+
+        def _evictable(_key: str) -> bool:
+            return _key not in pinned and not self._is_busy(_key)
+
+        now = time.time()
+        victims: List[Tuple[str, str]] = []
+        victim_keys: Set[str] = set()
+        for key, last_access in order:
+            if now - last_access > self.idle_ttl and _evictable(key):
+                victims.append((key, EvictionReason_idle_ttl))
+                victim_keys.add(key)
+        remaining = [key for key, _ in order if key not in victim_keys]
+        count = len(remaining)
+        total = sum(sizes[key] for key in remaining)
+        for key in remaining:
+            if count <= self.max_entries and total <= self.byte_budget:
+                break
+            if not _evictable(key):
+                continue
+            reason = EvictionReason_max_entries if count > self.max_entries else EvictionReason_byte_budget
+            victims.append((key, reason))
+            count -= 1
+            total -= sizes[key]
+        return victims
+
+    def _run(self):
+        while True:
+            time.sleep(Eviction_sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.exception(e)
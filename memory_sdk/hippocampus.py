@@ -1,13 +1,16 @@
 import logging
 import threading
-from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional
 
 from common_py.const.ai_attr import Entity_type_user
 from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
 
+from memory_sdk.eviction import EvictionPolicy
+from memory_sdk.instance_memory_block.block_flusher import BlockFlusher
 from memory_sdk.instance_memory_block.block_mgr import BlockManager
-from memory_sdk.memory_entity import UserMemoryEntity
+from memory_sdk.longterm_memory.long_term_mem_mgr import LongTermMemoryMgr
+from memory_sdk.memory_entity import UserMemoryEntity, bulk_destroy_memory_entities
+from memory_sdk.striped_lock import StripedLock
 
 
 logger = wrapper_azure_log_handler(
@@ -16,6 +19,14 @@ logger = wrapper_azure_log_handler(
     )
 )
 
+HippocampusMgr_max_entries = 2000
+HippocampusMgr_idle_ttl = 2 * 60 * 60  # 单位秒
+HippocampusMgr_byte_budget = 512 * 1024 * 1024
+Estimate_memory_entity_bytes = 2 * 1024
+
+# (AID, UID) -> UserMemoryEntity 的创建锁，所有海马体共用
+_memory_entity_locks = StripedLock()
+
 
 class Hippocampus:
 
@@ -31,31 +42,38 @@ class Hippocampus:
         :param force_update: 是否强制更新
         :return: bool 是否加载成功
         """
+        HippocampusMgr().eviction.touch(self.AID)
         try:
-            if UID in self.memory_entities:
-                entity = self.memory_entities[UID]
-            else:
-                entity = UserMemoryEntity(self.AID, UID, Entity_type_user)
-                self.memory_entities[UID] = entity
+            entity = _memory_entity_locks.get_or_create(
+                self.memory_entities, UID, lambda: self._new_memory_entity(UID), (self.AID, UID))
             if force_update:
-                entity.load_memory()
+                # 版本没有变化时不重新读取整个 hash
+                entity.reload_if_changed()
             return entity
         except Exception as e:
             logger.error(f'load memory of user error: {e}')
             return None
 
+    def _new_memory_entity(self, UID: str) -> UserMemoryEntity:
+        entity = UserMemoryEntity(self.AID, UID, Entity_type_user)
+        # 第一次加载用户记忆说明会话刚开始，提前加载长期记忆，第一条消息时召回已经可用
+        LongTermMemoryMgr().prefetch(self.AID, UID)
+        return entity
+
     def create_mem_block(self, event_slice: list):
         """
         创建记忆块
         :param event_slice: 事件列表
         """
+        HippocampusMgr().eviction.touch(self.AID)
         self.block_mgr.create(event_slice)
 
+    def estimate_bytes(self) -> int:
+        return self.block_mgr.estimate_bytes() + len(self.memory_entities) * Estimate_memory_entity_bytes
+
     def on_destroy(self):
         self.block_mgr.on_destroy(self.memory_entities)  # 和下面有先后顺序，不能一起销毁
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            for entity in self.memory_entities.values():
-                executor.submit(entity.on_destroy)
+        bulk_destroy_memory_entities(list(self.memory_entities.values()))
 
 
 class HippocampusMgr:
@@ -63,32 +81,73 @@ class HippocampusMgr:
 
     def __init__(self):
         if not hasattr(self, "_ready"):
-            HippocampusMgr._ready = True
-            self.hippocampus: Dict[str, Hippocampus] = {}
+            # 初始化完成后才设置 _ready，避免并发的第一次调用拿到没有初始化完的对象
+            with HippocampusMgr._instance_lock:
+                if not hasattr(self, "_ready"):
+                    self.hippocampus: Dict[str, Hippocampus] = {}
+                    self._locks = StripedLock()
+                    # AID -> 持有该海马体的 MemoryManager 数量，读写都在 AID 对应的分段锁内
+                    self._sessions: Dict[str, int] = {}
+                    # 有 block 正在写入或者有会话持有的海马体不淘汰
+                    self.eviction = EvictionPolicy("hippocampus", HippocampusMgr_max_entries, HippocampusMgr_idle_ttl,
+                                                   HippocampusMgr_byte_budget,
+                                                   size_of=lambda AID: self.hippocampus[AID].estimate_bytes() if AID in self.hippocampus else 0,
+                                                   is_busy=lambda AID: self._sessions.get(AID, 0) > 0
+                                                   or BlockFlusher().outstanding(AID) > 0,
+                                                   evict=self._evict)
+                    HippocampusMgr._ready = True
 
     def get_hippocampus(self, AID: str) -> Optional[Hippocampus]:
         """
         获取海马体
         """
         try:
-            if AID in self.hippocampus:
-                return self.hippocampus[AID]
-            else:
-                hippocampus = Hippocampus(AID)
-                self.hippocampus[AID] = hippocampus
-                return hippocampus
+            self.eviction.touch(AID)
+            return self._locks.get_or_create(self.hippocampus, AID, lambda: Hippocampus(AID))
         except Exception as e:
             logger.error(f'get hippocampus error: {e}')
             return None
 
+    def open_session(self, AID: str) -> Optional[Hippocampus]:
+        """
+        MemoryManager 持有海马体期间不会被淘汰，会话结束时调用 close_session
+        先登记再获取，淘汰线程在同一把锁内检查登记，不会移除会话正在使用的海马体
+        """
+        with self._locks.lock_for(AID):
+            self._sessions[AID] = self._sessions.get(AID, 0) + 1
+        return self.get_hippocampus(AID)
+
+    def close_session(self, AID: str):
+        with self._locks.lock_for(AID):
+            count = self._sessions.get(AID, 0) - 1
+            if count > 0:
+                self._sessions[AID] = count
+            else:
+                self._sessions.pop(AID, None)
+        # 从最后一个会话结束开始计算空闲时间
+        self.eviction.touch(AID)
+
     def destroy(self, AID: str):
         """
         销毁
         """
+        self._destroy(AID, False)
+
+    def _evict(self, AID: str):
+        self._destroy(AID, True)
+
+    def _destroy(self, AID: str, keep_live_session: bool):
         try:
-            if AID in self.hippocampus:
-                self.hippocampus[AID].on_destroy()
-                del self.hippocampus[AID]
+            with self.eviction.pinned(AID):
+                # 先从表中移除，销毁期间新的请求会创建新的海马体
+                with self._locks.lock_for(AID):
+                    if keep_live_session and self._sessions.get(AID, 0) > 0:
+                        logger.info(f"skip evicting hippocampus with live session, AID: {AID}")
+                        return
+                    hippocampus = self.hippocampus.pop(AID, None)
+                if hippocampus is not None:
+                    hippocampus.on_destroy()
+            self.eviction.remove(AID)
         except Exception as e:
             logger.error(f'destroy error: {e}')
 
@@ -0,0 +1,97 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, List, Tuple
+
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+# 到期回调(通常是总结记忆块，包含LLM调用)在共享线程池中执行
+IdleScheduler_worker_num = 8
+
+
+class IdleScheduler:
+    """
+    进程级的空闲检测调度器
+    所有会话共用一个最小堆记录各自的空闲截止时间，只有一个线程等待最近的截止时间，
+    替代每个AI一个每5秒轮询一次的线程。
+
+    截止时间被推迟时不删除堆中的旧记录，而是在弹出时和 _deadlines 中的最新值比较，过期记录直接丢弃。
+    """
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        if not hasattr(self, "_ready"):
+            IdleScheduler._ready = True
+            self._heap: List[Tuple[float, str]] = []
+            self._deadlines: Dict[str, float] = {}
+            self._callbacks: Dict[str, Callable[[], None]] = {}
+            self._cond = threading.Condition()
+            self._executor = ThreadPoolExecutor(max_workers=IdleScheduler_worker_num,
+                                                thread_name_prefix="idle_scheduler")
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def touch(self, key: str, deadline: float, callback: Callable[[], None]):
+        """
+        设置(或推迟) key 的空闲截止时间，到期后在共享线程池中执行 callback
+        """
+        with self._cond:
+            self._deadlines[key] = deadline
+            self._callbacks[key] = callback
+            heapq.heappush(self._heap, (deadline, key))
+            if self._heap[0][1] == key:
+                # 新的截止时间比当前等待的更早，唤醒调度线程重新计算等待时长
+                self._cond.notify()
+
+    def cancel(self, key: str):
+        with self._cond:
+            self._deadlines.pop(key, None)
+            self._callbacks.pop(key, None)
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def pending_count(self) -> int:
+        return len(self._deadlines)
+
+    def _run(self):
+        while True:
+            try:
+                with self._cond:
+                    while not self._heap:
+                        self._cond.wait()
+                    deadline, key = self._heap[0]
+                    now = time.time()
+                    if deadline > now:
+                        self._cond.wait(deadline - now)
+                        continue
+                    heapq.heappop(self._heap)
+                    if self._deadlines.get(key) != deadline:
+                        # 已被推迟或取消的旧记录
+                        continue
+                    del self._deadlines[key]
+                    callback = self._callbacks.pop(key)
+                self._executor.submit(self._safe_call, callback)
+            except Exception as e:
+                logger.exception(e)
+
+    @staticmethod
+    def _safe_call(callback: Callable[[], None]):
+        try:
+            callback()
+        except Exception as e:
+            logger.exception(e)
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(IdleScheduler, "_instance"):
+            with IdleScheduler._instance_lock:
+                if not hasattr(IdleScheduler, "_instance"):
+                    IdleScheduler._instance = object.__new__(cls)
+        return IdleScheduler._instance
@@ -0,0 +1,136 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from common_py.client.azure_mongo import MongoDBClient
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+from memory_sdk.instance_memory_block.event_block import EventBlock
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+BlockFlusher_queue_size = 1000  # 队列满时 submit 阻塞调用方，形成背压
+BlockFlusher_batch_size = 100  # 单次 insert 的最大文档数
+BlockFlusher_max_age = 5  # 队列中最老的文档最多等待多久，单位秒
+BlockFlusher_drain_timeout = 30
+
+# (owner_key, mongo文档, block, 写入成功后的回调)
+FlushItem = Tuple[str, Dict, EventBlock, Optional[Callable[[EventBlock], None]]]
+
+_flush_now = object()
+
+
+class BlockFlusher:
+    """
+    进程级的 AI_memory_block 异步写入器
+    所有AI的 BlockManager 把待保存的block放进同一个有界队列，后台线程按数量或等待时长攒批，
+    用少量的批量 insert 写入 mongo，成功后在后台线程执行各 block 的后续处理(长期记忆、话题记录)
+    """
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        if not hasattr(self, "_ready"):
+            BlockFlusher._ready = True
+            self.mongo_client = MongoDBClient()
+            self._queue: queue.Queue = queue.Queue(maxsize=BlockFlusher_queue_size)
+            self._outstanding: Dict[str, int] = {}
+            self._cond = threading.Condition()
+            self.flushed_count = 0
+            self.failed_count = 0
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, owner_key: str, doc: Dict, block: EventBlock,
+               on_saved: Optional[Callable[[EventBlock], None]] = None):
+        """
+        入队即返回，队列满时阻塞直到后台线程腾出空间
+        """
+        with self._cond:
+            self._outstanding[owner_key] = self._outstanding.get(owner_key, 0) + 1
+        self._queue.put((owner_key, doc, block, on_saved))
+
+    def drain(self, owner_key: str, timeout: float = BlockFlusher_drain_timeout) -> bool:
+        """
+        立即触发一次写入，并等待 owner_key 提交的所有block处理完毕
+        :return: 是否在超时前处理完毕
+        """
+        self._queue.put(_flush_now)
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._outstanding.get(owner_key, 0) > 0:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logger.error(f"drain block flusher timeout, owner: {owner_key}, "
+                                 f"outstanding: {self._outstanding.get(owner_key, 0)}")
+                    return False
+                self._cond.wait(remaining)
+            self._outstanding.pop(owner_key, None)
+        return True
+
+    def outstanding(self, owner_key: str) -> int:
+        """
+        owner_key 已提交但还没有处理完的block数量
+        """
+        with self._cond:
+            return self._outstanding.get(owner_key, 0)
+
+    def queue_size(self) -> int:
+        return self._queue.qsize()
+
+    def _run(self):
+        batch: List[FlushItem] = []
+        first_ts = 0.0
+        while True:
+            try:
+                wait = BlockFlusher_max_age - (time.time() - first_ts) if batch else None
+                try:
+                    item = self._queue.get(timeout=max(wait, 0)) if wait is not None else self._queue.get()
+                except queue.Empty:
+                    item = None
+                flush_now = item is _flush_now
+                if item is not None and not flush_now:
+                    if not batch:
+                        first_ts = time.time()
+                    batch.append(item)
+                if not batch:
+                    continue
+                if flush_now or len(batch) >= BlockFlusher_batch_size or \
+                        time.time() - first_ts >= BlockFlusher_max_age:
+                    self._flush(batch)
+                    batch = []
+            except Exception as e:
+                logger.exception(e)
+
+    def _flush(self, batch: List[FlushItem]):
+        try:
+            self.mongo_client.create_document("AI_memory_block", [item[1] for item in batch], *['AID'])
+            self.flushed_count += len(batch)
+            logger.debug(f"mongo db create success, {len(batch)} blocks")
+            for _, _, block, on_saved in batch:
+                if on_saved is None:
+                    continue
+                try:
+                    on_saved(block)
+                except Exception as e:
+                    logger.exception(e)
+        except Exception as e:
+            self.failed_count += len(batch)
+            logger.error(f"mongo db create error: {e}, lost blocks: {[item[2].name for item in batch]}")
+        finally:
+            with self._cond:
+                for owner_key, _, _, _ in batch:
+                    if owner_key in self._outstanding:
+                        self._outstanding[owner_key] -= 1
+                self._cond.notify_all()
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(BlockFlusher, "_instance"):
+            with BlockFlusher._instance_lock:
+                if not hasattr(BlockFlusher, "_instance"):
+                    BlockFlusher._instance = object.__new__(cls)
+        return BlockFlusher._instance
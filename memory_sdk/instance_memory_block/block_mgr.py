@@ -1,7 +1,10 @@
+import json
 import logging
 import random
 import threading
 from typing import List, Dict
+
+import numpy as np
 from common_py.ai_toolkit.openAI import ChatGPTClient, Message
 from common_py.client.azure_mongo import MongoDBClient
 from common_py.client.redis_client import RedisClient
@@ -9,10 +12,15 @@ from common_py.const.ai_attr import AI_type_npc
 from common_py.dto.ai_instance import InstanceMgr
 from common_py.model.base import BaseEvent
 from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
-from common_py.utils.similarity import similarity
 
 from memory_sdk import const
+from memory_sdk.eviction import estimate_block_bytes, estimate_events_bytes
+from memory_sdk.journal import MemoryJournal, JournalKind_memory_block, JournalKind_deferred_slice
+from memory_sdk.instance_memory_block.block_flusher import BlockFlusher
 from memory_sdk.instance_memory_block.event_block import EventBlock
+from memory_sdk.instance_memory_block.importance_model import ImportanceScorer, log_importance_label
+from memory_sdk.instance_memory_block.triviality_filter import TrivialityFilter, TrivialityFilter_enabled, \
+    TrivialityDecision_defer, TrivialityDecision_keep
 from memory_sdk.longterm_memory.long_term_mem_mgr import LongTermMemoryMgr
 from memory_sdk.memory_entity import UserMemoryEntity, AI_memory_topic_mentioned_last_time
 from memory_sdk.reflection_extractor import ReflectionExtractor
@@ -23,6 +31,8 @@ logger = wrapper_azure_log_handler(
     )
 )
 
+BlockSimilarity_merge_threshold = 0.9
+
 
 class BlockManager:
     """
@@ -30,27 +40,105 @@ class BlockManager:
     creating, merging, active storage and automatic storage if OnDestory
     """
     def create(self, event_slice: List[BaseEvent]):
-        block = EventBlock(AID=self.AID)
+        event_slice, deferred_journal_id = self._pre_filter(event_slice)
+        if not event_slice:
+            return
         try:
-            block.build_from_dialogue_event(event_slice)
+            self._build_block(event_slice)
+            with self._pending_lock:
+                if len(self.save_later) > 10:
+                    self._save_block()
+        except Exception as e:
+            logger.error(f"create error: {e}")
+            return
+        finally:
+            # 合并进来的暂存片段已经生成 block 并重新记录，或者与失败的片段一起放弃
+            MemoryJournal().ack(deferred_journal_id)
 
+    def _build_block(self, event_slice: List[BaseEvent]):
+        """
+        总结、合并和重要度评分的LLM调用都在锁外，锁内只有相似度矩阵和待保存列表的读写
+        """
+        with self._pending_lock:
+            self._building += 1
+        try:
+            block = EventBlock(AID=self.AID)
+            block.build_from_dialogue_event(event_slice)
             # _maintain_similarity may return origin block or merged block with high similarity
             # if merged block, delete origin block and add merged block
-            new_block = self._maintain_similarity(block)
-            new_block.importance = self._dialogue_importance(new_block)
+            new_block, merged_journal_ids = self._maintain_similarity(block)
+            if new_block.importance == 0:
+                new_block.importance = self._dialogue_importance(new_block)
             logger.debug(f"maintain similarity success")
-            self.block_dict[block.name] = new_block
-            self.save_later.append(new_block)
-            if len(self.save_later) > 10:
-                self._save_block()
-        except Exception as e:
-            logger.error(f"create error: {e}")
-            return
+            with self._pending_lock:
+                self.block_dict[block.name] = new_block
+                self._append_pending(new_block)
+            # 合并后的 block 已经记录，被合并的 block 不再需要保存
+            MemoryJournal().ack(*merged_journal_ids)
+        finally:
+            with self._pending_cond:
+                self._building -= 1
+                self._pending_cond.notify_all()
+
+    def _pre_filter(self, event_slice: List[BaseEvent]) -> (List[BaseEvent], int):
+        """
+        调用LLM之前的本地过滤，预测为闲聊的片段先暂存，和下一个片段合并后仍然是闲聊则丢弃
+        暂存的片段写入本地日志，崩溃后重放时直接总结
+        :return: 需要总结的片段(为空表示本次不需要总结)，以及其中暂存片段的日志记录id
+        """
+        if not TrivialityFilter_enabled:
+            return event_slice, -1
+        with self._pending_lock:
+            has_deferred = len(self._deferred_slice) > 0
+            event_slice = self._deferred_slice + list(event_slice)
+            deferred_journal_id = self._deferred_journal_id
+            self._deferred_slice = []
+            self._deferred_journal_id = -1
+            decision = self.triviality_filter.decide(self.AID, event_slice, has_deferred)
+            if decision == TrivialityDecision_defer:
+                self._deferred_slice = event_slice
+                self._deferred_journal_id = MemoryJournal().append(JournalKind_deferred_slice, {
+                    "AID": self.AID,
+                    "events": [json.loads(event.json()) for event in event_slice],
+                })
+            if decision != TrivialityDecision_keep:
+                MemoryJournal().ack(deferred_journal_id)
+                return [], -1
+        return event_slice, deferred_journal_id
 
     def on_destroy(self, memory_entities: Dict[str, UserMemoryEntity]):
-        self._save_block(memory_entities)
+        with self._pending_lock:
+            deferred_slice, deferred_journal_id = self._deferred_slice, self._deferred_journal_id
+            self._deferred_slice = []
+            self._deferred_journal_id = -1
+        # 暂存的片段没有等到下一个片段，销毁前同步总结，和其他待保存的block一起写入
+        if len(deferred_slice) > 0:
+            logger.info(f"flush deferred slice on destroy, AID: {self.AID}, events: {len(deferred_slice)}")
+            try:
+                self._build_block(deferred_slice)
+            except Exception as e:
+                logger.error(f"flush deferred slice error: {e}")
+        MemoryJournal().ack(deferred_journal_id)
+        with self._pending_cond:
+            # 等待进行中的 block 生成完成并放入待保存列表
+            while self._building > 0:
+                self._pending_cond.wait()
+            self._save_block(memory_entities)
+        # 等待本AI提交的block全部写入，之后 memory entity 才能销毁
+        BlockFlusher().drain(self.AID)
+
+    def estimate_bytes(self) -> int:
+        """
+        近似内存占用，block_dict 中的 block(含待保存的)、向量矩阵和暂存的闲聊事件
+        """
+        total = sum(estimate_block_bytes(block) for block in list(self.block_dict.values()))
+        return total + self.pending_matrix.nbytes + estimate_events_bytes(self._deferred_slice)
 
     def _dialogue_importance(self, event_block: EventBlock) -> int:
+        # 本地模型有把握时不再调用LLM
+        score = ImportanceScorer().score(event_block)
+        if score is not None:
+            return score
         messages = [
             Message(role="system", content=const.dialogue_importance),
             Message(role="user", content=event_block.raw_summary),
@@ -60,6 +148,8 @@ class BlockManager:
                 res = ChatGPTClient(temperature=0.0).generate(messages=messages)
                 rate = self._parse_rate(res.get_chat_content())
                 if rate is not None:
+                    # 包括之后会被丢弃的低重要度 block，作为本地模型的训练标签
+                    log_importance_label(event_block, rate)
                     return rate
             except Exception as e:
                 logger.error(f"dialogue importance error: {e}")
@@ -81,52 +171,110 @@ class BlockManager:
         if len(split_res) == 2 and split_res[1].strip().isdigit():
             return int(split_res[1].strip())
 
-    def _maintain_similarity(self, new_block: EventBlock) -> EventBlock:
-        need_merge_event = []
-        for block in self.save_later:
-            sim = similarity(new_block.embedding_1536D, block.embedding_1536D)
-            if sim > 0.9:
-                logger.debug(f"similarity: {sim}, merge block: {block.name}, "
-                             f"with content old: {block.summary}, new: {new_block.summary}")
-                need_merge_event.append(block)
-        if len(need_merge_event) > 0:
-            need_merge_event.append(new_block)
-            merged_block = EventBlock()
-            merged_block.merge_event_block(*need_merge_event)
-            for block in need_merge_event:
-                if block.name in self.block_dict:
-                    del self.block_dict[block.name]
-                if block in self.save_later:
-                    self.save_later.remove(block)
-            return self._maintain_similarity(merged_block)
-        return new_block
+    def _maintain_similarity(self, new_block: EventBlock) -> (EventBlock, List[int]):
+        """
+        新block和所有待保存block做一次矩阵向量乘法，相似度超过阈值的block通过并查集传递性地归为一组，
+        整组只调用一次LLM合并，不再递归地合并再比较
+        锁内只找出这一组并从待保存列表中取出，合并在锁外进行，失败时放回
+        :return: 新block或合并后的block，以及被合并block的日志记录id，由调用方在合并后的block记录之后 ack
+        """
+        new_vector = _normalize(new_block.embedding_1536D)
+        with self._pending_lock:
+            merge_idx_lst = self._find_merge_group(new_vector)
+            if len(merge_idx_lst) == 0:
+                return new_block, []
+            need_merge_event = [self.save_later[idx] for idx in merge_idx_lst]
+            self._remove_pending(merge_idx_lst)
+        for block in need_merge_event:
+            logger.debug(f"merge block: {block.name}, "
+                         f"with content old: {block.summary}, new: {new_block.summary}")
+        merged_block = EventBlock(AID=self.AID)
+        try:
+            merged_block.merge_event_block(*need_merge_event, new_block)
+        except Exception:
+            with self._pending_lock:
+                for block in need_merge_event:
+                    self._push_pending(block)
+            raise
+        with self._pending_lock:
+            for block in need_merge_event + [new_block]:
+                self.block_dict.pop(block.name, None)
+            merged_journal_ids = [self._journal_ids.pop(block.name, -1) for block in need_merge_event]
+        return merged_block, merged_journal_ids
+
+    def _find_merge_group(self, new_vector: np.ndarray) -> List[int]:
+        """
+        返回与新block(直接或间接)相似的待保存block下标
+        """
+        pending_count = len(self.save_later)
+        if pending_count == 0:
+            return []
+        new_sim = self.pending_matrix @ new_vector
+        seeds = np.nonzero(new_sim > BlockSimilarity_merge_threshold)[0]
+        if len(seeds) == 0:
+            return []
+
+        # 下标 pending_count 代表新block
+        parent = list(range(pending_count + 1))
+
+        def find(x: int) -> int:
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        def union(x: int, y: int):
+            root_x, root_y = find(x), find(y)
+            if root_x != root_y:
+                parent[root_x] = root_y
+
+        for idx in seeds:
+            union(int(idx), pending_count)
+        pending_sim = self.pending_matrix @ self.pending_matrix.T
+        rows, cols = np.nonzero(np.triu(pending_sim > BlockSimilarity_merge_threshold, k=1))
+        for i, j in zip(rows, cols):
+            union(int(i), int(j))
+        new_root = find(pending_count)
+        return [idx for idx in range(pending_count) if find(idx) == new_root]
+
+    def _append_pending(self, block: EventBlock):
+        self._journal_ids[block.name] = MemoryJournal().append(JournalKind_memory_block, {
+            "AID": self.AID,
+            "block": json.loads(block.json(exclude={'embedding_1536D', 'tags_embedding_1536D'})),
+        })
+        self._push_pending(block)
+
+    def _push_pending(self, block: EventBlock):
+        self.save_later.append(block)
+        self.pending_matrix = np.vstack([self.pending_matrix, _normalize(block.embedding_1536D)[np.newaxis, :]]) \
+            if self.pending_matrix.size > 0 else _normalize(block.embedding_1536D)[np.newaxis, :]
+
+    def _remove_pending(self, idx_lst: List[int]):
+        """
+        只移出待保存列表，日志记录由调用方在合并后的block记录之后 ack
+        """
+        remove_set = set(idx_lst)
+        keep = [idx for idx in range(len(self.save_later)) if idx not in remove_set]
+        self.save_later = [self.save_later[idx] for idx in keep]
+        self.pending_matrix = np.ascontiguousarray(self.pending_matrix[keep])
+
+    def _clear_pending(self):
+        self.save_later = []
+        self.pending_matrix = np.empty((0, 0), dtype=np.float32)
 
     def _save_block(self, memory_entities: Dict[str, UserMemoryEntity] = None):
-        documents = []
+        """
+        把待保存的block交给 BlockFlusher 异步写入，入队即返回
+        """
         for event_block in self.save_later:
             if event_block.importance <= 3:
+                MemoryJournal().ack(self._journal_ids.pop(event_block.name, -1))
                 continue
             doc = event_block.dict(exclude={'embedding_1536D', 'tags_embedding_1536D'})
             if self.AI_basic_info.type == AI_type_npc:
                 doc.update({'_partition_key': self.AID + '-' + str(random.randint(0, 100))})
-            documents.append(event_block.dict(exclude={'embedding_1536D', 'tags_embedding_1536D'}))
-        if len(documents) == 0:
-            logger.error(f"mongo db create error cause by empty documents")
-            return
-        self.mongo_client.create_document("AI_memory_block", documents, *['AID'])
-        logger.debug(f"mongo db create success, {documents}")
-
-        # update user memory entity of good topic_mentioned_last_time
-        for event_block in self.save_later:
-            for uid in event_block.participant_ids:
-
-                LongTermMemoryMgr().update_event_block_for_entity(self.AID, uid, [event_block])
-                most_importance_of_user = self.uid_importance_mem_dict.get(uid, 0)
-                if most_importance_of_user < event_block.importance:
-                    self.uid_importance_mem_dict[uid] = event_block.importance
-                    entity = memory_entities.get(uid, None)
-                    if entity is not None:
-                        entity.set_topic_mentioned_last_time(event_block.name)
+            BlockFlusher().submit(self.AID, doc, event_block,
+                                  lambda block: self._on_block_saved(block, memory_entities))
 
         # redis_key = _gen_block_list_key(self.AID)
         # pipeline = self.redis_client.pipeline()
@@ -157,10 +305,36 @@ class BlockManager:
         #             upsert_request['metadata']['participates'] = list(self.save_later[i].participant_ids.keys())
         #         executor.submit(pinecone.upsert_index, **upsert_request)
 
-        self.save_later.clear()
+        self._clear_pending()
+
+    def _on_block_saved(self, event_block: EventBlock, memory_entities: Dict[str, UserMemoryEntity] = None):
+        """
+        block 写入 mongo 成功后在 BlockFlusher 线程中执行
+        update user memory entity of good topic_mentioned_last_time
+        """
+        MemoryJournal().ack(self._journal_ids.pop(event_block.name, -1))
+        for uid in event_block.participant_ids:
+            LongTermMemoryMgr().update_event_block_for_entity(self.AID, uid, [event_block])
+            most_importance_of_user = self.uid_importance_mem_dict.get(uid, 0)
+            if most_importance_of_user < event_block.importance:
+                self.uid_importance_mem_dict[uid] = event_block.importance
+                entity = memory_entities.get(uid, None) if memory_entities else None
+                if entity is not None:
+                    entity.set_topic_mentioned_last_time(event_block.name)
 
     def __init__(self, AID: str):
         self.save_later: List[EventBlock] = []
+        self._pending_lock = threading.RLock()
+        # 进行中的 block 生成数，on_destroy 等待它们放入待保存列表之后再保存
+        self._pending_cond = threading.Condition(self._pending_lock)
+        self._building = 0
+        self.triviality_filter = TrivialityFilter()
+        self._deferred_slice: List[BaseEvent] = []  # 被预测为闲聊、等待与下一个片段合并的事件
+        self._deferred_journal_id = -1  # _deferred_slice 对应的本地日志记录
+        # block name -> 本地日志记录id，block 写入 mongo 或被丢弃后 ack
+        self._journal_ids: Dict[str, int] = {}
+        # 与 save_later 一一对应的归一化 float32 向量矩阵
+        self.pending_matrix: np.ndarray = np.empty((0, 0), dtype=np.float32)
         self.block_dict: Dict[str, EventBlock] = {}
         self.mongo_client = MongoDBClient()
         self.AI_basic_info = InstanceMgr().get_instance_info(AID)
@@ -170,3 +344,10 @@ class BlockManager:
 
         self.extract_reflection = ReflectionExtractor(self.AID)
 
+
+def _normalize(vector: List[float]) -> np.ndarray:
+    arr = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(arr)
+    if norm == 0:
+        return arr
+    return arr / norm
@@ -1,13 +1,13 @@
 import csv
 import json
 import logging
+import threading
 import time
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 from common_py.ai_toolkit.openAI import ChatGPTClient, Message
 from common_py.client.azure_mongo import MongoDBClient
-from common_py.client.embedding import OpenAIEmbedding
-from common_py.const.ai_attr import Entity_type_user
 from common_py.model.base import BaseEvent
 from common_py.model.chat import ConversationEvent
 from common_py.model.scene.scene import SceneEvent
@@ -16,7 +16,9 @@ from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
 from common_py.utils.util import get_random_str
 from pydantic import BaseModel
 from memory_sdk import const
-from memory_sdk.memory_entity import UserMemoryEntity
+from memory_sdk.embedding_cache import EmbeddingCache
+from memory_sdk.memory_entity import NicknameResolver
+from memory_sdk.name_substitution import NameSubstitution, fill_placeholders
 
 logger = wrapper_azure_log_handler(
     wrapper_std_output(
@@ -24,6 +26,14 @@ logger = wrapper_azure_log_handler(
     )
 )
 
+# 本地名字替换未命中时，是否使用LLM兜底替换剩余的名字
+EventBlock_LLM_name_fallback = False
+# 总结、标签、参与者和重要度在一次LLM调用中生成，两个向量在一次embedding请求中生成
+EventBlock_fused_summarize = True
+BlockSummaryCache_capacity = 10000
+# 只读取 block 总结时不需要的大字段，index_vectors 为长期记忆本地索引保存的问题向量
+Block_summary_projection = {'origin_event': 0, 'embedding_1536D': 0, 'tags_embedding_1536D': 0, 'index_vectors': 0}
+
 
 class EventBlock(BaseModel):
     origin_event: List[BaseEvent] = []
@@ -40,6 +50,7 @@ class EventBlock(BaseModel):
     embedding_1536D: List[float] = []
     tags_embedding_1536D: List[float] = []
     importance: int = 0
+    index_questions: List[str] = []  # 长期记忆向量检索用的问题，第一次生成后保存，重建时不再调用LLM
 
     # top3_similar_block: List[Tuple[str, float]] = []
 
@@ -63,12 +74,20 @@ class EventBlock(BaseModel):
         if zipped_text == "":
             raise Exception("Event log is empty")
         logger.debug(f"zipped_text: {zipped_text}")
-        messages = [
-            Message(role="system", content=const.summary_tpl),
-            Message(role="user", content=const.few_shot_user),
-            Message(role="assistant", content=const.few_shot_assistant),
-            Message(role="user", content=zipped_text),
-        ]
+        if EventBlock_fused_summarize:
+            messages = [
+                Message(role="system", content=const.summary_with_importance_tpl),
+                Message(role="user", content=const.few_shot_user),
+                Message(role="assistant", content=const.few_shot_assistant_with_importance),
+                Message(role="user", content=zipped_text),
+            ]
+        else:
+            messages = [
+                Message(role="system", content=const.summary_tpl),
+                Message(role="user", content=const.few_shot_user),
+                Message(role="assistant", content=const.few_shot_assistant),
+                Message(role="user", content=zipped_text),
+            ]
         response = ChatGPTClient(temperature=0).generate(messages=messages)
         try:
             extract_content = json.loads(response.get_chat_content())
@@ -88,47 +107,52 @@ class EventBlock(BaseModel):
         for event in self.origin_event:
             if isinstance(event, ConversationEvent):
                 chatting_speaker[event.speaker_name] = event.speaker
-        replaced_summary = extract_content["summary"]
-        if len(chatting_speaker) > 0 :
-            speaker_name_to_id = ""
-            example_username = list(chatting_speaker.keys())[0]
-            example_UID = chatting_speaker[example_username]
-            for name, id in chatting_speaker.items():
-                # 因为数字无法作为格式化字符串的key，所以加上一个后缀
-                speaker_name_to_id += f"username {name} with id: {id} \n"
-            summary_response = ChatGPTClient(temperature=0).generate(messages=
-            [
-                Message(role="system", content=const.change_name_to_id.format(example_username=example_username, example_UID=example_UID) + speaker_name_to_id),
-                Message(role="user", content=replaced_summary)
-            ]
-            )
-
-            replaced_summary = summary_response.get_chat_content()
+        replaced_summary, unresolved_names = NameSubstitution(chatting_speaker).substitute(extract_content["summary"])
+        if len(unresolved_names) > 0 and EventBlock_LLM_name_fallback:
+            replaced_summary = self._llm_change_name_to_id(replaced_summary,
+                                                           {name: chatting_speaker[name] for name in unresolved_names})
 
         self.tags = extract_content["tags"]
         self.participants = extract_content["participants"]
         self.summary = replaced_summary
         self.raw_summary = extract_content["summary"]
+        if EventBlock_fused_summarize:
+            # importance 为0时由 BlockManager 单独请求LLM评分
+            self.importance = _parse_importance(extract_content.get("importance", None))
         logger.debug(f"summary result: {self.summary}")
-        embedding = OpenAIEmbedding()
-        self.embedding_1536D = embedding(input=self.summary)
-        self.tags_embedding_1536D = embedding(input=",".join(self.tags))
+        if EventBlock_fused_summarize:
+            self.embedding_1536D, self.tags_embedding_1536D = EmbeddingCache().get_many([self.summary, ",".join(self.tags)])
+        else:
+            self.embedding_1536D = EmbeddingCache().get(self.summary)
+            self.tags_embedding_1536D = EmbeddingCache().get(",".join(self.tags))
+
+    def _llm_change_name_to_id(self, summary: str, name_to_id: Dict[str, str]) -> str:
+        """
+        本地替换没有命中的名字(比如LLM改写了名字的拼写)，交给LLM兜底
+        """
+        speaker_name_to_id = ""
+        example_username = list(name_to_id.keys())[0]
+        example_UID = name_to_id[example_username]
+        for name, id in name_to_id.items():
+            # 因为数字无法作为格式化字符串的key，所以加上一个后缀
+            speaker_name_to_id += f"username {name} with id: {id} \n"
+        summary_response = ChatGPTClient(temperature=0).generate(messages=
+        [
+            Message(role="system", content=const.change_name_to_id.format(example_username=example_username, example_UID=example_UID) + speaker_name_to_id),
+            Message(role="user", content=summary)
+        ]
+        )
+        return summary_response.get_chat_content()
 
     def get_summary(self):
-        for id, name in self.participant_ids.items():
-            try:
-                mem_entity = UserMemoryEntity(self.AID, id, Entity_type_user)
-                if mem_entity is None or mem_entity.target_nickname == '':
-                    continue
-                self.participant_ids[id] = mem_entity.target_nickname
-            except Exception as e:
-                logger.error(f"get_summary error: {e}")
-                continue
-
-        summary = self.summary
-        for id, name in self.participant_ids.items():
-            summary = summary.replace(f'{{{id}}}', name)
-        return summary
+        try:
+            nicknames = NicknameResolver().resolve_many(self.AID, list(self.participant_ids.keys()))
+            for id, nickname in nicknames.items():
+                if nickname != '':
+                    self.participant_ids[id] = nickname
+        except Exception as e:
+            logger.error(f"get_summary error: {e}")
+        return fill_placeholders(self.summary, self.participant_ids)
 
     def merge_event_block(self, *blocks):
         event_list = []
@@ -146,18 +170,96 @@ class EventBlock(BaseModel):
         return f"memory_block_{self.AID}_{self.create_timestamp}_{get_random_str(10)}"
 
 
+def _parse_importance(importance) -> int:
+    """
+    LLM 给出的 importance 可能是数字或数字字符串，不合法时返回0
+    """
+    try:
+        rate = int(str(importance).strip())
+    except (TypeError, ValueError):
+        return 0
+    if rate < 1 or rate > 10:
+        return 0
+    return rate
+
+
 def load_block_from_mongo(block_name: str) -> EventBlock:
-    mongo_client = MongoDBClient()
-    res = mongo_client.find_one_from_collection('AI_memory_block', {'name': block_name})
-    if not res:
+    block = load_blocks([block_name]).get(block_name, None)
+    if block is None:
         raise Exception(f"can not find block: {block_name}")
-    del res['origin_event']
-    block = EventBlock(**res)
     return block
 
 
-def from_mongo_res_to_event_block(res: Dict) -> EventBlock:
-    origin_event = res['origin_event']
+class _BlockSummaryCache:
+    """
+    block 保存之后不再修改，按 block name 缓存不含 origin_event 和向量的 block
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, block_name: str) -> Optional[EventBlock]:
+        with self._lock:
+            block = self._data.get(block_name, None)
+            if block is not None:
+                self._data.move_to_end(block_name)
+            return block
+
+    def put(self, block: EventBlock):
+        with self._lock:
+            self._data[block.name] = block
+            self._data.move_to_end(block.name)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+
+_block_summary_cache = _BlockSummaryCache(BlockSummaryCache_capacity)
+
+
+def load_blocks(block_names: List[str], fields: Optional[List[str]] = None) -> Dict[str, EventBlock]:
+    """
+    批量加载 block，一次 $in 查询，不读取 origin_event 和向量
+    :param fields: 只需要部分字段时指定，未命中缓存的部分只查询这些字段，结果不进入缓存
+    :return: block name -> block，找不到的 block 不在结果中
+    """
+    result: Dict[str, EventBlock] = {}
+    missing: List[str] = []
+    for block_name in dict.fromkeys(block_names):
+        block = _block_summary_cache.get(block_name)
+        if block is None:
+            missing.append(block_name)
+        else:
+            # 调用方可能修改 block(比如 get_summary 会更新 participant_ids)，返回副本
+            result[block_name] = block.copy(deep=True)
+    if len(missing) == 0:
+        return result
+
+    if fields:
+        projection = {field: 1 for field in fields}
+        projection['name'] = 1
+    else:
+        projection = dict(Block_summary_projection)
+    res_lst = MongoDBClient().find_from_collection('AI_memory_block', filter={'name': {'$in': missing}},
+                                                   projection=projection)
+    for res in res_lst:
+        res.pop('origin_event', None)
+        block = EventBlock(**res)
+        if not fields:
+            _block_summary_cache.put(block)
+            block = block.copy(deep=True)
+        result[block.name] = block
+    not_found = [block_name for block_name in missing if block_name not in result]
+    if len(not_found) > 0:
+        logger.warning(f"can not find blocks: {not_found}")
+    return result
+
+
+def events_from_dicts(origin_event: List[Dict]) -> List[BaseEvent]:
+    """
+    按 event_source 还原事件的具体类型
+    """
     events = []
     for e in origin_event:
         if e.get('event_source', '') == 'conversation':
@@ -166,6 +268,11 @@ def from_mongo_res_to_event_block(res: Dict) -> EventBlock:
             events.append(SystemHintEvent(**e))
         elif e.get('event_source', '') == 'scene_event':
             events.append(SceneEvent(**e))
+    return events
+
+
+def from_mongo_res_to_event_block(res: Dict) -> EventBlock:
+    events = events_from_dicts(res['origin_event'])
     del res['origin_event']
     block_item = EventBlock(**res)
     block_item.origin_event = events
@@ -173,14 +280,7 @@ def from_mongo_res_to_event_block(res: Dict) -> EventBlock:
 
 
 def load_event_block_by_name(block_name: str) -> Optional[EventBlock]:
-    mongo_client = MongoDBClient()
-    block_res = mongo_client.find_one_from_collection('AI_memory_block', {'name': block_name})
-    if not block_res:
-        logger.error(f"can not find block: {block_name}")
-        return None
-    del block_res['origin_event']
-    block = EventBlock(**block_res)
-    return block
+    return load_blocks([block_name]).get(block_name, None)
 
 
 def load_user_block_from_mongo(UID: str) -> List[EventBlock]:
@@ -0,0 +1,43 @@
+"""
+评估本地重要度模型与LLM打分的一致程度
+
+用法:
+python -m memory_sdk.instance_memory_block.importance_eval --export labels.jsonl --model importance_model.npz --holdout 0.2
+输出: 覆盖率(不需要回退LLM的比例)、MAE、完全一致率、误差在1以内的比例、是否保存(>3)的一致率、单条打分耗时
+以及低重要度(<=3) block 的一致程度和被有把握地误判为需要保存的比例
+--holdout / --seed 与训练时相同时只评估训练没有用到的留出集
+"""
+import argparse
+import json
+
+from memory_sdk.instance_memory_block.importance_model import ImportanceModel_path, ImportanceScorer, \
+    build_dataset, evaluate, load_labeled_docs, predict_many, split_holdout
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export", type=str, default=None, help="mongoexport 导出的 jsonl 文件，为空时查询 mongo")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--model", type=str, default=ImportanceModel_path)
+    parser.add_argument("--holdout", type=float, default=0.0, help="只评估留出集，为0时评估全部")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    scorer = ImportanceScorer()
+    scorer.reload(args.model)
+    if scorer.model is None:
+        raise Exception(f"importance model not found: {args.model}")
+    x, y = build_dataset(load_labeled_docs(args.export, args.limit))
+    if args.holdout > 0:
+        _, test_idx = split_holdout(len(y), args.holdout, args.seed)
+        x, y = x[test_idx], y[test_idx]
+    if (y <= 3).sum() == 0:
+        print("warning: no low importance labels in the evaluation set")
+    predictions, confident, cost_us = predict_many(scorer, x)
+    report = evaluate(predictions, confident, y)
+    report["score_latency_us"] = cost_us
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from common_py.client.azure_mongo import MongoDBClient
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+from memory_sdk.embedding_cache import EmbeddingCache
+from memory_sdk.instance_memory_block.event_block import EventBlock
+from memory_sdk.instance_memory_block.triviality_filter import TrivialityFilter_keyword_lexicon, count_keyword_hits
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+ImportanceModel_path = os.environ.get("IMPORTANCE_MODEL_PATH", "./importance_model.npz")
+ImportanceModel_ridge_alpha = 10.0
+# block importance <= 3 不会被保存，预测区间(预测值 ± z * 留出集残差标准差)不跨过这条线时才信任本地模型，否则回退到LLM
+ImportanceModel_save_line = 3.5
+ImportanceModel_confidence_z = 1.645
+ImportanceModel_embedding_batch = 100
+# LLM 对每个 block 的打分(包括因为 importance <= 3 被丢弃的)，作为训练标签
+# AI_memory_block 只保存 importance > 3 的 block，不能直接作为训练集
+ImportanceLabel_collection = "AI_memory_importance_label"
+
+
+def text_features(raw_summary: str, participant_count: int, tag_count: int) -> List[float]:
+    lowered = raw_summary.lower()
+    return [
+        float(np.log1p(len(lowered.split()))),
+        float(participant_count),
+        float(tag_count),
+        float(count_keyword_hits(lowered, TrivialityFilter_keyword_lexicon)),
+    ]
+
+
+def log_importance_label(event_block: EventBlock, importance: int):
+    """
+    记录LLM给出的打分，失败只打日志，不影响 block 的创建
+    """
+    try:
+        MongoDBClient().create_document(ImportanceLabel_collection, [{
+            "AID": event_block.AID,
+            "name": event_block.name,
+            "summary": event_block.summary,
+            "raw_summary": event_block.raw_summary,
+            "participant_count": len(event_block.participant_ids),
+            "tag_count": len(event_block.tags),
+            "importance": importance,
+            "create_timestamp": event_block.create_timestamp,
+        }], *['AID'])
+    except Exception as e:
+        logger.error(f"log importance label error: {e}")
+
+
+def block_features(event_block: EventBlock) -> np.ndarray:
+    """
+    summary 向量 + 简单文本特征
+    """
+    return np.concatenate([
+        np.asarray(event_block.embedding_1536D, dtype=np.float32),
+        np.asarray(text_features(event_block.raw_summary or event_block.summary,
+                                 len(event_block.participant_ids), len(event_block.tags)), dtype=np.float32),
+    ])
+
+
+def load_labeled_docs(export_path: Optional[str] = None, limit: int = 0) -> List[Dict]:
+    """
+    读取LLM打分记录，包括被丢弃的低重要度 block
+    :param export_path: mongoexport 导出的 AI_memory_importance_label jsonl 文件，为空时直接查询 mongo
+    """
+    if export_path:
+        docs = []
+        with open(export_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    docs.append(json.loads(line))
+    else:
+        docs = list(MongoDBClient().find_from_collection(ImportanceLabel_collection, filter={"importance": {"$gt": 0}}))
+    docs = [doc for doc in docs if doc.get("summary") and 1 <= int(doc.get("importance", 0)) <= 10]
+    return docs[:limit] if limit > 0 else docs
+
+
+def build_dataset(docs: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    打分记录不保存向量，通过 EmbeddingCache 批量获取 summary 的向量
+    """
+    embeddings = []
+    for start in range(0, len(docs), ImportanceModel_embedding_batch):
+        batch = docs[start:start + ImportanceModel_embedding_batch]
+        embeddings.extend(EmbeddingCache().get_many([doc["summary"] for doc in batch]))
+    rows = []
+    for doc, embedding in zip(docs, embeddings):
+        features = text_features(doc.get("raw_summary") or doc["summary"],
+                                 doc.get("participant_count", len(doc.get("participant_ids", {}))),
+                                 doc.get("tag_count", len(doc.get("tags", []))))
+        rows.append(np.concatenate([np.asarray(embedding, dtype=np.float32), np.asarray(features, dtype=np.float32)]))
+    labels = np.asarray([int(doc["importance"]) for doc in docs], dtype=np.float32)
+    return np.vstack(rows), labels
+
+
+def split_holdout(count: int, holdout: float, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    训练和评估使用相同的切分，相同的 seed 和比例得到相同的留出集
+    :return: 训练集下标、留出集下标
+    """
+    order = np.random.default_rng(seed).permutation(count)
+    holdout_count = int(count * holdout)
+    return order[holdout_count:], order[:holdout_count]
+
+
+def predict_values(model: Dict[str, np.ndarray], x: np.ndarray) -> np.ndarray:
+    return ((x - model["mean"]) / model["scale"]) @ model["weights"] + model["bias"]
+
+
+def fit_ridge(x: np.ndarray, y: np.ndarray, alpha: float = ImportanceModel_ridge_alpha) -> Dict[str, np.ndarray]:
+    mean = x.mean(axis=0)
+    scale = x.std(axis=0)
+    scale[scale == 0] = 1.0
+    xs = (x - mean) / scale
+    bias = float(y.mean())
+    weights = np.linalg.solve(xs.T @ xs + alpha * np.eye(xs.shape[1]), xs.T @ (y - bias))
+    # 训练集上的残差偏小，有留出集时由 calibrate 替换
+    residual = y - (xs @ weights + bias)
+    return {
+        "weights": weights.astype(np.float32),
+        "bias": np.float32(bias),
+        "mean": mean.astype(np.float32),
+        "scale": scale.astype(np.float32),
+        "residual_std": np.float32(residual.std()),
+    }
+
+
+def calibrate(model: Dict[str, np.ndarray], x: np.ndarray, y: np.ndarray):
+    """
+    用留出集的残差标准差作为预测的不确定度
+    """
+    model["residual_std"] = np.float32((y - predict_values(model, x)).std())
+
+
+def save_model(model: Dict[str, np.ndarray], path: str = ImportanceModel_path):
+    np.savez(path, **model)
+
+
+def evaluate(predictions: np.ndarray, confident: np.ndarray, labels: np.ndarray) -> Dict[str, float]:
+    """
+    与LLM打分的一致程度，confident_* 只统计本地模型有把握、不会回退到LLM的部分
+    """
+    rounded = np.clip(np.rint(predictions), 1, 10)
+
+    def _agreement(mask: np.ndarray) -> Dict[str, float]:
+        if mask.sum() == 0:
+            return {"count": 0}
+        return {
+            "count": int(mask.sum()),
+            "mae": float(np.abs(predictions[mask] - labels[mask]).mean()),
+            "exact": float((rounded[mask] == labels[mask]).mean()),
+            "within_1": float((np.abs(rounded[mask] - labels[mask]) <= 1).mean()),
+            "save_decision": float(((rounded[mask] > 3) == (labels[mask] > 3)).mean()),
+        }
+
+    all_mask = np.ones(len(labels), dtype=bool)
+    low_mask = labels <= 3
+    return {
+        "coverage": float(confident.mean()) if len(confident) else 0.0,
+        "all": _agreement(all_mask),
+        "confident": _agreement(confident),
+        # 低重要度(本该丢弃)的 block: 有把握地预测为需要保存的比例，这部分会跳过LLM被错误保存
+        "low_importance": _agreement(low_mask),
+        "low_importance_confident_saved": float((confident & low_mask & (rounded > 3)).sum() / low_mask.sum())
+        if low_mask.sum() > 0 else 0.0,
+    }
+
+
+class ImportanceScorer:
+    """
+    运行时的本地重要度打分，权重由 importance_trainer 训练并保存为 npz 文件
+    模型文件不存在或预测没有把握时返回 None，调用方回退到LLM
+    """
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        if not hasattr(self, "_ready"):
+            ImportanceScorer._ready = True
+            self.model: Optional[Dict[str, np.ndarray]] = None
+            self.reload(ImportanceModel_path)
+
+    def reload(self, path: str):
+        if not os.path.exists(path):
+            logger.info(f"importance model not found: {path}, use LLM only")
+            self.model = None
+            return
+        with np.load(path) as data:
+            self.model = {key: data[key] for key in data.files}
+        logger.info(f"importance model loaded: {path}, residual std: {float(self.model['residual_std']):.3f}")
+
+    def predict(self, features: np.ndarray) -> Tuple[float, bool]:
+        """
+        :return: 预测的重要度(未取整)，以及是否有把握
+        """
+        model = self.model
+        value = float(predict_values(model, features))
+        confident = abs(value - ImportanceModel_save_line) >= ImportanceModel_confidence_z * float(model["residual_std"])
+        return value, confident
+
+    def score(self, event_block: EventBlock) -> Optional[int]:
+        if self.model is None or len(event_block.embedding_1536D) == 0:
+            return None
+        features = block_features(event_block)
+        if features.shape[0] != self.model["mean"].shape[0]:
+            return None
+        value, confident = self.predict(features)
+        if not confident:
+            return None
+        return int(np.clip(np.rint(value), 1, 10))
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(ImportanceScorer, "_instance"):
+            with ImportanceScorer._instance_lock:
+                if not hasattr(ImportanceScorer, "_instance"):
+                    ImportanceScorer._instance = object.__new__(cls)
+        return ImportanceScorer._instance
+
+
+def predict_many(scorer: ImportanceScorer, x: Iterable[np.ndarray]) -> Tuple[np.ndarray, np.ndarray, float]:
+    """
+    :return: 预测值、是否有把握、单条打分的平均耗时(微秒)
+    """
+    predictions, confident = [], []
+    start = time.perf_counter()
+    for row in x:
+        value, ok = scorer.predict(row)
+        predictions.append(value)
+        confident.append(ok)
+    cost = time.perf_counter() - start
+    count = max(len(predictions), 1)
+    return np.asarray(predictions), np.asarray(confident, dtype=bool), cost / count * 1e6
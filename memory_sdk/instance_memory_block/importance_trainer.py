@@ -0,0 +1,52 @@
+"""
+离线训练本地重要度模型(ridge 回归，summary 向量 + 简单文本特征)，标签是 AI_memory_importance_label 中LLM给出的 importance
+留出集的残差标准差写入模型，作为运行时判断是否有把握的依据
+
+用法:
+python -m memory_sdk.instance_memory_block.importance_trainer --export blocks.jsonl --output importance_model.npz
+不指定 --export 时直接查询 mongo 的 AI_memory_importance_label
+"""
+import argparse
+import json
+
+from memory_sdk.instance_memory_block.importance_model import ImportanceModel_path, ImportanceModel_ridge_alpha, \
+    ImportanceScorer, build_dataset, calibrate, evaluate, fit_ridge, load_labeled_docs, predict_many, save_model, \
+    split_holdout
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export", type=str, default=None, help="mongoexport 导出的 jsonl 文件")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--output", type=str, default=ImportanceModel_path)
+    parser.add_argument("--alpha", type=float, default=ImportanceModel_ridge_alpha)
+    parser.add_argument("--holdout", type=float, default=0.2, help="留出做评估的比例")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    docs = load_labeled_docs(args.export, args.limit)
+    if len(docs) < 10:
+        raise Exception(f"too few labeled blocks: {len(docs)}")
+    x, y = build_dataset(docs)
+    train_idx, test_idx = split_holdout(len(y), args.holdout, args.seed)
+    if (y[train_idx] <= 3).sum() == 0:
+        print("warning: no low importance labels in the training set, the model can not learn to discard blocks")
+
+    model = fit_ridge(x[train_idx], y[train_idx], args.alpha)
+    if len(test_idx) > 0:
+        calibrate(model, x[test_idx], y[test_idx])
+    save_model(model, args.output)
+    print(f"trained on {len(train_idx)} blocks, residual std: {float(model['residual_std']):.3f}, "
+          f"model saved to {args.output}")
+
+    if len(test_idx) > 0:
+        scorer = ImportanceScorer()
+        scorer.reload(args.output)
+        predictions, confident, cost_us = predict_many(scorer, x[test_idx])
+        report = evaluate(predictions, confident, y[test_idx])
+        report["score_latency_us"] = cost_us
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,28 @@
 import csv
+import gzip
+import json
+import queue
+import threading
 import time
 from datetime import datetime
-from typing import List, Dict
+from typing import Dict, Iterator, List, Optional
 
 from common_py.client.azure_mongo import MongoDBClient
-from common_py.model.chat import ConversationEvent
 from pydantic import BaseModel
 
-from memory_sdk.instance_memory_block.event_block import EventBlock, from_mongo_res_to_event_block
+# 流式导出只读取需要的字段，不构造 EventBlock
+Export_projection = {
+    'name': 1, 'AID': 1, 'create_timestamp': 1,
+    'origin_event.event_source': 1, 'origin_event.role': 1, 'origin_event.speaker': 1,
+    'origin_event.speaker_name': 1, 'origin_event.message': 1, 'origin_event.occur_time': 1,
+}
+Export_batch_size = 500
+# 每个分区预读的 block 数上限，导出时内存占用与结果总量无关
+Export_partition_queue_size = 1000
+# mongo 客户端没有暴露游标时，按时间窗口分页读取，每页在内存中排序
+Export_fallback_window_seconds = 6 * 60 * 60
+Export_format_csv = 'csv'
+Export_format_jsonl = 'jsonl'
 
 
 class QueryOption(BaseModel):
@@ -92,48 +107,158 @@ def _generate_query_filter_by_query_option(query_option: QueryOption):
     return query_filter
 
 
-def _save_to_csv(file_name: str, block_lst: list):
-    # AI_dict: Dict = {}
-    # for block in block_lst:
-    #     if block.AID not in AI_dict:
-    #         AI_dict[block.AID] = []
-    #     AI_dict[block.AID].append(block)
-    # for AID, block_lst in AI_dict.items():
-    #     AI_dict[AID] = sorted(block_lst, key=lambda x: x.create_timestamp, reverse=True)
-    block_lst = sorted(block_lst, key=lambda x: x.create_timestamp)
-
-    # last_time_lst = []
-    # for AID, block_lst in AI_dict.items():
-    #     for block in block_lst:
-    #         last_time = int(block.origin_event[-1].occur_time) - int(block.origin_event[0].occur_time)
-    #         last_time_lst.append(last_time)
-    # print(last_time_lst)
-
-    # save as csv
-    with open(f'{file_name}.csv', 'w', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(['AID', 'role: speaker', 'message', 'occur time'])
-        for block in block_lst:
-            AID = ''
-            for event in block.origin_event:
-                if isinstance(event, ConversationEvent):
-                    if event.role == 'AI' and AID == '':
-                        AID = event.speaker
-                    formatted_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(event.occur_time)))
-                    writer.writerow([AID, f"{event.role}: {event.speaker_name}", event.message, formatted_time])
-            writer.writerow(['', '', ''])
+def query_conversation_history(file_name: str, query_option: QueryOption, limit: int = None):
+    export_conversation_history(file_name, query_option, limit=limit)
 
 
-def query_conversation_history(file_name: str, query_option: QueryOption, limit: int = None):
+def export_conversation_history(file_name: str, query_option: QueryOption, fmt: str = Export_format_csv,
+                                gzip_output: bool = False, partitions: int = 1, batch_size: int = Export_batch_size,
+                                limit: int = None) -> str:
+    """
+    流式导出对话记录: mongo 游标按 create_timestamp 在服务端排序，逐个 block 转成行写入 csv / jsonl
+    :param partitions: 时间范围切分的分区数，各分区并行读取，按时间顺序写出；需要同时指定开始和结束时间
+    :return: 导出的文件名
+    """
+    path = f"{file_name}.{fmt}" + ('.gz' if gzip_output else '')
+    opener = gzip.open if gzip_output else open
+    mongodb_client = MongoDBClient(DB_NAME='unichat-backend')
+    blocks = _iter_blocks(mongodb_client, query_option, partitions, batch_size, limit)
+    with opener(path, 'wt', encoding='utf-8', newline='') as f:
+        if fmt == Export_format_jsonl:
+            for row in _iter_rows(blocks):
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        else:
+            writer = csv.writer(f)
+            writer.writerow(['AID', 'role: speaker', 'message', 'occur time'])
+            last_block = None
+            for row in _iter_rows(blocks):
+                if last_block is not None and row['block'] != last_block:
+                    writer.writerow(['', '', ''])
+                last_block = row['block']
+                writer.writerow([row['AID'], f"{row['role']}: {row['speaker_name']}", row['message'], row['occur_time']])
+            if last_block is not None:
+                writer.writerow(['', '', ''])
+    return path
+
+
+def _iter_rows(blocks: Iterator[Dict]) -> Iterator[Dict]:
+    """
+    一个 block 展开成多行，只导出对话事件，AID 取 block 中第一个 AI 发言者，与之前的 csv 一致
+    """
+    for block in blocks:
+        AID = ''
+        for event in block.get('origin_event', []):
+            if event.get('event_source', '') != 'conversation':
+                continue
+            if event.get('role', '') == 'AI' and AID == '':
+                AID = event.get('speaker', '')
+            yield {
+                'block': block.get('name', ''),
+                'AID': AID,
+                'role': event.get('role', ''),
+                'speaker_name': event.get('speaker_name', ''),
+                'message': event.get('message', ''),
+                'occur_time': time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(float(event.get('occur_time', 0)))),
+            }
+
+
+def _iter_blocks(mongodb_client: MongoDBClient, query_option: QueryOption, partitions: int, batch_size: int,
+                 limit: Optional[int]) -> Iterator[Dict]:
+    ranges = _split_time_range(query_option, partitions)
+    stop = threading.Event()
+    queues: List[queue.Queue] = []
+    for start_time, end_time in ranges:
+        partition_option = query_option.copy(update={'start_time': start_time, 'end_time': end_time})
+        partition_queue = queue.Queue(maxsize=Export_partition_queue_size)
+        queues.append(partition_queue)
+        threading.Thread(target=_produce_partition, daemon=True,
+                         args=(mongodb_client, partition_option, batch_size, limit, partition_queue, stop)).start()
+    count = 0
+    try:
+        # 分区按时间先后排列，依次消费即可保持全局有序，后面的分区在有界队列中预读
+        for partition_queue in queues:
+            while True:
+                item = partition_queue.get()
+                if item is _partition_end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                count += 1
+                if limit and count >= limit:
+                    return
+    finally:
+        stop.set()
+
+
+_partition_end = object()
+
+
+def _produce_partition(mongodb_client: MongoDBClient, query_option: QueryOption, batch_size: int,
+                       limit: Optional[int], partition_queue: queue.Queue, stop: threading.Event):
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                partition_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for block in _find_sorted(mongodb_client, query_option, batch_size, limit):
+            if not _put(block):
+                return
+    except Exception as e:
+        _put(e)
+        return
+    _put(_partition_end)
+
+
+def _find_sorted(mongodb_client: MongoDBClient, query_option: QueryOption, batch_size: int,
+                 limit: Optional[int]) -> Iterator[Dict]:
     mongo_filter = _generate_query_filter_by_query_option(query_option)
+    db = getattr(mongodb_client, 'db', None)
+    if db is not None:
+        # 客户端暴露 pymongo database 时使用游标，服务端排序，按 batch_size 分批拉取
+        cursor = db['AI_memory_block'].find(mongo_filter, Export_projection, batch_size=batch_size) \
+            .sort('create_timestamp', 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        yield from cursor
+        return
+    if not query_option.start_time or not query_option.end_time:
+        res = mongodb_client.find_from_collection('AI_memory_block', filter=mongo_filter,
+                                                  projection=Export_projection, limit=limit)
+        yield from sorted(res, key=lambda x: x.get('create_timestamp', 0))
+        return
+    # 按时间窗口分页，每页单独查询和排序，内存只保留一个窗口的数据
+    window_start = query_option.start_time
+    while window_start <= query_option.end_time:
+        window_end = min(window_start + Export_fallback_window_seconds - 1, query_option.end_time)
+        window_option = query_option.copy(update={'start_time': window_start, 'end_time': window_end})
+        res = mongodb_client.find_from_collection('AI_memory_block',
+                                                  filter=_generate_query_filter_by_query_option(window_option),
+                                                  projection=Export_projection, limit=limit)
+        yield from sorted(res, key=lambda x: x.get('create_timestamp', 0))
+        window_start = window_end + 1
 
-    mongodb_client = MongoDBClient(DB_NAME='unichat-backend')
-    block_lst: List[EventBlock] = []
-    res = mongodb_client.find_from_collection('AI_memory_block', filter=mongo_filter, limit=limit)
-    for item in res:
-        block_lst.append(from_mongo_res_to_event_block(item))
-    # sort by create_timestamp
-    _save_to_csv(file_name, block_lst)
+
+def _split_time_range(query_option: QueryOption, partitions: int) -> List[tuple]:
+    """
+    把 [start_time, end_time] 切成连续不重叠的分区，没有完整时间范围时不切分
+    """
+    if partitions <= 1 or not query_option.start_time or not query_option.end_time:
+        return [(query_option.start_time, query_option.end_time)]
+    total = query_option.end_time - query_option.start_time + 1
+    step = max(1, (total + partitions - 1) // partitions)
+    ranges = []
+    start_time = query_option.start_time
+    while start_time <= query_option.end_time:
+        end_time = min(start_time + step - 1, query_option.end_time)
+        ranges.append((start_time, end_time))
+        start_time = end_time + 1
+    return ranges
 
 
 if __name__ == '__main__':
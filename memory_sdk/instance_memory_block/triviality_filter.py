@@ -0,0 +1,136 @@
+import json
+import logging
+import re
+from typing import Dict, Iterable, List, Optional, Set
+
+from common_py.model.base import BaseEvent
+from common_py.model.chat import ConversationEvent
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+TrivialityFilter_enabled = True
+TrivialityFilter_min_messages = 4  # 少于这个消息数的片段认为是闲聊
+TrivialityFilter_min_tokens = 30
+TrivialityFilter_min_lexical_diversity = 0.3  # 窗口内不同词数 / 窗口词数 的滑动平均(MATTR)
+TrivialityFilter_diversity_window = 50  # MATTR 的窗口大小，原始的不同词数 / 总词数随长度增加而下降，长片段会被误判
+TrivialityFilter_max_greeting_ratio = 0.6  # 寒暄消息占比超过这个值认为是闲聊
+
+# 只由这些词组成的消息视为寒暄
+TrivialityFilter_greeting_lexicon: Set[str] = {
+    "hi", "hello", "hey", "yo", "morning", "good", "night", "evening", "afternoon", "bye", "goodbye", "see", "you",
+    "later", "thanks", "thank", "thx", "ok", "okay", "k", "sure", "yes", "yeah", "yep", "no", "nope", "lol", "haha",
+    "hmm", "cool", "nice", "great", "how", "are", "r", "u", "doing", "what's", "up", "sup", "fine", "i'm", "im",
+    "and", "too", "well", "bro", "dear",
+    "你好", "您好", "嗨", "哈喽", "早", "早上好", "晚上好", "晚安", "再见", "拜拜", "谢谢", "好的", "嗯", "哦", "哈",
+    "哈哈", "哈哈哈", "是的", "对", "好", "在吗", "在", "吃了吗",
+}
+# 出现这些词的片段一定交给LLM总结，比如生日、家人、约定等值得记住的内容
+TrivialityFilter_keyword_lexicon: Set[str] = {
+    "remember", "birthday", "anniversary", "promise", "family", "mother", "father", "mom", "dad", "wife", "husband",
+    "girlfriend", "boyfriend", "job", "interview", "exam", "sick", "hospital", "died", "married", "divorce", "moved",
+    "pregnant", "favorite", "hate", "secret",
+    "记得", "记住", "生日", "纪念日", "答应", "家人", "妈妈", "爸爸", "老婆", "老公", "女朋友", "男朋友", "工作", "面试",
+    "考试", "生病", "医院", "去世", "结婚", "离婚", "搬家", "怀孕", "最喜欢", "讨厌", "秘密",
+}
+
+# 拉丁字符按单词切分，中日韩字符逐字计数
+_token_pattern = re.compile(r"[a-zA-Z0-9']+|[⺀-鿿가-힯]")
+_latin_pattern = re.compile(r"[a-z0-9']+")
+
+TrivialityDecision_keep = "keep"
+TrivialityDecision_defer = "defer"  # 暂存，和下一个片段合并后再判断
+TrivialityDecision_skip = "skip"
+
+
+def count_keyword_hits(lowered: str, keyword_lexicon: Iterable[str]) -> int:
+    """
+    拉丁字母的关键词按整词匹配(避免 whatever 命中 hate、moment 命中 mom)，中文关键词按子串匹配
+    """
+    words = set(_latin_pattern.findall(lowered))
+    return sum(1 for keyword in keyword_lexicon
+               if (keyword in words if _latin_pattern.fullmatch(keyword) else keyword in lowered))
+
+
+def lexical_diversity(tokens: List[str], window: int = TrivialityFilter_diversity_window) -> float:
+    """
+    滑动窗口的 type-token ratio (MATTR)，不随片段长度变化；短于窗口时等于原始比例
+    """
+    if len(tokens) == 0:
+        return 0.0
+    if len(tokens) <= window:
+        return len(set(tokens)) / len(tokens)
+    counts: Dict[str, int] = {}
+    for token in tokens[:window]:
+        counts[token] = counts.get(token, 0) + 1
+    total = len(counts)
+    for i in range(window, len(tokens)):
+        counts[tokens[i]] = counts.get(tokens[i], 0) + 1
+        removed = tokens[i - window]
+        counts[removed] -= 1
+        if counts[removed] == 0:
+            del counts[removed]
+        total += len(counts)
+    return total / (len(tokens) - window + 1) / window
+
+
+class TrivialityFilter:
+    """
+    在调用LLM总结之前，用本地特征预测一个对话片段的重要度是否会 <= 3(不会被保存)
+    特征: 消息数、token数、词汇多样性、寒暄消息占比、关键词命中数
+    """
+
+    def __init__(self, greeting_lexicon: Optional[Iterable[str]] = None,
+                 keyword_lexicon: Optional[Iterable[str]] = None):
+        self.greeting_lexicon: Set[str] = set(
+            greeting_lexicon if greeting_lexicon is not None else TrivialityFilter_greeting_lexicon)
+        self.keyword_lexicon: Set[str] = set(
+            keyword_lexicon if keyword_lexicon is not None else TrivialityFilter_keyword_lexicon)
+
+    def extract_features(self, event_slice: List[BaseEvent]) -> Dict[str, float]:
+        messages = [event.message.strip() for event in event_slice
+                    if isinstance(event, ConversationEvent) and event.message and event.message.strip()]
+        tokens: List[str] = []
+        greeting_count = 0
+        keyword_hits = 0
+        for message in messages:
+            lowered = message.lower()
+            message_tokens = _token_pattern.findall(lowered)
+            tokens.extend(message_tokens)
+            if lowered.strip(" !?.,~。！？，～") in self.greeting_lexicon or \
+                    (len(message_tokens) > 0 and all(token in self.greeting_lexicon for token in message_tokens)):
+                greeting_count += 1
+            keyword_hits += count_keyword_hits(lowered, self.keyword_lexicon)
+        return {
+            "message_count": len(messages),
+            "token_count": len(tokens),
+            "lexical_diversity": round(lexical_diversity(tokens), 3),
+            "greeting_ratio": round(greeting_count / len(messages), 3) if messages else 1.0,
+            "keyword_hits": keyword_hits,
+        }
+
+    def is_trivial(self, features: Dict[str, float]) -> bool:
+        if features["keyword_hits"] > 0:
+            return False
+        return features["message_count"] < TrivialityFilter_min_messages \
+            or features["token_count"] < TrivialityFilter_min_tokens \
+            or features["lexical_diversity"] < TrivialityFilter_min_lexical_diversity \
+            or features["greeting_ratio"] > TrivialityFilter_max_greeting_ratio
+
+    def decide(self, AID: str, event_slice: List[BaseEvent], has_deferred: bool) -> str:
+        """
+        :param has_deferred: event_slice 是否已经包含了之前暂存的片段，已经合并过一次仍然是闲聊则直接丢弃
+        """
+        features = self.extract_features(event_slice)
+        if not self.is_trivial(features):
+            decision = TrivialityDecision_keep
+        elif has_deferred:
+            decision = TrivialityDecision_skip
+        else:
+            decision = TrivialityDecision_defer
+        logger.info(f"triviality filter AID: {AID}, decision: {decision}, features: {json.dumps(features)}")
+        return decision
@@ -9,6 +9,7 @@ from common_py.model.scene.const import SceneEventName_IntimacyLevelUp
 from common_py.model.scene.event_report import report_scene_event
 from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
 from memory_sdk.hippocampus import HippocampusMgr
+from memory_sdk.journal import MemoryJournal, JournalKind_intimacy_chat_time, JournalKind_intimacy_ticket
 from memory_sdk.intimacy_sdk.intimacy_ticket import IntimacyBase, IntimacyTicketChatTime
 from memory_sdk.memory_entity import UserMemoryEntity
 
@@ -52,8 +53,28 @@ class IntimacyMgr:
             self.mongo_db = MongoDBClient()
             self.intimacy_stash: Dict[str, List[IntimacyBase]] = {}
             self.uuid_map: Dict[str, List[IntimacyTicketChatTime]] = {}  # 有些亲密度单据需要合并，比如聊天时长，需要根据UUID进行合并
+            # 暂存单据对应的本地日志记录，写入成功后 ack
+            self.uuid_journal_ids: Dict[str, List[int]] = {}
+            self.intimacy_journal_ids: Dict[str, List[int]] = {}
+            self._recover_journal()
+
+    @staticmethod
+    def _recover_journal():
+        """
+        服务启动时重放上次进程退出前没有写入远端的本地日志，日志未开启时直接返回
+        journal_recovery 依赖 IntimacyMgr，这里延迟导入
+        """
+        if not MemoryJournal().enabled:
+            return
+        try:
+            from memory_sdk.journal_recovery import recover_memory_journal
+            recover_memory_journal()
+        except Exception as e:
+            logger.error(f"recover memory journal error: {e}")
 
     def add_chat_time_intimacy(self, intimacy_ticket: IntimacyTicketChatTime):
+        journal_id = MemoryJournal().append(JournalKind_intimacy_chat_time, intimacy_ticket.dict())
+        self.uuid_journal_ids.setdefault(intimacy_ticket.UUID, []).append(journal_id)
         if intimacy_ticket.UUID not in self.uuid_map:  # 两个AI互相对话的时候这个逻辑会有一些问题，短期没有AI对话的需求，先不考虑
             self.uuid_map[intimacy_ticket.UUID] = [intimacy_ticket]
         else:
@@ -127,6 +148,8 @@ class IntimacyMgr:
 
     def _add_in_stash(self, intimacy_ticket: IntimacyBase):
         intimacy_key = _assemble_key(intimacy_ticket)
+        journal_id = MemoryJournal().append(JournalKind_intimacy_ticket, intimacy_ticket.dict())
+        self.intimacy_journal_ids.setdefault(intimacy_key, []).append(journal_id)
         if intimacy_key not in self.intimacy_stash:
             self.intimacy_stash[intimacy_key] = [intimacy_ticket]
         else:
@@ -218,10 +241,14 @@ class IntimacyMgr:
                 self._add_in_stash(AI_intimacy_ticket)
         for uuid in combined_uuid_lst:
             del self.uuid_map[uuid]
+            # 原始单据已经合并进 intimacy_stash 并重新记录
+            MemoryJournal().ack(*self.uuid_journal_ids.pop(uuid, []))
 
     def _on_save(self):
         new_dict = deepcopy(self.intimacy_stash)
         self.intimacy_stash = {}
+        journal_ids = self.intimacy_journal_ids
+        self.intimacy_journal_ids = {}
         for intimacy_key, intimacy_ticket_list in new_dict.items():
             source_id = intimacy_ticket_list[0].source_id
             target_id = intimacy_ticket_list[0].target_id
@@ -230,7 +257,9 @@ class IntimacyMgr:
             # 这里也只处理了AI对人的亲密度，对target_id是uid做了假设
             mem_entity = HippocampusMgr().get_hippocampus(source_id).load_memory_of_user(target_id)
             if mem_entity is None:
-                # 防止exception，日志里面打过了
+                # 防止exception，日志里面打过了；记忆加载不到时重放也无法处理，ack 掉避免每次重启都重放
+                logger.warning(f"drop intimacy tickets without memory entity, key: {intimacy_key}")
+                MemoryJournal().ack(*journal_ids.get(intimacy_key, []))
                 continue
             current_intimacy_point = mem_entity.add_intimacy_point(add_value)
 
@@ -248,6 +277,7 @@ class IntimacyMgr:
 
             logger.debug(
                 f'create AI_intimacy_record ids: {[str(id) for id in ids]} current intimacy point: {current_intimacy_point}')
+            MemoryJournal().ack(*journal_ids.get(intimacy_key, []))
 
     def _check_and_update_intimacy(self, source_id: str, target_id: str, need_upgrade: bool, channel_name: str):
         mem_entity = HippocampusMgr().get_hippocampus(source_id).load_memory_of_user(target_id, need_upgrade)
@@ -0,0 +1,272 @@
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Set, Tuple
+
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+# 默认关闭。开启时同一台机器上的每个worker必须配置不同的目录，目录被其他进程占用时日志自动关闭
+MemoryJournal_dir = os.environ.get("MEMORY_JOURNAL_DIR", "./memory_journal")
+MemoryJournal_enabled = os.environ.get("MEMORY_JOURNAL_ENABLED", "false").lower() == "true"
+MemoryJournal_segment_size = 16 * 1024 * 1024
+MemoryJournal_fsync_interval = 0.005  # 攒批 fsync 的等待时长，单位秒
+
+# 帧格式: 4字节长度 + 4字节 crc32 + json payload
+_frame_header = struct.Struct(">II")
+_segment_suffix = ".wal"
+_lock_file = "LOCK"
+
+JournalKind_memory_block = "memory_block"
+JournalKind_memory_stash = "memory_stash"
+JournalKind_intimacy_chat_time = "intimacy_chat_time"
+JournalKind_intimacy_ticket = "intimacy_ticket"
+JournalKind_long_term_block = "long_term_block"
+JournalKind_deferred_slice = "deferred_slice"
+
+
+class MemoryJournal:
+    """
+    本地追加写日志，内存中暂存的待写数据先写入这里并 fsync，之后才返回给调用方
+    远端(mongo/redis)写入成功后调用 ack，确认记录写在当前分段，可能指向更早分段中的数据记录
+    因此只从最老的一端删除分段: 该分段以及所有更早的分段中的记录都已 ack 时才删除，
+    被删除分段中的确认记录只会指向同样已被删除的分段
+    进程重启后通过 replay 把没有 ack 的记录重新交给正常的保存路径，语义为至少一次
+
+    记录 payload:
+    - 数据记录 {"i": 记录id, "k": 类型, "d": 数据}
+    - 确认记录 {"a": 记录id}
+    """
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        if not hasattr(self, "_ready"):
+            MemoryJournal._ready = True
+            self.enabled = MemoryJournal_enabled
+            self._lock = threading.Lock()
+            self._cond = threading.Condition(self._lock)
+            self._segment_pending: Dict[int, Set[int]] = {}
+            # 磁盘上存在的分段，按编号升序
+            self._segments: List[int] = []
+            self._record_segment: Dict[int, int] = {}
+            self._recovered: Dict[int, Tuple[str, Dict]] = {}
+            self._next_id = 0
+            # 帧的写入序号，确认记录也需要落盘
+            self._written_seq = 0
+            self._durable_seq = 0
+            self._active_no = 0
+            self._active_size = 0
+            self._file = None
+            if not self.enabled:
+                return
+            os.makedirs(MemoryJournal_dir, exist_ok=True)
+            if not self._lock_dir():
+                self.enabled = False
+                return
+            self._load_segments()
+            self._open_segment(self._active_no)
+            threading.Thread(target=self._sync_loop, daemon=True).start()
+
+    def append(self, kind: str, data: Dict) -> int:
+        """
+        写入一条数据记录并等待落盘
+        :return: 记录id，日志未开启时返回 -1
+        """
+        if not self.enabled:
+            return -1
+        with self._lock:
+            record_id = self._next_id
+            self._next_id += 1
+            self._write_frame({"i": record_id, "k": kind, "d": data})
+            self._segment_pending.setdefault(self._active_no, set()).add(record_id)
+            self._record_segment[record_id] = self._active_no
+            seq = self._written_seq
+            self._cond.notify_all()
+            while self._durable_seq < seq:
+                self._cond.wait()
+        return record_id
+
+    def ack(self, *record_ids: int):
+        """
+        远端写入成功，确认记录不需要再重放
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            for record_id in record_ids:
+                if record_id is None or record_id < 0:
+                    continue
+                segment_no = self._record_segment.pop(record_id, None)
+                self._recovered.pop(record_id, None)
+                if segment_no is None:
+                    continue
+                self._write_frame({"a": record_id})
+                self._segment_pending.get(segment_no, set()).discard(record_id)
+            self._truncate_head()
+            self._cond.notify_all()
+
+    def replay(self, handlers: Dict[str, Callable[[Dict], None]]):
+        """
+        把上次进程退出前没有 ack 的记录按写入顺序交给对应的 handler，handler 成功执行后 ack
+        handler 内部通常会重新走正常的保存路径(并重新写入日志)
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            records = sorted(self._recovered.items())
+        logger.info(f"memory journal replay {len(records)} records")
+        for record_id, (kind, data) in records:
+            handler = handlers.get(kind, None)
+            if handler is None:
+                logger.warning(f"memory journal has no replay handler for kind: {kind}")
+                continue
+            try:
+                handler(data)
+                self.ack(record_id)
+            except Exception as e:
+                logger.error(f"memory journal replay record {record_id} error: {e}")
+
+    def pending_count(self) -> int:
+        return len(self._record_segment)
+
+    def _write_frame(self, record: Dict):
+        payload = json.dumps(record, ensure_ascii=False).encode("utf-8")
+        frame = _frame_header.pack(len(payload), zlib.crc32(payload)) + payload
+        if self._active_size + len(frame) > MemoryJournal_segment_size and self._active_size > 0:
+            self._roll_segment()
+        self._file.write(frame)
+        self._active_size += len(frame)
+        self._written_seq += 1
+
+    def _sync_loop(self):
+        while True:
+            try:
+                with self._cond:
+                    while self._durable_seq >= self._written_seq:
+                        self._cond.wait()
+                # 等一小段时间，让并发的写入共用一次 fsync
+                time.sleep(MemoryJournal_fsync_interval)
+                with self._cond:
+                    target = self._written_seq
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+                    self._durable_seq = target
+                    self._cond.notify_all()
+            except Exception as e:
+                logger.exception(e)
+                time.sleep(1)
+
+    def _roll_segment(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._open_segment(self._active_no + 1)
+        self._truncate_head()
+
+    def _truncate_head(self):
+        """
+        从最老的分段开始删除已经全部 ack 的分段，遇到还有未 ack 记录的分段就停止，当前分段不删除
+        """
+        while len(self._segments) > 0 and self._segments[0] != self._active_no \
+                and len(self._segment_pending.get(self._segments[0], set())) == 0:
+            self._remove_segment(self._segments[0])
+
+    def _open_segment(self, segment_no: int):
+        self._active_no = segment_no
+        if segment_no not in self._segments:
+            self._segments.append(segment_no)
+        self._file = open(_segment_path(segment_no), "ab")
+        self._active_size = self._file.tell()
+
+    def _remove_segment(self, segment_no: int):
+        self._segment_pending.pop(segment_no, None)
+        if segment_no in self._segments:
+            self._segments.remove(segment_no)
+        try:
+            os.remove(_segment_path(segment_no))
+        except FileNotFoundError:
+            pass
+
+    def _lock_dir(self) -> bool:
+        """
+        独占日志目录，避免同一台机器上的多个进程写入同一组分段文件
+        """
+        self._lock_handle = open(os.path.join(MemoryJournal_dir, _lock_file), "w")
+        try:
+            fcntl.flock(self._lock_handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            logger.error(f"memory journal dir {MemoryJournal_dir} is used by another process, journal disabled")
+            self._lock_handle.close()
+            return False
+
+    def _load_segments(self):
+        segment_no_lst = sorted(
+            int(file_name[:-len(_segment_suffix)]) for file_name in os.listdir(MemoryJournal_dir)
+            if file_name.endswith(_segment_suffix) and file_name[:-len(_segment_suffix)].isdigit()
+        )
+        self._segments = list(segment_no_lst)
+        acked: Set[int] = set()
+        for segment_no in segment_no_lst:
+            for record in _read_segment(segment_no):
+                if "a" in record:
+                    acked.add(record["a"])
+                    self._next_id = max(self._next_id, record["a"] + 1)
+                    continue
+                record_id = record["i"]
+                self._recovered[record_id] = (record["k"], record["d"])
+                self._record_segment[record_id] = segment_no
+                self._segment_pending.setdefault(segment_no, set()).add(record_id)
+                self._next_id = max(self._next_id, record_id + 1)
+            self._active_no = segment_no + 1
+        for record_id in acked:
+            self._recovered.pop(record_id, None)
+            segment_no = self._record_segment.pop(record_id, None)
+            if segment_no is not None:
+                self._segment_pending[segment_no].discard(record_id)
+        self._truncate_head()
+        if len(self._recovered) > 0:
+            logger.warning(f"memory journal found {len(self._recovered)} records not acknowledged")
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(MemoryJournal, "_instance"):
+            with MemoryJournal._instance_lock:
+                if not hasattr(MemoryJournal, "_instance"):
+                    MemoryJournal._instance = object.__new__(cls)
+        return MemoryJournal._instance
+
+
+def _segment_path(segment_no: int) -> str:
+    return os.path.join(MemoryJournal_dir, f"{segment_no:010d}{_segment_suffix}")
+
+
+def _read_segment(segment_no: int) -> List[Dict]:
+    """
+    读取分段中所有完整的帧，遇到长度或 crc 不匹配的帧(通常是崩溃时写了一半)就停止
+    """
+    records = []
+    with open(_segment_path(segment_no), "rb") as f:
+        content = f.read()
+    offset = 0
+    while offset + _frame_header.size <= len(content):
+        length, crc = _frame_header.unpack_from(content, offset)
+        start = offset + _frame_header.size
+        payload = content[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            logger.warning(f"memory journal segment {segment_no} corrupted at offset {offset}, "
+                           f"ignore the rest {len(content) - offset} bytes")
+            break
+        records.append(json.loads(payload.decode("utf-8")))
+        offset = start + length
+    return records
+
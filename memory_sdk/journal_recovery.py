@@ -0,0 +1,90 @@
+import logging
+from typing import Dict
+
+from common_py.client.azure_mongo import MongoDBClient
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+from memory_sdk.instance_memory_block.block_mgr import BlockManager
+from memory_sdk.instance_memory_block.event_block import EventBlock, from_mongo_res_to_event_block, events_from_dicts
+from memory_sdk.intimacy_sdk.intimacy_mgr import IntimacyMgr
+from memory_sdk.intimacy_sdk.intimacy_ticket import IntimacyBase, IntimacyTicketChatTime
+from memory_sdk.journal import MemoryJournal, JournalKind_memory_block, JournalKind_memory_stash, \
+    JournalKind_intimacy_chat_time, JournalKind_intimacy_ticket, JournalKind_long_term_block, JournalKind_deferred_slice
+from memory_sdk.longterm_memory.long_term_mem_mgr import LongTermMemoryMgr
+from memory_sdk.memory_entity import UserMemoryEntity
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+
+def recover_memory_journal():
+    """
+    由 IntimacyMgr(need_init=True) 在服务启动时调用，重放上次进程退出前没有写入远端的记录
+    重放的数据重新走正常的保存路径，语义为至少一次，mongo 中已经存在的 block 会跳过
+    """
+    MemoryJournal().replay({
+        JournalKind_memory_block: _replay_memory_block,
+        JournalKind_memory_stash: _replay_memory_stash,
+        JournalKind_intimacy_chat_time: _replay_intimacy_chat_time,
+        JournalKind_intimacy_ticket: _replay_intimacy_ticket,
+        JournalKind_long_term_block: _replay_long_term_block,
+        JournalKind_deferred_slice: _replay_deferred_slice,
+    })
+
+
+def _replay_memory_block(data: Dict):
+    AID = data["AID"]
+    event_block = _load_block(data["block"])
+    mongo_client = MongoDBClient()
+    if mongo_client.find_one_from_collection("AI_memory_block", {"name": event_block.name}):
+        return
+    if event_block.importance <= 3:
+        return
+    doc = event_block.dict(exclude={'embedding_1536D', 'tags_embedding_1536D'})
+    mongo_client.create_document("AI_memory_block", [doc], *['AID'])
+    for uid in event_block.participant_ids:
+        LongTermMemoryMgr().update_event_block_for_entity(AID, uid, [event_block])
+
+
+def _replay_memory_stash(data: Dict):
+    entity = UserMemoryEntity(data["AID"], data["target_id"], data["target_type"])
+    entity._element_stash(data["key"], data["value"])
+    entity.save_stash()
+
+
+def _replay_intimacy_chat_time(data: Dict):
+    IntimacyMgr().add_chat_time_intimacy(IntimacyTicketChatTime(**data))
+
+
+def _replay_intimacy_ticket(data: Dict):
+    # 合并后的聊天时长单据也会走到这里
+    if "UUID" in data:
+        IntimacyMgr()._add_in_stash(IntimacyTicketChatTime(**data))
+    else:
+        IntimacyMgr()._add_in_stash(IntimacyBase(**data))
+
+
+def _replay_long_term_block(data: Dict):
+    LongTermMemoryMgr().update_event_block_for_entity(data["AID"], data["target_id"], [_load_block(data["block"])])
+
+
+def _replay_deferred_slice(data: Dict):
+    """
+    暂存的闲聊片段没有等到下一个片段，与销毁时相同，直接总结并保存
+    """
+    block_mgr = BlockManager(data["AID"])
+    block_mgr._deferred_slice = events_from_dicts(data["events"])
+    block_mgr.on_destroy({})
+
+
+def _load_block(block: Dict) -> EventBlock:
+    """
+    与从 mongo 读取 block 相同，按 event_source 还原 origin_event 的具体类型，否则对话内容等字段会丢失
+    长期记忆的日志记录不包含 origin_event
+    """
+    block = dict(block)
+    block.setdefault("origin_event", [])
+    return from_mongo_res_to_event_block(block)
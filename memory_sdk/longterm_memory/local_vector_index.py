@@ -0,0 +1,283 @@
+"""
+长期记忆的本地向量索引，替代每个 (AID, target) 一个 chroma 集合 + 快照上传下载
+每个实体一个目录，向量以 float32 追加写入 vectors.f32，记录(id / meta / documents)追加写入 records.jsonl
+打开时 memmap 向量文件，用 NumPy 计算余弦相似度取 top-k，并支持 create_time 等元数据过滤
+
+query / get 与 chroma 集合保持一致: score 为余弦相似度(1 - cosine distance)，只返回 score >= threshold 的记录
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from common_py.client.chroma import VectorRecordItem
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+from memory_sdk.embedding_cache import EmbeddingCache
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+LocalVectorIndex_dir = os.environ.get("LOCAL_VECTOR_INDEX_DIR", "./long_term_index")
+
+_vectors_file = "vectors.f32"
+_records_file = "records.jsonl"
+_info_file = "index.json"
+
+
+class _Snapshot:
+    """
+    某一时刻索引的只读视图，upsert 之后整体替换，查询不需要加锁
+    """
+
+    def __init__(self, vectors: np.ndarray, records: List[Dict], alive: np.ndarray):
+        self.vectors = vectors
+        self.records = records
+        self.alive = alive
+        self._numeric_columns: Dict[str, np.ndarray] = {}
+        self._raw_columns: Dict[str, np.ndarray] = {}
+
+    def numeric_column(self, field: str) -> np.ndarray:
+        column = self._numeric_columns.get(field, None)
+        if column is None:
+            column = np.full(len(self.records), np.nan)
+            for i, record in enumerate(self.records):
+                value = record["meta"].get(field, None)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    column[i] = value
+            self._numeric_columns[field] = column
+        return column
+
+    def raw_column(self, field: str) -> np.ndarray:
+        column = self._raw_columns.get(field, None)
+        if column is None:
+            column = np.empty(len(self.records), dtype=object)
+            for i, record in enumerate(self.records):
+                column[i] = record["meta"].get(field, None)
+            self._raw_columns[field] = column
+        return column
+
+
+class LocalVectorIndex:
+    """
+    实现 LongTermMemoryEntity 用到的 ChromaCollection 接口: upsert_many / query / get / get_collection_name
+    """
+
+    def __init__(self, name: str, root: str = LocalVectorIndex_dir):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._lock = threading.Lock()
+        self._dim = 0
+        self._snapshot = _Snapshot(np.zeros((0, 0), dtype=np.float32), [], np.zeros(0, dtype=bool))
+        os.makedirs(self.path, exist_ok=True)
+        self._open()
+
+    @staticmethod
+    def exists(name: str, root: str = LocalVectorIndex_dir) -> bool:
+        return os.path.exists(os.path.join(root, name, _records_file))
+
+    def get_collection_name(self) -> str:
+        return self.name
+
+    def count(self) -> int:
+        return int(self._snapshot.alive.sum())
+
+    @staticmethod
+    def remove(name: str, root: str = LocalVectorIndex_dir):
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+    def upsert_many(self, record_lst: List[VectorRecordItem]):
+        if len(record_lst) == 0:
+            return
+        self.upsert_vectors(record_lst, np.asarray(
+            EmbeddingCache().get_many([str(record.documents) for record in record_lst]), dtype=np.float32))
+
+    def upsert_vectors(self, record_lst: List[VectorRecordItem], vectors: np.ndarray):
+        """
+        使用已经计算好的向量写入，不再请求 embedding
+        """
+        if len(record_lst) == 0:
+            return
+        vectors = self._normalize(np.asarray(vectors, dtype=np.float32))
+        with self._lock:
+            if self._dim == 0:
+                self._dim = vectors.shape[1]
+                with open(os.path.join(self.path, _info_file), "w") as f:
+                    json.dump({"dim": self._dim}, f)
+            elif vectors.shape[1] != self._dim:
+                raise Exception(f"embedding dimension mismatch: {vectors.shape[1]} != {self._dim}")
+            # 先写向量再写记录，崩溃时最多多出没有记录的向量，打开时截断到与记录对齐
+            with open(os.path.join(self.path, _vectors_file), "ab") as f:
+                f.write(vectors.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            new_records = [{"id": record.id, "meta": record.meta, "documents": record.documents} for record in record_lst]
+            with open(os.path.join(self.path, _records_file), "a", encoding="utf-8") as f:
+                for record in new_records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._snapshot = self._build_snapshot(self._snapshot.records + new_records)
+
+    def query(self, input_data: str, meta_filter: Dict = None, top_k: int = 3,
+              threshold: float = 0.0) -> List[VectorRecordItem]:
+        snapshot = self._snapshot
+        if len(snapshot.records) == 0:
+            return []
+        candidates = np.nonzero(snapshot.alive & self._mask(snapshot, meta_filter or {}))[0]
+        if len(candidates) == 0:
+            return []
+        query_vector = self._normalize(np.asarray([EmbeddingCache().get(input_data)], dtype=np.float32))[0]
+        scores = snapshot.vectors[candidates] @ query_vector
+        keep = scores >= threshold
+        candidates, scores = candidates[keep], scores[keep]
+        if len(candidates) > top_k:
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores)
+        return [self._to_item(snapshot.records[candidates[i]], float(scores[i])) for i in order]
+
+    def get(self, where: Dict = None, limit: Optional[int] = None) -> List[VectorRecordItem]:
+        snapshot = self._snapshot
+        if len(snapshot.records) == 0:
+            return []
+        rows = np.nonzero(snapshot.alive & self._mask(snapshot, where or {}))[0]
+        if limit:
+            rows = rows[:limit]
+        return [self._to_item(snapshot.records[row]) for row in rows]
+
+    def export(self) -> (List[VectorRecordItem], np.ndarray):
+        """
+        :return: 所有有效的记录和对应的(归一化后的)向量
+        """
+        snapshot = self._snapshot
+        rows = np.nonzero(snapshot.alive)[0]
+        return [self._to_item(snapshot.records[row]) for row in rows], np.asarray(snapshot.vectors[rows])
+
+    def close(self, delete: bool = False):
+        """
+        写入时已经落盘，关闭只释放 memmap；delete 为 True 时删除本地文件
+        """
+        with self._lock:
+            self._snapshot = _Snapshot(np.zeros((0, 0), dtype=np.float32), [], np.zeros(0, dtype=bool))
+            if delete:
+                shutil.rmtree(self.path, ignore_errors=True)
+
+    def _open(self):
+        info_path = os.path.join(self.path, _info_file)
+        if os.path.exists(info_path):
+            with open(info_path, "r") as f:
+                self._dim = json.load(f)["dim"]
+        records: List[Dict] = []
+        # 每条完整记录结束处的文件偏移
+        offsets: List[int] = []
+        records_path = os.path.join(self.path, _records_file)
+        if os.path.exists(records_path):
+            with open(records_path, "rb") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("incomplete line")
+                        records.append(json.loads(line.decode("utf-8")))
+                    except ValueError:
+                        logger.warning(f"[LocalVectorIndex] {self.name} truncated record, ignore the rest")
+                        break
+                    offset += len(line)
+                    offsets.append(offset)
+        # 上次写入中途崩溃时两个文件长度不一致，截断到较短的一方，之后的追加写入才能保持行号与向量对齐
+        vectors_path = os.path.join(self.path, _vectors_file)
+        vector_rows = 0
+        if self._dim > 0 and os.path.exists(vectors_path):
+            vector_rows = os.path.getsize(vectors_path) // 4 // self._dim
+        rows = min(len(records), vector_rows)
+        if os.path.exists(vectors_path) and os.path.getsize(vectors_path) != rows * self._dim * 4:
+            logger.warning(f"[LocalVectorIndex] {self.name} truncate vectors to {rows} rows")
+            os.truncate(vectors_path, rows * self._dim * 4)
+        records_size = offsets[rows - 1] if rows > 0 else 0
+        if os.path.exists(records_path) and os.path.getsize(records_path) != records_size:
+            logger.warning(f"[LocalVectorIndex] {self.name} truncate records to {rows} rows")
+            os.truncate(records_path, records_size)
+        self._snapshot = self._build_snapshot(records[:rows])
+
+    def _build_snapshot(self, records: List[Dict]) -> _Snapshot:
+        vectors_path = os.path.join(self.path, _vectors_file)
+        rows = 0
+        if self._dim > 0 and os.path.exists(vectors_path):
+            rows = min(len(records), os.path.getsize(vectors_path) // 4 // self._dim)
+        records = records[:rows]
+        if rows > 0:
+            vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(rows, self._dim))
+        else:
+            vectors = np.zeros((0, self._dim), dtype=np.float32)
+        # 同一个 id 多次写入时以最后一次为准
+        id_row: Dict[str, int] = {}
+        alive = np.ones(rows, dtype=bool)
+        for row, record in enumerate(records):
+            previous = id_row.get(record["id"], None)
+            if previous is not None:
+                alive[previous] = False
+            id_row[record["id"]] = row
+        return _Snapshot(vectors, records, alive)
+
+    def _mask(self, snapshot: _Snapshot, where: Dict) -> np.ndarray:
+        mask = np.ones(len(snapshot.records), dtype=bool)
+        for key, condition in where.items():
+            if key == "$and":
+                for sub in condition:
+                    mask &= self._mask(snapshot, sub)
+            elif key == "$or":
+                any_mask = np.zeros(len(snapshot.records), dtype=bool)
+                for sub in condition:
+                    any_mask |= self._mask(snapshot, sub)
+                mask &= any_mask
+            else:
+                if not isinstance(condition, dict):
+                    condition = {"$eq": condition}
+                for op, value in condition.items():
+                    mask &= self._compare(snapshot, key, op, value)
+        return mask
+
+    @staticmethod
+    def _compare(snapshot: _Snapshot, field: str, op: str, value) -> np.ndarray:
+        if op in ("$gt", "$gte", "$lt", "$lte"):
+            column = snapshot.numeric_column(field)
+            # nan 参与比较结果为 False，缺少该字段的记录不会命中
+            with np.errstate(invalid="ignore"):
+                if op == "$gt":
+                    return column > value
+                if op == "$gte":
+                    return column >= value
+                if op == "$lt":
+                    return column < value
+                return column <= value
+        column = snapshot.raw_column(field)
+        if op == "$eq":
+            return np.array([item == value for item in column], dtype=bool)
+        if op == "$ne":
+            return np.array([item != value for item in column], dtype=bool)
+        if op == "$in":
+            values = set(value)
+            return np.array([item in values for item in column], dtype=bool)
+        if op == "$nin":
+            values = set(value)
+            return np.array([item not in values for item in column], dtype=bool)
+        raise Exception(f"unsupported filter operator: {op}")
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    @staticmethod
+    def _to_item(record: Dict, score: Optional[float] = None) -> VectorRecordItem:
+        if score is None:
+            return VectorRecordItem(id=record["id"], meta=record["meta"], documents=record["documents"])
+        return VectorRecordItem(id=record["id"], meta=record["meta"], documents=record["documents"], score=score)
@@ -1,16 +1,26 @@
 import json
 import logging
+import threading
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
 from common_py.ai_toolkit.openAI import ChatGPTClient, Message
+from common_py.client.azure_mongo import MongoDBClient
 from common_py.client.chroma import ChromaCollection, VectorRecordItem
 from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+from pymongo import UpdateOne
 
 from memory_sdk import const
-from memory_sdk.const import gen_question_answer
+from memory_sdk.const import gen_question_answer, gen_question_answer_batch
+from memory_sdk.embedding_cache import EmbeddingCache, pack_vector
 from memory_sdk.instance_memory_block.event_block import EventBlock, load_event_block_by_name
+from memory_sdk.longterm_memory.local_vector_index import LocalVectorIndex
+from memory_sdk.longterm_memory.snapshot_delta import SnapshotWithDelta
+from memory_sdk.longterm_memory.temporal_parser import has_temporal_cue, parse_time_range, \
+    timestamp_range_by_time_accuracy
 
 logger = wrapper_azure_log_handler(
     wrapper_std_output(
@@ -18,6 +28,18 @@ logger = wrapper_azure_log_handler(
     )
 )
 
+# 规则无法解析(如农历节日)但有时间线索时，是否回退到LLM解析；该调用在对话的同步路径上，默认关闭
+Temporal_LLM_fallback = False
+
+# 索引问题的批量生成: 多个 summary 打包进一个 prompt，按 token 预算切分批次，只重试解析失败的 block
+Question_batch_enabled = True
+Question_batch_token_budget = 3000
+Question_batch_max_items = 20
+Question_batch_max_retries = 3
+# 进程内共用的问题生成线程池，不再每次调用创建
+Question_executor_workers = 10
+_question_executor = ThreadPoolExecutor(max_workers=Question_executor_workers)
+
 
 class LongTermMemoryEntity:
 
@@ -27,30 +49,46 @@ class LongTermMemoryEntity:
         self.collection: Optional[ChromaCollection] = chroma_collection
         self.LLMClient = ChatGPTClient()
         self.ready: bool = False
+        # 本进程上传过的向量记录数，用于估算内存，从快照加载的记录不计入
+        self.record_count: int = 0
+        self._ready_event = threading.Event()
+        # 是否从快照加载，以及加载时补齐的 delta block，关闭时据此决定追加 delta 还是上传新的快照
+        self.base_snapshot: bool = False
+        self.delta_block_names: List[str] = []
+        # 会话中增量索引进集合、但还没有持久化到快照或 delta 的 block 和对应的 journal
+        self.indexed_block_names: List[str] = []
+        self.indexed_journal_ids: List[int] = []
 
     def set_collection(self, collection: ChromaCollection):
         self.collection = collection
 
     def set_ready(self):
         self.ready = True
+        self._ready_event.set()
+
+    def wait_ready(self, timeout: float) -> bool:
+        """
+        等待向量集合加载完成，最多等待 timeout 秒
+        """
+        return self.ready or self._ready_event.wait(timeout)
+
+    def upload_new_mem_block(self, mem_block_lst: List[EventBlock], stored_vectors: Dict[str, List[bytes]] = None):
+        """
+        block 已经保存过索引问题时直接使用，否则调用LLM生成并写回 AI_memory_block，之后的重建不再需要LLM
+        本地索引同样使用保存过的向量(stored_vectors 为 AI_memory_block 中的 index_vectors)，没有时计算并写回
+        :param stored_vectors: block name -> index_vectors
+        """
+        ensure_index_questions(self.LLMClient, mem_block_lst)
 
-    def upload_new_mem_block(self, mem_block_lst: List[EventBlock]):
         record_lst = []
-        question_tasks = []
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            for mem_block in mem_block_lst:
-                meta_data = {
-                    "AID": self.AID,
-                    "target_id": self.target_id,
-                    "create_time": mem_block.create_timestamp,
-                    "block_name": mem_block.name
-                }
-                task = executor.submit(self._gen_vector_index_from_mem_block, mem_block)
-                question_tasks.append((meta_data, task))
-        for tup in question_tasks:
-            meta_data, task = tup
-            questions = task.result()
-            for question in questions:
+        for mem_block in mem_block_lst:
+            meta_data = {
+                "AID": self.AID,
+                "target_id": self.target_id,
+                "create_time": mem_block.create_timestamp,
+                "block_name": mem_block.name
+            }
+            for question in mem_block.index_questions:
                 record_lst.append(VectorRecordItem(
                     id=str(uuid.uuid4()),
                     meta=meta_data,
@@ -63,33 +101,12 @@ class LongTermMemoryEntity:
                     documents=mem_block.raw_summary
                 )
             )
-        self.collection.upsert_many(record_lst)
-
-    def _gen_vector_index_from_mem_block(self, mem_block: EventBlock) -> List[str]:
-        chat_summary = mem_block.raw_summary
-        question_num = 1
-        if len(chat_summary) > 250:
-            question_num = 2
-        if len(chat_summary) > 500:
-            question_num = 3
-        question_index = []
-        for i in range(3):
-            try:
-                gen_question_prompt = gen_question_answer.format(question_number=question_num,
-                                                                 chat_summary=chat_summary)
-                resp = self.LLMClient.generate(messages=[
-                    Message(role='system', content=gen_question_prompt)
-                ])
-                if resp:
-                    json_resp = json.loads(resp.get_chat_content())
-                    if 'questions' not in json_resp or not isinstance(json_resp['questions'], list):
-                        raise Exception(f"llm response expect questions key in json but not found: {json_resp}")
-                    question_index.extend(json_resp['questions'])
-                    break
-            except Exception as e:
-                logger.warning(f"gen vector index from mem block error: {e}")
-                continue
-        return question_index
+        if isinstance(self.collection, (LocalVectorIndex, SnapshotWithDelta)):
+            self.collection.upsert_vectors(record_lst, ensure_index_vectors(mem_block_lst, stored_vectors or {}))
+        else:
+            # chroma 集合不接受预先计算的向量，由 chroma 自己 embedding，这里不保存向量
+            self.collection.upsert_many(record_lst)
+        self.record_count += len(record_lst)
 
     def _get_block_name_by_time_range(self, start_time: int, end_time: int, content: str = None, count: int = 2) -> List[str]:
         if not self.ready:
@@ -117,7 +134,12 @@ class LongTermMemoryEntity:
             if not self.ready:
                 logger.warning(f"LongTermMemoryEntity not ready, return empty list")
                 return []
-            time_range_tuple = self._generate_time_range(content)
+            # 没有时间线索的消息直接跳过，规则能解析的不再调用LLM
+            if not has_temporal_cue(content):
+                return []
+            time_range_tuple = parse_time_range(content)
+            if time_range_tuple is None and Temporal_LLM_fallback:
+                time_range_tuple = self._generate_time_range(content)
             if not time_range_tuple:
                 return []
             return self._get_block_name_by_time_range(start_time=time_range_tuple[0], end_time=time_range_tuple[1], content=content, count=count)
@@ -154,26 +176,7 @@ class LongTermMemoryEntity:
             return None
 
     def _get_timestamp_range_by_time_accuracy(self, time_accuracy: str, target_formatted_time: str) -> (int, int):
-        if time_accuracy == 'day':
-            start_time = datetime.strptime(target_formatted_time, "%Y-%m-%d").timestamp()
-            end_time = start_time + 24 * 3600
-        elif time_accuracy == 'week':
-            specified_date = datetime.strptime(target_formatted_time, "%Y-%m-%d")
-            # 计算周一的日期
-            # weekday() 方法返回的是周一为0，周日为6
-            monday_delta = timedelta(days=specified_date.weekday())
-            start_time = specified_date - monday_delta
-            start_time = start_time.timestamp()
-            end_time = start_time + 7 * 24 * 3600
-        elif time_accuracy == 'month':
-            start_time = datetime.strptime(target_formatted_time, "%Y-%m").timestamp()
-            end_time = start_time + 31 * 24 * 3600
-        elif time_accuracy == 'year':
-            start_time = datetime.strptime(target_formatted_time, "%Y").timestamp()
-            end_time = start_time + 365 * 24 * 3600
-        else:
-            raise Exception(f"time accuracy error: {time_accuracy}")
-        return int(start_time), int(end_time)
+        return timestamp_range_by_time_accuracy(time_accuracy, target_formatted_time)
 
     def get_block_name_by_text_input(self, content: str, count: int = 3) -> List[str]:
         try:
@@ -204,6 +207,180 @@ class LongTermMemoryEntity:
 
         return block_name_lst
 
+def _question_number(chat_summary: str) -> int:
+    question_num = 1
+    if len(chat_summary) > 250:
+        question_num = 2
+    if len(chat_summary) > 500:
+        question_num = 3
+    return question_num
+
+
+def _estimate_tokens(text: str) -> int:
+    # 粗略估计，英文约4个字符一个token，中文等非ASCII字符约一个字符一个token
+    ascii_count = sum(1 for c in text if ord(c) < 128)
+    return ascii_count // 4 + (len(text) - ascii_count) + 1
+
+
+def gen_index_questions(llm_client: ChatGPTClient, chat_summary: str) -> List[str]:
+    """
+    为 block summary 生成用于向量检索的问题，summary 越长问题越多
+    """
+    question_num = _question_number(chat_summary)
+    question_index = []
+    for i in range(3):
+        try:
+            gen_question_prompt = gen_question_answer.format(question_number=question_num,
+                                                             chat_summary=chat_summary)
+            resp = llm_client.generate(messages=[
+                Message(role='system', content=gen_question_prompt)
+            ])
+            if resp:
+                json_resp = json.loads(resp.get_chat_content())
+                if 'questions' not in json_resp or not isinstance(json_resp['questions'], list):
+                    raise Exception(f"llm response expect questions key in json but not found: {json_resp}")
+                question_index.extend(json_resp['questions'])
+                break
+        except Exception as e:
+            logger.warning(f"gen vector index from mem block error: {e}")
+            continue
+    return question_index
+
+
+def gen_index_questions_batch(llm_client: ChatGPTClient, chat_summaries: List[str]) -> List[List[str]]:
+    """
+    一次LLM请求为多个 summary 生成问题，summary 以下标标记，返回 下标 -> 问题列表 的 json
+    :return: 与 chat_summaries 一一对应，解析失败的位置为空列表
+    """
+    result: List[List[str]] = [[] for _ in chat_summaries]
+    tagged = '\n'.join(f"[{i}] (at most {_question_number(summary)} questions)\n{summary}"
+                        for i, summary in enumerate(chat_summaries))
+    try:
+        resp = llm_client.generate(messages=[
+            Message(role='system', content=gen_question_answer_batch.format(chat_summaries=tagged))
+        ])
+        if not resp:
+            return result
+        json_resp: Dict = json.loads(resp.get_chat_content())
+    except Exception as e:
+        logger.warning(f"gen vector index batch error: {e}")
+        return result
+    for i, summary in enumerate(chat_summaries):
+        questions = json_resp.get(str(i), None)
+        if isinstance(questions, dict):
+            questions = questions.get('questions', None)
+        if not isinstance(questions, list):
+            continue
+        result[i] = [str(question) for question in questions if question][:_question_number(summary)]
+    return result
+
+
+def _split_question_batches(mem_block_lst: List[EventBlock]) -> List[List[EventBlock]]:
+    batches: List[List[EventBlock]] = []
+    batch: List[EventBlock] = []
+    batch_tokens = 0
+    for mem_block in mem_block_lst:
+        tokens = _estimate_tokens(mem_block.raw_summary)
+        if len(batch) > 0 and (batch_tokens + tokens > Question_batch_token_budget
+                               or len(batch) >= Question_batch_max_items):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(mem_block)
+        batch_tokens += tokens
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def ensure_index_questions(llm_client: ChatGPTClient, mem_block_lst: List[EventBlock]):
+    """
+    为还没有索引问题的 block 生成问题并写回 AI_memory_block
+    批量模式下按 token 预算打包，每一轮只重试上一轮没有拿到问题的 block
+    """
+    pending = [mem_block for mem_block in mem_block_lst if len(mem_block.index_questions) == 0]
+    if len(pending) == 0:
+        return
+    if not Question_batch_enabled:
+        tasks = [_question_executor.submit(gen_index_questions, llm_client, mem_block.raw_summary)
+                 for mem_block in pending]
+        for mem_block, task in zip(pending, tasks):
+            mem_block.index_questions = task.result()
+        save_index_questions(pending)
+        return
+
+    remaining = pending
+    for _ in range(Question_batch_max_retries):
+        batches = _split_question_batches(remaining)
+        tasks = [_question_executor.submit(gen_index_questions_batch, llm_client,
+                                           [mem_block.raw_summary for mem_block in batch])
+                 for batch in batches]
+        for batch, task in zip(batches, tasks):
+            for mem_block, questions in zip(batch, task.result()):
+                mem_block.index_questions = questions
+        remaining = [mem_block for mem_block in remaining if len(mem_block.index_questions) == 0]
+        if len(remaining) == 0:
+            break
+    if len(remaining) > 0:
+        logger.warning(f"gen index questions failed for {len(remaining)} blocks after {Question_batch_max_retries} rounds")
+    save_index_questions(pending)
+
+
+def save_index_questions(mem_block_lst: List[EventBlock]):
+    """
+    把生成的索引问题写回 AI_memory_block，生成失败(没有问题)的 block 不写，下次重建或 backfill 时重试
+    """
+    _bulk_set_blocks([(mem_block.name, {"index_questions": mem_block.index_questions}) for mem_block in mem_block_lst
+                      if len(mem_block.index_questions) > 0 and mem_block.name])
+
+
+def ensure_index_vectors(mem_block_lst: List[EventBlock], stored_vectors: Dict[str, List[bytes]]) -> np.ndarray:
+    """
+    每个 block 依次为各个问题和 raw_summary 的向量，与 upload_new_mem_block 生成的记录一一对应
+    保存过且数量一致时直接使用，否则通过 EmbeddingCache 一次请求计算，并以 float32 字节写回 AI_memory_block
+    """
+    vectors: List[List[bytes]] = []
+    missing: List[int] = []
+    for i, mem_block in enumerate(mem_block_lst):
+        stored = stored_vectors.get(mem_block.name, [])
+        if len(stored) != len(mem_block.index_questions) + 1:
+            stored = []
+            missing.append(i)
+        vectors.append(stored)
+    texts = [text for i in missing for text in mem_block_lst[i].index_questions + [mem_block_lst[i].raw_summary]]
+    if len(texts) > 0:
+        embedded = iter(EmbeddingCache().get_many(texts))
+        for i in missing:
+            vectors[i] = [pack_vector(next(embedded)) for _ in range(len(mem_block_lst[i].index_questions) + 1)]
+        # 问题生成失败的 block 下次会重新生成问题，向量也不保存
+        _bulk_set_blocks([(mem_block_lst[i].name, {"index_vectors": vectors[i]}) for i in missing
+                          if len(mem_block_lst[i].index_questions) > 0 and mem_block_lst[i].name])
+    rows = [np.frombuffer(raw, dtype=np.float32) for block_vectors in vectors for raw in block_vectors]
+    return np.vstack(rows) if rows else np.zeros((0, 0), dtype=np.float32)
+
+
+def _bulk_set_blocks(updates: List[Tuple[str, Dict]]):
+    """
+    按 block name 以 $set 写回 AI_memory_block，一次 bulk_write 完成
+    客户端没有暴露 pymongo database 时逐个更新；写入失败只记录，下次重建时重新生成
+    """
+    if len(updates) == 0:
+        return
+    mongo_client = MongoDBClient()
+    db = getattr(mongo_client, 'db', None)
+    if db is not None:
+        try:
+            db['AI_memory_block'].bulk_write([UpdateOne({"name": name}, {'$set': fields}) for name, fields in updates],
+                                             ordered=False)
+        except Exception as e:
+            logger.warning(f"bulk save {list(updates[0][1].keys())} of {len(updates)} blocks error: {e}")
+        return
+    for name, fields in updates:
+        try:
+            mongo_client.update_many_document("AI_memory_block", {"name": name}, {'$set': fields}, False)
+        except Exception as e:
+            logger.warning(f"save {list(fields.keys())} of {name} error: {e}")
+
+
 #
 # if __name__ == '__main__':
 #     target_formatted_time = '2022-06-27'
@@ -1,11 +1,22 @@
+import json
 import logging
+import os
 import threading
-from typing import Dict, List
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
 from common_py.client.azure_mongo import MongoDBClient
 from common_py.client.chroma import ChromaCollection, ChromaDBManager, VectorRecordItem
 from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+from memory_sdk.eviction import EvictionPolicy, Estimate_vector_record_bytes, estimate_block_bytes
 from memory_sdk.instance_memory_block.event_block import EventBlock, from_mongo_res_to_event_block
+from memory_sdk.journal import MemoryJournal, JournalKind_long_term_block
 from memory_sdk.longterm_memory.long_term_mem_entity import LongTermMemoryEntity
+from memory_sdk.longterm_memory.local_vector_index import LocalVectorIndex
+from memory_sdk.longterm_memory.snapshot_delta import SnapshotDelta_compact_interval, \
+    SnapshotDelta_compact_threshold, SnapshotWithDelta, append_delta, clear_delta, find_compactable, load_delta
+from memory_sdk.longterm_memory.warmup_pool import WarmupPool, WarmupPriority_interactive, WarmupPriority_prefetch
+from memory_sdk.striped_lock import StripedLock
 
 logger = wrapper_azure_log_handler(
     wrapper_std_output(
@@ -13,20 +24,70 @@ logger = wrapper_azure_log_handler(
     )
 )
 
+LongTermMemory_max_entries = 1000
+LongTermMemory_idle_ttl = 60 * 60  # 单位秒
+LongTermMemory_byte_budget = 1024 * 1024 * 1024
+LongTermMemory_loader_workers = 8
+LongTermMemory_uploader_workers = 4
+LongTermMemory_close_wait_ready_timeout = 60  # 单位秒
+# 会话进行中的增量索引: stash 中的 block 数或最早 block 的等待时间达到阈值时，生成问题并写入向量集合
+LongTermMemory_indexer_workers = 4
+LongTermMemory_index_interval = 5  # 单位秒
+LongTermMemory_index_min_blocks = 3
+LongTermMemory_index_max_age = 60  # 单位秒
+
+# 向量索引后端: chroma 每个实体一个集合并上传快照; local 为本地 memmap 文件，见 local_vector_index
+LongTermIndex_backend_chroma = "chroma"
+LongTermIndex_backend_local = "local"
+LongTermIndex_backend = os.environ.get("LONG_TERM_INDEX_BACKEND", LongTermIndex_backend_chroma)
+
 
 class LongTermMemoryMgr:
     _instance_lock = threading.Lock()
 
     def __init__(self):
         if not hasattr(self, "_ready"):
-            LongTermMemoryMgr._ready = True
-            self.mongo_client = MongoDBClient()
-            self.mem_map: Dict[str, LongTermMemoryEntity] = {}
-            self.event_stash: Dict[str, List[EventBlock]] = {}
+            # 初始化完成后才设置 _ready，避免并发的第一次调用拿到没有初始化完的对象
+            with LongTermMemoryMgr._instance_lock:
+                if not hasattr(self, "_ready"):
+                    self.mongo_client = MongoDBClient()
+                    self.mem_map: Dict[str, LongTermMemoryEntity] = {}
+                    self.event_stash: Dict[str, List[EventBlock]] = {}
+                    self.event_stash_journal_ids: Dict[str, List[int]] = {}
+                    self.event_stash_time: Dict[str, float] = {}
+                    self._stash_lock = threading.RLock()
+                    self._locks = StripedLock()
+                    # 向量集合的加载线程池，有界且按优先级调度，交互会话优先
+                    self.warmup_pool = WarmupPool("long_term_memory", LongTermMemory_loader_workers)
+                    # 关闭时的上传在后台执行，不阻塞会话结束；正在关闭的实体再次加载时等待上传完成
+                    self.uploader = ThreadPoolExecutor(max_workers=LongTermMemory_uploader_workers)
+                    self._closing: Dict[str, threading.Event] = {}
+                    # 正在加载向量集合的实体，后台合并 delta 时跳过
+                    self._loading: Set[str] = set()
+                    # 所有实体共用的增量索引线程池，每个实体同时只有一个索引任务
+                    self.indexer = ThreadPoolExecutor(max_workers=LongTermMemory_indexer_workers)
+                    self._indexing: Dict[str, Future] = {}
+                    threading.Thread(target=self._index_loop, daemon=True).start()
+                    if LongTermIndex_backend == LongTermIndex_backend_chroma:
+                        threading.Thread(target=self._compact_loop, daemon=True).start()
+                    # 还在加载向量集合的实体不淘汰
+                    self.eviction = EvictionPolicy("long_term_memory", LongTermMemory_max_entries, LongTermMemory_idle_ttl,
+                                                   LongTermMemory_byte_budget,
+                                                   size_of=self._estimate_bytes,
+                                                   is_busy=lambda store_key: (e := self.mem_map.get(store_key)) is not None
+                                                   and not e.ready,
+                                                   evict=self._close_by_store_key)
+                    LongTermMemoryMgr._ready = True
 
     def load_from_mongo(self, AID: str, target_id: str, entity: LongTermMemoryEntity):
-        chroma_collection = ChromaDBManager().get_collection(gen_collection_name(AID, target_id))
-        entity.set_collection(chroma_collection)
+        # 本地索引重建时使用保存的 index_vectors，chroma 自己 embedding，不读取向量
+        projection = {'embedding_1536D': 0, 'tags_embedding_1536D': 0}
+        if LongTermIndex_backend == LongTermIndex_backend_local:
+            entity.set_collection(LocalVectorIndex(gen_collection_name(AID, target_id)))
+        else:
+            chroma_collection = ChromaDBManager().get_collection(gen_collection_name(AID, target_id))
+            entity.set_collection(chroma_collection)
+            projection['index_vectors'] = 0
         partition_id = f"participant_ids.{target_id}"
         mem_block_lst = self.mongo_client.find_from_collection("AI_memory_block",
                                                                filter={
@@ -37,61 +98,278 @@ class LongTermMemoryMgr:
                                                                        }
                                                                        },
                                                                    ]
-                                                               })
+                                                               }, projection=projection)
         logger.info(f"[LongTermMemoryEntity] load from mongo result number: {len(mem_block_lst)}")
+        stored_vectors = {event_block['name']: event_block.get('index_vectors', []) for event_block in mem_block_lst}
         mem_blocks = [from_mongo_res_to_event_block(event_block) for event_block in mem_block_lst]
-        entity.upload_new_mem_block(mem_blocks)
+        entity.upload_new_mem_block(mem_blocks, stored_vectors)
         entity.set_ready()
         logger.info(f"[LongTermMemoryEntity] load from mongo success")
 
     def _upload_collection_to_blob_and_delete(self, entity: LongTermMemoryEntity):
+        if isinstance(entity.collection, LocalVectorIndex):
+            # 本地索引写入时已经落盘，保留文件供下次直接打开
+            entity.collection.close()
+            return
         ChromaDBManager().close_collection(entity.collection.get_collection_name(), True)
 
     def load_from_blob(self, entity_name: str, entity: LongTermMemoryEntity):
-        collection = ChromaDBManager().get_collection(entity_name, use_cloud_if_not_exist=True)
+        base = ChromaDBManager().get_collection(entity_name, use_cloud_if_not_exist=True)
+        collection = SnapshotWithDelta(base, entity_name)
+        # 快照之后追加的 block 连同向量保存在 delta 中，直接放进本地 delta 索引，不重新 embedding
+        delta_block_names, record_lst, vectors = load_delta(entity_name)
+        collection.delta.upsert_vectors(record_lst, vectors)
         entity.set_collection(collection)
+        entity.base_snapshot = True
+        entity.delta_block_names = delta_block_names
+        entity.set_ready()
+        logger.info(f"[LongTermMemoryEntity] load from blob success, delta blocks: {len(delta_block_names)}")
+
+    def load_from_local(self, entity_name: str, entity: LongTermMemoryEntity):
+        entity.set_collection(LocalVectorIndex(entity_name))
         entity.set_ready()
-        logger.info(f"[LongTermMemoryEntity] load from blob success")
+        logger.info(f"[LongTermMemoryEntity] load from local index success")
 
-    def get_long_term_mem_entity(self, AID: str, target_id: str) -> LongTermMemoryEntity:
+    def get_long_term_mem_entity(self, AID: str, target_id: str,
+                                 priority: int = WarmupPriority_interactive) -> LongTermMemoryEntity:
         store_key = gen_collection_name(AID, target_id)
-        if store_key not in self.mem_map:
-            entity = LongTermMemoryEntity(
-                AID=AID,
-                target_id=target_id,
-            )
-            self.mem_map[store_key] = entity
-
-            def load_vector_collection():
-                if ChromaDBManager().if_cloud_snapshot_exist(store_key):
+        self.eviction.touch(store_key)
+        # 同一个实体只创建一次，也只提交一次加载任务
+        entity = self._locks.get_or_create(self.mem_map, store_key, lambda: self._create_entity(AID, target_id, priority))
+        if not entity.ready:
+            # 预加载还在排队时，交互请求提升它的优先级
+            self.warmup_pool.promote(store_key, priority)
+        return entity
+
+    def prefetch(self, AID: str, target_id: str):
+        """
+        进入会话时调用，在第一条消息之前开始加载长期记忆
+        """
+        self.get_long_term_mem_entity(AID, target_id, WarmupPriority_prefetch)
+
+    def warmup_stats(self) -> Dict:
+        return self.warmup_pool.stats()
+
+    def _create_entity(self, AID: str, target_id: str, priority: int = WarmupPriority_interactive) -> LongTermMemoryEntity:
+        store_key = gen_collection_name(AID, target_id)
+        entity = LongTermMemoryEntity(
+            AID=AID,
+            target_id=target_id,
+        )
+
+        def load_vector_collection():
+            # 上一次关闭的上传还没有完成时，等待快照和 delta 写完再加载
+            with self._locks.lock_for(store_key):
+                closing = self._closing.get(store_key, None)
+                self._loading.add(store_key)
+            if closing is not None:
+                closing.wait()
+            try:
+                if LongTermIndex_backend == LongTermIndex_backend_local:
+                    if LocalVectorIndex.exists(store_key):
+                        self.load_from_local(store_key, entity)
+                    else:
+                        self.load_from_mongo(AID, target_id, entity)
+                elif ChromaDBManager().if_cloud_snapshot_exist(store_key):
                     self.load_from_blob(store_key, entity)
                 else:
                     self.load_from_mongo(AID, target_id, entity)
+            except Exception:
+                # 加载失败的实体不会 ready，也不会被淘汰，移除之后下一次请求重新加载
+                with self._locks.lock_for(store_key):
+                    if self.mem_map.get(store_key, None) is entity:
+                        self.mem_map.pop(store_key, None)
+                raise
+            finally:
+                with self._locks.lock_for(store_key):
+                    self._loading.discard(store_key)
 
-            threading.Thread(target=load_vector_collection).start()
-            return entity
-        else:
-            return self.mem_map[store_key]
+        self.warmup_pool.submit(store_key, load_vector_collection, priority)
+        return entity
 
     def update_event_block_for_entity(self, AID: str, target_id: str, block_lst: List[EventBlock]):
         store_key = gen_collection_name(AID, target_id)
-        if store_key not in self.event_stash:
-            self.event_stash[store_key] = block_lst
-        else:
-            self.event_stash[store_key].extend(block_lst)
+        journal_ids = []
+        for block in block_lst:
+            journal_ids.append(MemoryJournal().append(JournalKind_long_term_block, {
+                "AID": AID,
+                "target_id": target_id,
+                "block": json.loads(block.json(exclude={'origin_event', 'embedding_1536D', 'tags_embedding_1536D'})),
+            }))
+        self._restore_stash(store_key, block_lst, journal_ids)
 
     def close_long_term_entity(self, AID: str, target_id: str):
-        store_key = gen_collection_name(AID, target_id)
-        if store_key not in self.mem_map:
+        self._close_by_store_key(gen_collection_name(AID, target_id))
+
+    def _close_by_store_key(self, store_key: str):
+        """
+        从内存中移除实体，刷写和上传交给后台线程
+        """
+        with self.eviction.pinned(store_key):
+            with self._locks.lock_for(store_key):
+                entity = self.mem_map.pop(store_key, None)
+                if entity is None:
+                    return
+                closing = threading.Event()
+                self._closing[store_key] = closing
+        self.eviction.remove(store_key)
+        self.uploader.submit(self._flush_entity, store_key, entity, closing)
+
+    def _flush_entity(self, store_key: str, entity: LongTermMemoryEntity, closing: threading.Event):
+        """
+        chroma 后端: 从快照加载且 delta 不多时只追加 delta，否则上传整个集合作为新的 base 并清理已合并的 delta
+        会话中增量索引过的 block 已经在集合中，这里只处理剩余的 stash
+        """
+        block_lst, journal_ids = [], []
+        try:
+            if not entity.wait_ready(LongTermMemory_close_wait_ready_timeout):
+                logger.error(f"[LongTermMemoryEntity] {store_key} not ready when closing, keep stash for next load")
+                return
+            # 等待进行中的增量索引，失败时 block 会放回 stash
+            with self._stash_lock:
+                indexing = self._indexing.pop(store_key, None)
+            if indexing is not None:
+                indexing.exception()
+            block_lst, journal_ids = self._take_stash(store_key)
+            block_names = entity.indexed_block_names + [block.name for block in block_lst]
+            journal_ids = entity.indexed_journal_ids + journal_ids
+            if isinstance(entity.collection, LocalVectorIndex):
+                entity.upload_new_mem_block(block_lst)
+                entity.collection.close()
+            elif isinstance(entity.collection, SnapshotWithDelta):
+                # 新 block 写入本地 delta 索引，向量只计算一次
+                entity.upload_new_mem_block(block_lst)
+                collection: SnapshotWithDelta = entity.collection
+                if len(entity.delta_block_names) + len(block_names) < SnapshotDelta_compact_threshold:
+                    record_lst, vectors = collection.delta.export()
+                    new_names = set(block_names)
+                    keep = [i for i, record in enumerate(record_lst) if record.meta.get("block_name") in new_names]
+                    append_delta(store_key, [record_lst[i] for i in keep], vectors[keep])
+                    ChromaDBManager().close_collection(collection.get_collection_name(), False)
+                else:
+                    self._compact(collection.base, collection.delta.export()[0],
+                                  entity.delta_block_names + block_names)
+                collection.close()
+            else:
+                entity.upload_new_mem_block(block_lst)
+                self._upload_collection_to_blob_and_delete(entity)
+                clear_delta(store_key, entity.delta_block_names + block_names)
+            MemoryJournal().ack(*journal_ids)
+            logger.info(f"[LongTermMemoryEntity] {store_key} closed, new blocks: {len(block_names)}")
+        except Exception as e:
+            logger.exception(e)
+            # 没有刷写成功的 block 留在 stash 中，下次加载之后重新索引
+            self._restore_stash(store_key, block_lst, journal_ids)
+        finally:
+            self._closing.pop(store_key, None)
+            closing.set()
+
+    def _compact(self, base: ChromaCollection, record_lst: List[VectorRecordItem], block_names: List[str]):
+        """
+        把 delta 记录写入 base 集合并上传为新的快照，之后清理已合并的 delta
+        chroma 集合不接受预先计算的向量，合并时由 chroma 重新 embedding，每 SnapshotDelta_compact_threshold 个 block 一次
+        """
+        store_key = base.get_collection_name()
+        if len(record_lst) > 0:
+            base.upsert_many(record_lst)
+        ChromaDBManager().close_collection(store_key, True)
+        clear_delta(store_key, block_names)
+        logger.info(f"[LongTermMemoryEntity] {store_key} compacted, delta blocks: {len(block_names)}")
+
+    def _compact_loop(self):
+        while True:
+            time.sleep(SnapshotDelta_compact_interval)
+            try:
+                for store_key in find_compactable():
+                    self._compact_idle(store_key)
+            except Exception as e:
+                logger.exception(e)
+
+    def _compact_idle(self, store_key: str):
+        """
+        后台合并没有加载的实体的 delta，合并期间登记在 _closing 中，加载时等待合并完成
+        已经加载的实体在关闭时合并
+        """
+        with self._locks.lock_for(store_key):
+            if store_key in self.mem_map or store_key in self._closing or store_key in self._loading:
+                return
+            closing = threading.Event()
+            self._closing[store_key] = closing
+        try:
+            base = ChromaDBManager().get_collection(store_key, use_cloud_if_not_exist=True)
+            block_names, record_lst, _ = load_delta(store_key)
+            self._compact(base, record_lst, block_names)
+        except Exception as e:
+            logger.warning(f"[LongTermMemoryEntity] {store_key} background compact error: {e}")
+        finally:
+            self._closing.pop(store_key, None)
+            closing.set()
+
+    def _take_stash(self, store_key: str) -> Tuple[List[EventBlock], List[int]]:
+        with self._stash_lock:
+            self.event_stash_time.pop(store_key, None)
+            return self.event_stash.pop(store_key, []), self.event_stash_journal_ids.pop(store_key, [])
+
+    def _restore_stash(self, store_key: str, block_lst: List[EventBlock], journal_ids: List[int]):
+        if len(block_lst) == 0:
             return
-        entity = self.mem_map[store_key]
-        if store_key in self.event_stash:
-            block_lst = self.event_stash[store_key]
+        with self._stash_lock:
+            self.event_stash.setdefault(store_key, []).extend(block_lst)
+            self.event_stash_journal_ids.setdefault(store_key, []).extend(journal_ids)
+            self.event_stash_time.setdefault(store_key, time.time())
+
+    def _index_loop(self):
+        while True:
+            time.sleep(LongTermMemory_index_interval)
+            try:
+                self._schedule_index()
+            except Exception as e:
+                logger.exception(e)
+
+    def _schedule_index(self):
+        now = time.time()
+        with self._stash_lock:
+            candidates = [store_key for store_key, block_lst in self.event_stash.items()
+                          if len(block_lst) >= LongTermMemory_index_min_blocks
+                          or now - self.event_stash_time.get(store_key, now) >= LongTermMemory_index_max_age]
+        for store_key in candidates:
+            entity = self.mem_map.get(store_key, None)
+            # 还在加载的实体等下一轮，正在关闭的实体由关闭流程处理
+            if entity is None or not entity.ready:
+                continue
+            # 与关闭流程读取 _indexing 互斥，关闭时要么能看到这里提交的任务，要么这里能看到 _closing
+            with self._stash_lock:
+                if store_key in self._closing:
+                    continue
+                indexing = self._indexing.get(store_key, None)
+                if indexing is not None and not indexing.done():
+                    continue
+                block_lst, journal_ids = self._take_stash(store_key)
+                if len(block_lst) == 0:
+                    continue
+                self._indexing[store_key] = self.indexer.submit(self._index_blocks, store_key, entity, block_lst,
+                                                                journal_ids)
+
+    def _index_blocks(self, store_key: str, entity: LongTermMemoryEntity, block_lst: List[EventBlock],
+                      journal_ids: List[int]):
+        """
+        把 stash 中的 block 写入还在使用中的向量集合，journal 在关闭刷写成功之后才确认
+        """
+        try:
             entity.upload_new_mem_block(block_lst)
-            del self.event_stash[store_key]
-        self._upload_collection_to_blob_and_delete(entity)
-        del self.mem_map[store_key]
-        return
+            entity.indexed_block_names.extend(block.name for block in block_lst)
+            entity.indexed_journal_ids.extend(journal_ids)
+            logger.info(f"[LongTermMemoryEntity] {store_key} indexed {len(block_lst)} blocks")
+        except Exception as e:
+            logger.warning(f"[LongTermMemoryEntity] {store_key} incremental index error: {e}")
+            self._restore_stash(store_key, block_lst, journal_ids)
+
+    def _estimate_bytes(self, store_key: str) -> int:
+        entity = self.mem_map.get(store_key, None)
+        if entity is None:
+            return 0
+        stash_bytes = sum(estimate_block_bytes(block) for block in list(self.event_stash.get(store_key, [])))
+        return entity.record_count * Estimate_vector_record_bytes + stash_bytes
 
     def __new__(cls, *args, **kwargs):
         if not hasattr(LongTermMemoryMgr, "_instance"):
@@ -0,0 +1,66 @@
+"""
+为历史 AI_memory_block 离线补齐索引问题(index_questions)，补齐之后长期记忆冷启动重建不再调用LLM
+
+用法:
+python -m memory_sdk.longterm_memory.question_backfill --limit 1000
+python -m memory_sdk.longterm_memory.question_backfill --AID xxx --dry-run
+"""
+import argparse
+import time
+from typing import Dict, List
+
+from common_py.ai_toolkit.openAI import ChatGPTClient
+from common_py.client.azure_mongo import MongoDBClient
+
+from memory_sdk.instance_memory_block.event_block import Block_summary_projection, EventBlock
+from memory_sdk.longterm_memory.long_term_mem_entity import ensure_index_questions
+
+Backfill_batch_size = 100
+
+
+def _load_missing_blocks(AID: str, limit: int) -> List[EventBlock]:
+    mongo_filter: Dict = {"$or": [{"index_questions": {"$exists": False}}, {"index_questions": {"$size": 0}}]}
+    if AID:
+        mongo_filter = {"$and": [{"AID": AID}, mongo_filter]}
+    res = MongoDBClient().find_from_collection("AI_memory_block", filter=mongo_filter,
+                                               projection=Block_summary_projection)
+    block_lst = []
+    for item in res:
+        if not item.get("raw_summary"):
+            continue
+        block_lst.append(EventBlock(**item))
+        if 0 < limit <= len(block_lst):
+            break
+    return block_lst
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--AID", type=str, default="", help="只处理某个AI的block")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--dry-run", action="store_true", help="只统计需要补齐的block数量")
+    args = parser.parse_args()
+
+    block_lst = _load_missing_blocks(args.AID, args.limit)
+    print(f"{len(block_lst)} blocks without index questions")
+    if args.dry_run or len(block_lst) == 0:
+        return
+
+    llm_client = ChatGPTClient()
+    start = time.time()
+    done, failed = 0, 0
+    for batch_start in range(0, len(block_lst), Backfill_batch_size):
+        batch = block_lst[batch_start:batch_start + Backfill_batch_size]
+        # 批量生成并写回，并发度由进程内共用的问题生成线程池决定
+        ensure_index_questions(llm_client, batch)
+        for block in batch:
+            if len(block.index_questions) == 0:
+                failed += 1
+            else:
+                done += 1
+        print(f"progress {batch_start + len(batch)}/{len(block_lst)}, filled: {done}, failed: {failed}, "
+              f"cost: {time.time() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
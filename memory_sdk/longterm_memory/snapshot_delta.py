@@ -0,0 +1,119 @@
+"""
+长期记忆快照的增量段(delta)
+快照(base)是 chroma 集合整体上传的结果，之后每次关闭只追加新 block 的向量记录，不再重新上传整个集合
+delta 中保存记录和向量，加载时放进本地的 delta 索引，与 base 一起查询，不需要重新 embedding，也不写入 chroma
+delta 累积到一定数量后合并成新的 base: 关闭时检查，另外后台定期合并没有加载的实体
+"""
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from common_py.client.azure_mongo import MongoDBClient
+from common_py.client.chroma import ChromaCollection, VectorRecordItem
+
+from memory_sdk.longterm_memory.local_vector_index import LocalVectorIndex, LocalVectorIndex_dir
+
+SnapshotDelta_collection = "AI_long_term_memory_delta"
+# delta 中的 block 数达到该值时合并成新的 base 快照
+SnapshotDelta_compact_threshold = 50
+# 后台合并的检查间隔，单位秒
+SnapshotDelta_compact_interval = 10 * 60
+# 加载后的 delta 索引放在本地目录，关闭时删除
+SnapshotDelta_local_dir = os.path.join(LocalVectorIndex_dir, "delta")
+
+
+def load_delta(store_key: str) -> Tuple[List[str], List[VectorRecordItem], np.ndarray]:
+    """
+    :return: delta 中的 block 名字、向量记录和对应的向量
+    """
+    res = MongoDBClient().find_one_from_collection(SnapshotDelta_collection, {"store_key": store_key})
+    if res is None:
+        return [], [], np.zeros((0, 0), dtype=np.float32)
+    block_names = list(res.get("block_names", []))
+    stored = res.get("records", {})
+    record_lst, vectors = [], []
+    for block_name in block_names:
+        for record in stored.get(block_name, []):
+            record_lst.append(VectorRecordItem(id=record["id"], meta=record["meta"], documents=record["documents"]))
+            vectors.append(np.frombuffer(record["vector"], dtype=np.float32))
+    return block_names, record_lst, np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+
+def append_delta(store_key: str, record_lst: List[VectorRecordItem], vectors: np.ndarray):
+    """
+    按 block 追加向量记录，同一个 block 重复追加时覆盖
+    """
+    if len(record_lst) == 0:
+        return
+    by_block: Dict[str, List[Dict]] = {}
+    for record, vector in zip(record_lst, vectors):
+        by_block.setdefault(record.meta["block_name"], []).append({
+            "id": record.id,
+            "meta": record.meta,
+            "documents": record.documents,
+            "vector": np.asarray(vector, dtype=np.float32).tobytes(),
+        })
+    update = {f"records.{block_name}": records for block_name, records in by_block.items()}
+    update["update_time"] = int(time.time())
+    MongoDBClient().update_many_document(SnapshotDelta_collection, {"store_key": store_key}, {
+        "$addToSet": {"block_names": {"$each": list(by_block.keys())}},
+        "$set": update,
+    }, True)
+
+
+def clear_delta(store_key: str, block_names: List[str]):
+    """
+    合并成新的 base 之后调用，只移除已经合并的 block，合并期间追加的 delta 保留
+    """
+    if len(block_names) == 0:
+        return
+    MongoDBClient().update_many_document(SnapshotDelta_collection, {"store_key": store_key}, {
+        "$pullAll": {"block_names": block_names},
+        "$unset": {f"records.{block_name}": "" for block_name in block_names},
+        "$set": {"update_time": int(time.time())},
+    }, False)
+
+
+def find_compactable(threshold: int = SnapshotDelta_compact_threshold) -> List[str]:
+    """
+    :return: delta 中 block 数达到阈值的 store_key
+    """
+    res = MongoDBClient().find_from_collection(SnapshotDelta_collection,
+                                               filter={f"block_names.{threshold - 1}": {"$exists": True}},
+                                               projection={"store_key": 1})
+    return [doc["store_key"] for doc in res]
+
+
+class SnapshotWithDelta:
+    """
+    实现 LongTermMemoryEntity 用到的 ChromaCollection 接口，base 为从快照加载的 chroma 集合，只读
+    新写入的记录只进入本地 delta 索引(EmbeddingCache 计算一次向量)，关闭时连同向量一起追加到 delta
+    """
+
+    def __init__(self, base: ChromaCollection, store_key: str):
+        self.base = base
+        self.store_key = store_key
+        LocalVectorIndex.remove(store_key, SnapshotDelta_local_dir)
+        self.delta = LocalVectorIndex(store_key, SnapshotDelta_local_dir)
+
+    def get_collection_name(self) -> str:
+        return self.base.get_collection_name()
+
+    def upsert_many(self, record_lst: List[VectorRecordItem]):
+        self.delta.upsert_many(record_lst)
+
+    def query(self, input_data: str, meta_filter: Dict = None, top_k: int = 3,
+              threshold: float = 0.0) -> List[VectorRecordItem]:
+        res = list(self.base.query(input_data=input_data, meta_filter=meta_filter, top_k=top_k, threshold=threshold))
+        res.extend(self.delta.query(input_data=input_data, meta_filter=meta_filter, top_k=top_k, threshold=threshold))
+        return sorted(res, key=lambda item: item.score or 0.0, reverse=True)[:top_k]
+
+    def get(self, where: Dict = None, limit: Optional[int] = None) -> List[VectorRecordItem]:
+        res = list(self.base.get(where=where, limit=limit))
+        if limit and len(res) >= limit:
+            return res
+        return res + self.delta.get(where=where, limit=limit - len(res) if limit else None)
+
+    def close(self):
+        self.delta.close(delete=True)
@@ -0,0 +1,308 @@
+"""
+本地规则的时间表达解析，替代 LongTermMemoryEntity._generate_time_range 中的LLM调用
+输出与LLM相同的 (time_accuracy, formatted_time)，再由 timestamp_range_by_time_accuracy 转换成时间戳范围
+
+- has_temporal_cue: 廉价的检测，没有可解析的时间线索的消息直接跳过
+- parse_time_expression: 能确定的表达返回结果，有线索但无法确定(如春节、中秋等农历节日)时返回 None，由调用方回退到LLM
+"""
+import re
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+
+TimeAccuracy_day = "day"
+TimeAccuracy_week = "week"
+TimeAccuracy_month = "month"
+TimeAccuracy_year = "year"
+
+_cn_digit = {"零": 0, "〇": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+_cn_num = r"[0-9零〇一二两三四五六七八九十]+"
+_en_num_words = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8,
+    "nine": 9, "ten": 10, "eleven": 11, "twelve": 12,
+}
+_en_num = r"(?:\d+|a|an|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve)"
+
+_en_months = {
+    "january": 1, "jan": 1, "february": 2, "feb": 2, "march": 3, "mar": 3, "april": 4, "apr": 4, "may": 5,
+    "june": 6, "jun": 6, "july": 7, "jul": 7, "august": 8, "aug": 8, "september": 9, "sep": 9, "sept": 9,
+    "october": 10, "oct": 10, "november": 11, "nov": 11, "december": 12, "dec": 12,
+}
+# "may" 作为情态动词太常见，只在 "in may" / "may 5" 这类明确的形式中识别
+_en_month_pattern = r"(january|february|march|april|june|july|august|september|october|november|december|jan|feb|mar|apr|jun|jul|aug|sept|sep|oct|nov|dec)"
+_en_weekdays = {"monday": 0, "tuesday": 1, "wednesday": 2, "thursday": 3, "friday": 4, "saturday": 5, "sunday": 6}
+_cn_weekdays = {"一": 0, "二": 1, "三": 2, "四": 3, "五": 4, "六": 5, "日": 6, "天": 6}
+
+# 公历固定日期的节日 (月, 日)，农历节日无法用规则确定，交给LLM
+_holidays = {
+    "christmas": (12, 25), "圣诞": (12, 25), "平安夜": (12, 24), "christmas eve": (12, 24),
+    "new year's day": (1, 1), "new year": (1, 1), "元旦": (1, 1),
+    "valentine": (2, 14), "情人节": (2, 14), "halloween": (10, 31), "万圣节": (10, 31),
+    "国庆": (10, 1), "劳动节": (5, 1), "五一": (5, 1), "儿童节": (6, 1), "教师节": (9, 10),
+}
+_lunar_holidays = ["春节", "除夕", "中秋", "端午", "元宵", "七夕", "重阳", "清明", "chinese new year",
+                   "spring festival", "mid-autumn", "thanksgiving", "感恩节", "easter", "复活节",
+                   "mother's day", "father's day", "母亲节", "父亲节"]
+
+# 只包含规则能够解析的表达和明确的日期(农历节日)，"之前"、"那天"、"last time" 这类泛指不算时间线索
+_cue_pattern = re.compile(
+    rf"\b(today|tonight|yesterday|last night|this (?:week|weekend|month|year|morning|afternoon|evening)|"
+    rf"(?:last|past) (?:week|weekend|month|year)|week before last|{_en_num} (?:days?|weeks?|months?|years?) ago|"
+    rf"monday|tuesday|wednesday|thursday|friday|saturday|sunday|"
+    rf"{_en_month_pattern}|(?:in|during|last|this) may|may \d{{1,2}}|"
+    rf"christmas|halloween|valentine|new year|chinese new year|spring festival|mid-autumn|thanksgiving|easter|"
+    rf"mother's day|father's day|(?:in|during|back in|since) (?:19|20)\d\d|(?:19|20)\d\d[-/.]\d{{1,2}})\b|"
+    rf"今天|今晚|今早|昨天|昨晚|昨日|前天|{_cn_num}(?:天|个?(?:周|星期|礼拜)|个月|年)(?:以)?前|"
+    rf"上上?(?:周|个?(?:星期|礼拜|月))|这周|本周|这个?(?:星期|礼拜|月)|本月|今年|去年|前年|"
+    rf"(?:周|星期|礼拜)[一二三四五六日天]|{_cn_num}月|(?:19|20)\d\d年|"
+    rf"圣诞|平安夜|元旦|情人节|万圣节|国庆|劳动节|五一|儿童节|教师节|春节|除夕|中秋|端午|元宵|七夕|重阳|清明|感恩节|复活节|"
+    rf"母亲节|父亲节",
+    re.IGNORECASE,
+)
+
+
+def has_temporal_cue(content: str) -> bool:
+    return bool(_cue_pattern.search(content))
+
+
+def parse_time_expression(content: str, now: Optional[datetime] = None) -> Optional[Tuple[str, str]]:
+    """
+    :return: (time_accuracy, formatted_time)，无法确定时返回 None
+    """
+    now = now or datetime.now()
+    text = content.lower().strip()
+    for lunar in _lunar_holidays:
+        if lunar in text:
+            return None
+    year_offset = _year_offset(text)
+    for parser in (_parse_explicit_date, _parse_holiday, _parse_month_day, _parse_relative_day, _parse_weekday,
+                   _parse_relative_week, _parse_relative_month):
+        res = parser(text, now, year_offset)
+        if res is not None:
+            return res
+    if year_offset is not None:
+        return TimeAccuracy_year, str(now.year + year_offset)
+    match = re.search(r"\b(?:in|during|back in)\s+((?:19|20)\d\d)\b|((?:19|20)\d\d)年", text)
+    if match:
+        return TimeAccuracy_year, match.group(1) or match.group(2)
+    return None
+
+
+def timestamp_range_by_time_accuracy(time_accuracy: str, target_formatted_time: str) -> (int, int):
+    if time_accuracy == TimeAccuracy_day:
+        start_time = datetime.strptime(target_formatted_time, "%Y-%m-%d").timestamp()
+        end_time = start_time + 24 * 3600
+    elif time_accuracy == TimeAccuracy_week:
+        specified_date = datetime.strptime(target_formatted_time, "%Y-%m-%d")
+        # 计算周一的日期
+        # weekday() 方法返回的是周一为0，周日为6
+        monday_delta = timedelta(days=specified_date.weekday())
+        start_time = specified_date - monday_delta
+        start_time = start_time.timestamp()
+        end_time = start_time + 7 * 24 * 3600
+    elif time_accuracy == TimeAccuracy_month:
+        start_time = datetime.strptime(target_formatted_time, "%Y-%m").timestamp()
+        end_time = start_time + 31 * 24 * 3600
+    elif time_accuracy == TimeAccuracy_year:
+        start_time = datetime.strptime(target_formatted_time, "%Y").timestamp()
+        end_time = start_time + 365 * 24 * 3600
+    else:
+        raise Exception(f"time accuracy error: {time_accuracy}")
+    return int(start_time), int(end_time)
+
+
+def parse_time_range(content: str, now: Optional[datetime] = None) -> Optional[Tuple[int, int]]:
+    res = parse_time_expression(content, now)
+    if res is None:
+        return None
+    return timestamp_range_by_time_accuracy(*res)
+
+
+def _to_int(num: str) -> int:
+    if num.isdigit():
+        return int(num)
+    if num in _en_num_words:
+        return _en_num_words[num]
+    # 中文数字，只需要支持到九十九
+    if "十" in num:
+        tens, _, ones = num.partition("十")
+        return (_cn_digit.get(tens, 1) if tens else 1) * 10 + (_cn_digit.get(ones, 0) if ones else 0)
+    value = 0
+    for c in num:
+        value = value * 10 + _cn_digit.get(c, 0)
+    return value
+
+
+def _day(date: datetime) -> Tuple[str, str]:
+    return TimeAccuracy_day, date.strftime("%Y-%m-%d")
+
+
+def _month(year: int, month: int) -> Tuple[str, str]:
+    return TimeAccuracy_month, f"{year:04d}-{month:02d}"
+
+
+def _shift_month(now: datetime, months: int) -> Tuple[int, int]:
+    index = now.year * 12 + now.month - 1 - months
+    return index // 12, index % 12 + 1
+
+
+def _valid_date(year: int, month: int, day: int) -> Optional[datetime]:
+    try:
+        return datetime(year, month, day)
+    except ValueError:
+        return None
+
+
+def _past_year(now: datetime, month: int, day: int, year_offset: Optional[int]) -> int:
+    """
+    没有指明年份时，取最近一次已经发生过的日期所在的年份
+    """
+    if year_offset is not None:
+        return now.year + year_offset
+    return now.year if (month, day) <= (now.month, now.day) else now.year - 1
+
+
+def _year_offset(text: str) -> Optional[int]:
+    if re.search(r"今年|this year", text):
+        return 0
+    if re.search(r"去年|last year", text):
+        return -1
+    if re.search(r"前年|the year before last", text):
+        return -2
+    match = re.search(rf"\b({_en_num}) years? ago\b", text) or re.search(rf"({_cn_num})年前", text)
+    if match:
+        return -_to_int(match.group(1))
+    return None
+
+
+def _parse_explicit_date(text: str, now: datetime, year_offset: Optional[int]):
+    match = re.search(r"\b((?:19|20)\d\d)[-/.](\d{1,2})[-/.](\d{1,2})\b", text) or \
+        re.search(r"((?:19|20)\d\d)年(\d{1,2})月(\d{1,2})[日号]", text)
+    if match:
+        date = _valid_date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        return _day(date) if date else None
+    match = re.search(r"((?:19|20)\d\d)年(\d{1,2})月", text) or re.search(r"\b((?:19|20)\d\d)[-/](\d{1,2})\b", text)
+    if match and 1 <= int(match.group(2)) <= 12:
+        return _month(int(match.group(1)), int(match.group(2)))
+    match = re.search(rf"\b{_en_month_pattern}\s+((?:19|20)\d\d)\b", text)
+    if match:
+        return _month(int(match.group(2)), _en_months[match.group(1)])
+    return None
+
+
+def _parse_holiday(text: str, now: datetime, year_offset: Optional[int]):
+    # 先匹配更长的名字，比如 christmas eve 优先于 christmas
+    for name in sorted(_holidays, key=len, reverse=True):
+        if name in text:
+            month, day = _holidays[name]
+            return _day(datetime(_past_year(now, month, day, year_offset), month, day))
+    return None
+
+
+def _parse_month_day(text: str, now: datetime, year_offset: Optional[int]):
+    match = re.search(rf"({_cn_num})月({_cn_num})[日号]", text)
+    if match:
+        month, day = _to_int(match.group(1)), _to_int(match.group(2))
+        date = _valid_date(_past_year(now, month, day, year_offset), month, day) if 1 <= month <= 12 else None
+        return _day(date) if date else None
+    match = re.search(rf"\b{_en_month_pattern}\s+(\d{{1,2}})(?:st|nd|rd|th)?\b", text) or \
+        re.search(r"\bmay\s+(\d{1,2})(?:st|nd|rd|th)?\b", text)
+    if match:
+        month = _en_months[match.group(1)] if match.lastindex == 2 else 5
+        day = int(match.group(match.lastindex))
+        date = _valid_date(_past_year(now, month, day, year_offset), month, day)
+        return _day(date) if date else None
+    match = re.search(rf"\b(\d{{1,2}})(?:st|nd|rd|th)?\s+(?:of\s+)?{_en_month_pattern}\b", text)
+    if match:
+        month, day = _en_months[match.group(2)], int(match.group(1))
+        date = _valid_date(_past_year(now, month, day, year_offset), month, day)
+        return _day(date) if date else None
+
+    # 只有月份
+    month = None
+    match = re.search(rf"(?<![0-9零〇一二两三四五六七八九十])({_cn_num})月(?!前|份前)", text)
+    if match and "个月" not in text[match.start():match.end() + 1]:
+        month = _to_int(match.group(1))
+    if month is None:
+        match = re.search(rf"\b(?:in|during|last|this|since)\s+{_en_month_pattern}\b", text) or \
+            re.search(rf"\b{_en_month_pattern}\b", text)
+        if match:
+            month = _en_months[match.group(1)]
+        elif re.search(r"\b(?:in|during|last|this) may\b", text):
+            month = 5
+    if month is None or not 1 <= month <= 12:
+        return None
+    year = now.year + year_offset if year_offset is not None else (now.year if month <= now.month else now.year - 1)
+    return _month(year, month)
+
+
+def _shift_year(date: datetime, year_offset: Optional[int]) -> datetime:
+    """
+    一年前的今天、去年的昨天等，2月29日在平年取2月28日
+    """
+    if not year_offset:
+        return date
+    return _valid_date(date.year + year_offset, date.month, date.day) or datetime(date.year + year_offset, date.month, 28)
+
+
+def _parse_relative_day(text: str, now: datetime, year_offset: Optional[int]):
+    if re.search(r"大前天", text):
+        days = 3
+    elif re.search(r"前天|day before yesterday", text):
+        days = 2
+    elif re.search(r"昨天|昨晚|昨日|yesterday|last night", text):
+        days = 1
+    elif re.search(r"今天|今晚|今早|\btoday\b|\btonight\b|this (?:morning|afternoon|evening)", text):
+        days = 0
+    else:
+        match = re.search(rf"\b({_en_num}) days? ago\b", text) or re.search(rf"({_cn_num})天(?:以)?前", text)
+        if match is None:
+            return None
+        days = _to_int(match.group(1))
+    return _day(_shift_year(now - timedelta(days=days), year_offset))
+
+
+def _parse_weekday(text: str, now: datetime, year_offset: Optional[int]):
+    match = re.search(r"\b(?:(last|this|on|past)\s+)?(monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b", text)
+    if match:
+        weekday = _en_weekdays[match.group(2)]
+        if match.group(1) == "last":
+            # last X: 今天之前最近的一个X，周日说 last friday 指两天前
+            return _day(now - timedelta(days=(now.weekday() - weekday - 1) % 7 + 1))
+        # 最近一次已经过去的那一天(包括今天)
+        return _day(now - timedelta(days=(now.weekday() - weekday) % 7))
+    match = re.search(r"(上|这|本)?(?:个)?(?:周|星期|礼拜)([一二三四五六日天])", text)
+    if match is None:
+        return None
+    weekday = _cn_weekdays[match.group(2)]
+    if match.group(1) == "上":
+        # 上周X: 上一个自然周中的那一天
+        monday = now - timedelta(days=now.weekday() + 7)
+        return _day(monday + timedelta(days=weekday))
+    return _day(now - timedelta(days=(now.weekday() - weekday) % 7))
+
+
+def _parse_relative_week(text: str, now: datetime, year_offset: Optional[int]):
+    if re.search(r"上上周|上上个?(?:星期|礼拜)|week before last", text):
+        return TimeAccuracy_week, (now - timedelta(days=14)).strftime("%Y-%m-%d")
+    if re.search(r"上周|上个?(?:星期|礼拜)|last week(?:end)?|past week", text):
+        return TimeAccuracy_week, (now - timedelta(days=7)).strftime("%Y-%m-%d")
+    if re.search(r"这周|本周|这个?(?:星期|礼拜)|this week(?:end)?", text):
+        return TimeAccuracy_week, now.strftime("%Y-%m-%d")
+    match = re.search(rf"\b({_en_num}) weeks? ago\b", text) or re.search(rf"({_cn_num})(?:个)?(?:周|星期|礼拜)(?:以)?前", text)
+    if match:
+        return TimeAccuracy_week, (now - timedelta(days=7 * _to_int(match.group(1)))).strftime("%Y-%m-%d")
+    return None
+
+
+def _parse_relative_month(text: str, now: datetime, year_offset: Optional[int]):
+    if re.search(r"上上个月", text):
+        return _month(*_shift_month(now, 2))
+    if re.search(r"上个?月|last month|past month", text):
+        return _month(*_shift_month(now, 1))
+    if re.search(r"这个月|本月|this month", text):
+        return _month(now.year, now.month)
+    match = re.search(rf"\b({_en_num}) months? ago\b", text) or re.search(rf"({_cn_num})个月(?:以)?前", text)
+    if match:
+        return _month(*_shift_month(now, _to_int(match.group(1))))
+    return None
@@ -0,0 +1,137 @@
+import bisect
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+# 数值越小越优先
+WarmupPriority_interactive = 0  # 用户已经在对话，RAG 正在等待
+WarmupPriority_prefetch = 1  # 进入会话时预加载，第一条消息之前完成
+WarmupPriority_backfill = 2  # 批量预热等后台任务
+
+WarmupPool_default_workers = 8
+# 耗时直方图的桶上界，单位秒
+Warmup_histogram_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class _Histogram:
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def to_dict(self) -> Dict:
+        labels = [f"<={bucket}" for bucket in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.count,
+            "avg": self.total / self.count if self.count > 0 else 0,
+        }
+
+
+class WarmupPool:
+    """
+    长期记忆实体加载的有界线程池，按优先级出队，同一个 key 只排队一次
+    已经在排队的 key 以更高优先级再次提交时提升优先级
+    """
+
+    def __init__(self, name: str, workers: int = WarmupPool_default_workers):
+        self.name = name
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[int, int, str]] = []
+        self._seq = itertools.count()
+        # key -> (当前优先级, 任务, 入队时间)
+        self._pending: Dict[str, Tuple[int, Callable[[], None], float]] = {}
+        self._running = 0
+        self.queue_wait = _Histogram(Warmup_histogram_buckets)
+        self.load_time = _Histogram(Warmup_histogram_buckets)
+        self.failed = 0
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"{name}-warmup-{i}", daemon=True).start()
+
+    def submit(self, key: str, task: Callable[[], None], priority: int = WarmupPriority_interactive) -> bool:
+        """
+        :return: 是否新加入队列，已经在排队时只可能提升优先级
+        """
+        with self._cond:
+            if key in self._pending:
+                self._promote_locked(key, priority)
+                return False
+            self._pending[key] = (priority, task, time.time())
+            heapq.heappush(self._heap, (priority, next(self._seq), key))
+            self._cond.notify()
+            return True
+
+    def promote(self, key: str, priority: int):
+        with self._cond:
+            self._promote_locked(key, priority)
+
+    def _promote_locked(self, key: str, priority: int):
+        pending = self._pending.get(key, None)
+        if pending is not None and priority < pending[0]:
+            self._pending[key] = (priority, pending[1], pending[2])
+            heapq.heappush(self._heap, (priority, next(self._seq), key))
+            self._cond.notify()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            depth: Dict[int, int] = {}
+            for priority, _, _ in self._pending.values():
+                depth[priority] = depth.get(priority, 0) + 1
+            return {
+                "queue_depth": len(self._pending),
+                "queue_depth_by_priority": depth,
+                "running": self._running,
+                "failed": self.failed,
+                "queue_wait": self.queue_wait.to_dict(),
+                "load_time": self.load_time.to_dict(),
+            }
+
+    def _next(self) -> Tuple[str, Callable[[], None], float]:
+        with self._cond:
+            while True:
+                while len(self._heap) == 0:
+                    self._cond.wait()
+                priority, _, key = heapq.heappop(self._heap)
+                pending = self._pending.get(key, None)
+                # 提升优先级后旧的堆元素作废
+                if pending is None or pending[0] != priority:
+                    continue
+                del self._pending[key]
+                self._running += 1
+                return key, pending[1], pending[2]
+
+    def _run(self):
+        while True:
+            key, task, enqueue_time = self._next()
+            start = time.time()
+            failed = False
+            try:
+                task()
+            except Exception as e:
+                failed = True
+                logger.error(f"[{self.name}] warmup {key} error: {e}")
+            end = time.time()
+            with self._cond:
+                self._running -= 1
+                self.queue_wait.observe(start - enqueue_time)
+                self.load_time.observe(end - start)
+                if failed:
+                    self.failed += 1
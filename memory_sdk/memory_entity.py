@@ -1,14 +1,17 @@
 import json
 import logging
+import threading
 import time
-from typing import Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 
 from common_py.client.azure_mongo import MongoDBClient
 from common_py.client.redis_client import RedisClient, RedisAIMemoryInfo
 from common_py.const.ai_attr import Entity_type_AI, Entity_type_user
 from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
-from pymongo.results import UpdateResult
 
+from memory_sdk.journal import MemoryJournal, JournalKind_memory_stash
+from memory_sdk.stash_writer import StashWriter, bulk_update_reflection
 from memory_sdk.util import seconds_to_english_readable
 
 logger = wrapper_azure_log_handler(
@@ -32,6 +35,12 @@ AI_memory_time_since_last_met_description = "time_since_last_met_description"
 AI_memory_time_duration_since_last_met = "time_duration_since_last_met"
 
 AI_memory_if_first_met = "if_first_met"
+AI_memory_version = "version"  # 每次写入记忆 hash 都要加一，读取方据此判断是否需要重新加载
+
+BulkDestroy_batch_size = 200  # 单个 redis pipeline 中的实体数
+
+NicknameResolver_capacity = 50000
+NicknameResolver_ttl = 10 * 60  # 其他进程修改昵称时，本地缓存最多延迟这么久
 
 
 class UserMemoryEntity:
@@ -66,8 +75,10 @@ class UserMemoryEntity:
         self.if_first_met_tag = False
 
         self.ideal_level = ''
+        self.version: Optional[int] = None  # 上次加载时 hash 的版本
 
         self.current_stash: dict = {}  # 本次对话的暂存
+        self.stash_journal_ids: List[int] = []  # current_stash 对应的本地日志记录
         self.load_memory()
 
     def load_memory(self):
@@ -84,7 +95,10 @@ class UserMemoryEntity:
                 return
             # assure the result is a Dict[str, str]
             del result['_id']
+            # mongo 中的版本号可能已经过期，回填 redis 之后重新加一，其他进程据此发现 hash 被重新填充
+            result.pop(AI_memory_version, None)
             self.redis_client.hset(self.redis_key, result)
+            result[AI_memory_version] = self.redis_client.hincrby(self.redis_key, AI_memory_version, 1)
         else:
             result = {k.decode(): v.decode() for k, v in result.items()}
 
@@ -92,8 +106,8 @@ class UserMemoryEntity:
         self.target_nickname = result.get(AI_memory_target_nickname, '')
 
         self.last_met_timestamp = int(result.get(AI_memory_last_met_timestamp, time.time()))
-        self.time_duration_since_last_met = int(time.time()) - self.last_met_timestamp
-        self.time_since_last_met_description = seconds_to_english_readable(self.time_duration_since_last_met) if self.time_duration_since_last_met > 2 else 'just now'
+        self._refresh_time_since_last_met()
+        self.version = int(result.get(AI_memory_version, 0))
         self.ideal_level = result.get(AI_memory_ideal_level, '')
         self.topic_mentioned_last_time = result.get(AI_memory_topic_mentioned_last_time, None)
         self.intimacy_point = result.get(AI_memory_intimacy_point, 0)
@@ -103,6 +117,32 @@ class UserMemoryEntity:
         if first_met == 'first_met':
             self.if_first_met_tag = True
 
+    def reload_if_changed(self) -> bool:
+        """
+        只读取 hash 的版本号，版本变化时才重新加载整个 hash
+        :return: 是否重新加载
+        """
+        version = self.redis_client.hget(self.redis_key, AI_memory_version)
+        if version is not None and self.version is not None and int(version) == self.version:
+            self._refresh_time_since_last_met()
+            return False
+        self.load_memory()
+        return True
+
+    def _advance_version(self, version):
+        """
+        本实体自己的写入让 hash 的版本加一，本地状态已经是最新的，不需要重新加载
+        版本跳过了中间值说明期间有其他写入，保持原版本，下次 reload_if_changed 时重新加载
+        """
+        if version is None or self.version is None:
+            return
+        if int(version) == self.version + 1:
+            self.version = int(version)
+
+    def _refresh_time_since_last_met(self):
+        self.time_duration_since_last_met = int(time.time()) - self.last_met_timestamp
+        self.time_since_last_met_description = seconds_to_english_readable(self.time_duration_since_last_met) if self.time_duration_since_last_met > 2 else 'just now'
+
     def get_target_name(self):
         return self.target_nickname
 
@@ -110,6 +150,7 @@ class UserMemoryEntity:
         self.target_nickname = name
         self._element_stash(AI_memory_target_nickname, name)
         self.save_stash()
+        NicknameResolver().invalidate(self.AID, self.target_id)
 
     def set_user_language(self, language_code: str):
         self.user_language = language_code
@@ -131,16 +172,21 @@ class UserMemoryEntity:
         return int(self.intimacy_point if self.intimacy_point != '' else 0)
 
     def add_intimacy_point(self, amount: int) -> int:
-        new_intimacy_point = self.redis_client.hincrby(self.redis_key, AI_memory_intimacy_point, amount)
+        pipeline = self.redis_client.pipeline()
+        pipeline.hincrby(self.redis_key, AI_memory_intimacy_point, amount)
+        pipeline.hincrby(self.redis_key, AI_memory_version, 1)
+        new_intimacy_point, version = pipeline.execute()
         if not new_intimacy_point:
             return 0
         self.intimacy_point = int(new_intimacy_point)
+        self._advance_version(version)
         return self.intimacy_point
 
     def get_intimacy_level(self):
         return self.intimacy_level
 
     def set_intimacy_level(self, level: str):
+        self.intimacy_level = level
         self._element_stash(AI_memory_intimacy_level, level)
         self.save_stash()
 
@@ -168,6 +214,17 @@ class UserMemoryEntity:
 
     def _element_stash(self, key: str, value: str):
         self.current_stash[key] = value
+        self.stash_journal_ids.append(MemoryJournal().append(JournalKind_memory_stash, {
+            "AID": self.AID,
+            "target_id": self.target_id,
+            "target_type": self.target_type,
+            "key": key,
+            "value": value,
+        }))
+
+    def _ack_stash(self):
+        MemoryJournal().ack(*self.stash_journal_ids)
+        self.stash_journal_ids = []
 
     def get_dict(self):
         return {
@@ -183,47 +240,158 @@ class UserMemoryEntity:
         }
 
     def save_stash(self):
-        self.redis_client.hset(self.redis_key,
-                               self.current_stash)
-        filter = {
-            "source_id": self.AID,
-            "target_id": self.target_id,
-            "target_type": self.target_type,
-        }
-        res: UpdateResult = self.mongo_client.update_many_document("AI_memory_reflection", filter, {'$set': self.current_stash}, False)
-        logger.info(f"save stash result: {res.raw_result}, content: {self.current_stash}")
+        """
+        redis 立即写入，mongo 由 StashWriter 合并后批量写入，日志记录在 mongo 写入成功后 ack
+        """
+        if len(self.current_stash) == 0:
+            return
+        version = StashWriter().write(self.redis_key, (self.AID, self.target_id, self.target_type),
+                                      self.current_stash, self.stash_journal_ids)
+        self._advance_version(version)
+        logger.info(f"save stash content: {self.current_stash}")
         self.current_stash = {}
+        self.stash_journal_ids = []
 
     def on_destroy(self):
         """
         与AI见面后的固定记忆刷新
         """
         try:
-            self._element_stash(AI_memory_last_met_timestamp, str(int(time.time())))
-            self._element_stash(AI_memory_if_first_met, 'not_first_met')
-
-            self.redis_client.hincrby(RedisAIMemoryInfo.format(source_id=self.AID, target_id=self.target_id),
-                                      AI_memory_met_times, 1)
-            self.redis_client.hset(RedisAIMemoryInfo.format(source_id=self.AID, target_id=self.target_id),
-                                   self.current_stash)
-            filter = {
-                "source_id": self.AID,
-                "target_id": self.target_id,
-                "target_type": self.target_type,
-            }
-            user_entity = self.redis_client.hgetall(RedisAIMemoryInfo.format(source_id=self.AID, target_id=self.target_id))
-            # decode
-            if user_entity:
-                user_entity = {k.decode(): v.decode() for k, v in user_entity.items()}
-                user_entity.update(filter)
-                partition_key = f"{self.AID}-{self.target_id}"
-                user_entity['_partition_key'] = partition_key
+            self._prepare_destroy()
+            self.redis_client.hincrby(self.redis_key, AI_memory_met_times, 1)
+            self.redis_client.hset(self.redis_key, self.current_stash)
+            self._advance_version(self.redis_client.hincrby(self.redis_key, AI_memory_version, 1))
+            reflection = self._reflection_document(self.redis_client.hgetall(self.redis_key))
+            if reflection is not None:
+                filter, user_entity = reflection
                 res = self.mongo_client.update_many_document("AI_memory_reflection", filter, {'$set': user_entity}, True)
                 logger.info(f"create AI_memory_reflection {res.raw_result}, {json.dumps(filter)}")
             self.current_stash = {}
+            self._ack_stash()
+        except Exception as e:
+            logger.exception(e)
+
+    def _prepare_destroy(self):
+        self._element_stash(AI_memory_last_met_timestamp, str(int(time.time())))
+        self._element_stash(AI_memory_if_first_met, 'not_first_met')
+
+    def _reflection_document(self, user_entity: dict) -> Optional[Tuple[dict, dict]]:
+        """
+        把 redis 中的记忆 hash 转换成 AI_memory_reflection 的 upsert 内容
+        """
+        if not user_entity:
+            return None
+        filter = {
+            "source_id": self.AID,
+            "target_id": self.target_id,
+            "target_type": self.target_type,
+        }
+        # decode
+        user_entity = {k.decode(): v.decode() for k, v in user_entity.items()}
+        # 版本号只在 redis 中有意义，不写入 mongo
+        user_entity.pop(AI_memory_version, None)
+        user_entity.update(filter)
+        partition_key = f"{self.AID}-{self.target_id}"
+        user_entity['_partition_key'] = partition_key
+        return filter, user_entity
+
+
+def bulk_destroy_memory_entities(entities: List[UserMemoryEntity]):
+    """
+    批量执行 UserMemoryEntity.on_destroy，结果与逐个执行相同
+    所有实体的 hincrby / hset / hincrby version / hgetall 在一个 redis pipeline 中完成，upsert 通过一次 bulk_write 写入 mongo
+    """
+    for start in range(0, len(entities), BulkDestroy_batch_size):
+        batch = entities[start:start + BulkDestroy_batch_size]
+        try:
+            for entity in batch:
+                entity._prepare_destroy()
+            pipeline = RedisClient().pipeline()
+            for entity in batch:
+                pipeline.hincrby(entity.redis_key, AI_memory_met_times, 1)
+                pipeline.hset(entity.redis_key, mapping=entity.current_stash)
+                pipeline.hincrby(entity.redis_key, AI_memory_version, 1)
+                pipeline.hgetall(entity.redis_key)
+            res = pipeline.execute()
+            reflections = []
+            for i, entity in enumerate(batch):
+                entity._advance_version(res[4 * i + 2])
+                reflection = entity._reflection_document(res[4 * i + 3])
+                if reflection is not None:
+                    reflections.append(reflection)
+            bulk_update_reflection(MongoDBClient(), reflections, True)
+            logger.info(f"bulk create AI_memory_reflection, entities: {len(batch)}, upserts: {len(reflections)}")
+            for entity in batch:
+                entity.current_stash = {}
+                entity._ack_stash()
         except Exception as e:
             logger.exception(e)
 
+
+class NicknameResolver:
+    """
+    进程级的昵称缓存，(AID, UID) -> AI对这个人的称呼，空字符串表示没有设置昵称
+    替代在热路径上为每个参与者创建 UserMemoryEntity，未命中的 UID 在一次 redis pipeline 中批量读取
+    """
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        if not hasattr(self, "_ready"):
+            NicknameResolver._ready = True
+            self.redis_client = RedisClient()
+            self._cache: OrderedDict = OrderedDict()
+            self._lock = threading.Lock()
+
+    def resolve_many(self, AID: str, uid_lst: List[str]) -> Dict[str, str]:
+        result: Dict[str, str] = {}
+        missing: List[str] = []
+        now = time.time()
+        with self._lock:
+            for uid in uid_lst:
+                item = self._cache.get((AID, uid), None)
+                if item is None or item[0] < now:
+                    missing.append(uid)
+                    continue
+                self._cache.move_to_end((AID, uid))
+                result[uid] = item[1]
+        if len(missing) == 0:
+            return result
+
+        pipeline = self.redis_client.pipeline()
+        for uid in missing:
+            redis_key = RedisAIMemoryInfo.format(source_id=AID, target_id=uid)
+            pipeline.exists(redis_key)
+            pipeline.hget(redis_key, AI_memory_target_nickname)
+        res = pipeline.execute()
+        for i, uid in enumerate(missing):
+            exists, nickname = res[2 * i], res[2 * i + 1]
+            if exists:
+                nickname = nickname.decode() if isinstance(nickname, bytes) else (nickname or '')
+            else:
+                # redis 中没有记忆时走原来的加载逻辑，从 mongo 读取并回写 redis
+                nickname = UserMemoryEntity(AID, uid, Entity_type_user).target_nickname
+            result[uid] = nickname
+            self._put(AID, uid, nickname)
+        return result
+
+    def invalidate(self, AID: str, uid: str):
+        with self._lock:
+            self._cache.pop((AID, uid), None)
+
+    def _put(self, AID: str, uid: str, nickname: str):
+        with self._lock:
+            self._cache[(AID, uid)] = (time.time() + NicknameResolver_ttl, nickname)
+            self._cache.move_to_end((AID, uid))
+            while len(self._cache) > NicknameResolver_capacity:
+                self._cache.popitem(last=False)
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(NicknameResolver, "_instance"):
+            with NicknameResolver._instance_lock:
+                if not hasattr(NicknameResolver, "_instance"):
+                    NicknameResolver._instance = object.__new__(cls)
+        return NicknameResolver._instance
+
 # if __name__ == '__main__':
 #     ad = {
 #         "a": "2",
@@ -1,9 +1,11 @@
 import threading
-import time
+import uuid
 from typing import List, Type
 from common_py.ai_toolkit.openAI import Message
 from common_py.model.base import BaseEvent
+from memory_sdk.event_buffer import EventRingBuffer
 from memory_sdk.hippocampus import HippocampusMgr
+from memory_sdk.idle_scheduler import IdleScheduler
 import logging
 from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
 
@@ -18,15 +20,27 @@ EventType_conversation = "conversation"
 EventType_scene_event = 'scene_event'
 EventType_say_hello = "say_hello"  # deprecated
 
+# 本地事件缓冲区容量，超出后未压缩的老事件会先落到 block manager 再被覆盖
+LocalEventBuffer_capacity = 512
+# 最后一次对话之后多久没有新对话视为空闲，单位秒
+Idle_timeout_seconds = 60
+
 
 class MemoryManager:
 
     def __init__(self, AID: str, close_signal: threading.Event):
-        self.hippocampus = HippocampusMgr().get_hippocampus(AID)
-        self.local_event_buffer: List[BaseEvent] = []
+        self.AID = AID
+        # 会话持有期间海马体不会被淘汰，close 时释放
+        self.hippocampus = HippocampusMgr().open_session(AID)
+        self.local_event_buffer: EventRingBuffer = EventRingBuffer(LocalEventBuffer_capacity)
 
-        # 用于记录zip_context_memory的索引
+        # 用于记录zip_context_memory的索引，记录的是事件序号而不是缓冲区下标
         self.zip_index: int = -1
+        # zip_index 之后的对话事件数量，随 add_event 增量维护
+        self.unzipped_conversation_count: int = 0
+        self._zip_lock = threading.Lock()
+        self._idle_key = f"{AID}_{uuid.uuid4()}"
+        self._closed = False
         self.close_event: threading.Event = close_signal
         # self.system_prompt_key: str = "system_prompt"
         # self.local_chat_buffer_key: str = "chat_history"
@@ -35,7 +49,17 @@ class MemoryManager:
     def add_event(self, event: BaseEvent):
         if not isinstance(event, BaseEvent):
             raise Exception(f"event {event} is not a BaseEvent")
-        self.local_event_buffer.append(event)
+        with self._zip_lock:
+            if self.local_event_buffer.is_full() and self.local_event_buffer.first_seq() > self.zip_index:
+                # 即将覆盖尚未压缩的事件，先把未压缩的部分交给 block manager
+                spill_events = self._cut_unzipped()
+                IdleScheduler().submit(self.hippocampus.create_mem_block, spill_events)
+            self.local_event_buffer.append(event)
+            if event.event_source == EventType_conversation:
+                self.unzipped_conversation_count += 1
+        if event.event_source == EventType_conversation and not self._closed:
+            # 最后一次对话一分钟后仍没有新的对话，视为空闲
+            IdleScheduler().touch(self._idle_key, int(event.occur_time) + Idle_timeout_seconds, self._on_idle)
         # if isinstance(event, ConversationEvent):
         #     if event.role == 'user':
         #         self.local_chat_buffer.append(Message(role='user', content=event.message))
@@ -47,56 +71,66 @@ class MemoryManager:
         #     self.local_chat_buffer.append(Message(role='system', content=event.message))
 
     def get_message_list(self, count: int = 15) -> List[Message]:
-        if len(self.local_event_buffer) < count:
-            return [e.get_message_from_event() for e in self.local_event_buffer]
-        else:
-            return [e.get_message_from_event() for e in self.local_event_buffer[-count:]]
+        return [e.get_message_from_event() for e in self.local_event_buffer.last(count)]
 
     def get_event_list(self, target_type: Type[BaseEvent], count: int = 15) -> List[BaseEvent]:
         # get the last count events of target_type
-        if len(self.local_event_buffer) < count:
-            return [e for e in self.local_event_buffer if isinstance(e, target_type)]
-        else:
-            target_event_lst = []
-            for e in self.local_event_buffer[::-1]:
-                if isinstance(e, target_type):
-                    target_event_lst.append(e)
-                    if len(target_event_lst) >= count:
-                        break
-            target_event_lst.reverse()
-            return target_event_lst
+        return self.local_event_buffer.last_of_type(target_type, count)
 
-    def zip_context_memory(self):
+    def _cut_unzipped(self) -> List[BaseEvent]:
+        """
+        截取 zip_index 之后的全部事件并推进 zip_index，调用方需持有 _zip_lock
+        """
+        unzipped_events = self.local_event_buffer.slice_from(self.zip_index + 1)
+        self.zip_index = self.local_event_buffer.last_seq()
+        self.unzipped_conversation_count = 0
+        return unzipped_events
+
+    def _on_idle(self):
+        """
+        IdleScheduler 到期回调，在共享线程池中执行
+        """
+        if self.close_event.is_set():
+            self.close()
+            return
+        with self._zip_lock:
+            # 双重条件，当连续一分钟没有产生对话，并且连续的对话超过10句时，才作为一个block缓存
+            if self.unzipped_conversation_count <= 10:
+                return
+            unzipped_events = self._cut_unzipped()
+        self.hippocampus.create_mem_block(unzipped_events)
+
+    def close(self):
+        """
+        会话结束，取消空闲检测并把剩余的对话总结成block，由会话的持有方在结束时调用
+        完成后设置 close_event，等待会话结束的调用方以此为准
+        """
         try:
-            while True:
-                if self.close_event.is_set():
-                    if len(list(
-                            filter(lambda x: x.event_source == "conversation",
-                                   self.local_event_buffer[self.zip_index + 1:]))) >= 4:
-                        self.hippocampus.create_mem_block(self.local_event_buffer[self.zip_index + 1:])
+            with self._zip_lock:
+                if self._closed:
                     return
-                time.sleep(5)
-                # 倒序遍历 local_event_buffer，查看最后一次会话的发生时间，如果是在一分钟前，就截断这个区间的数据，总结成一个block
-                buffer_length = len(self.local_event_buffer)
-                for idx in range(buffer_length - 1, self.zip_index, -1):
-                    event = self.local_event_buffer[idx]
-                    if event.event_source != "conversation":
-                        continue
-                    # summary and send to pinecone then clear local_event_buffer
-                    if int(time.time()) - int(event.occur_time) > 60:
-                        # 双重条件，当连续一分钟没有产生对话，并且连续的对话超过10句时，才作为一个block缓存
-                        if len(list(filter(lambda x: x.event_source == "conversation",
-                                           self.local_event_buffer[self.zip_index + 1:]))) > 10:
-                            self.hippocampus.create_mem_block(self.local_event_buffer[self.zip_index + 1:])
-                            self.zip_index = buffer_length - 1
-                    break
+                self._closed = True
+                conversation_count = self.unzipped_conversation_count
+                unzipped_events = self._cut_unzipped()
+            IdleScheduler().cancel(self._idle_key)
+            try:
+                if conversation_count >= 4:
+                    self.hippocampus.create_mem_block(unzipped_events)
+            finally:
+                HippocampusMgr().close_session(self.AID)
         except Exception as e:
             logger.exception(e)
-            return
         finally:
-            logger.debug(f"zip context memory task has been stopped.")
             self.close_event.set()
 
+    def zip_context_memory(self):
+        """
+        兼容旧的调用方式，立即返回。空闲检测交给进程级的 IdleScheduler，会话结束时调用 close，
+        不再有线程阻塞或轮询 close_event；只设置了 close_event 的会话在下一次空闲到期时关闭
+        """
+        if self.close_event.is_set():
+            IdleScheduler().submit(self.close)
+
     # def _data_collector(self, speaker_id: str, speak_content: str) -> Dict[str, Any]:
     #     """Collect data from inputs."""
     #
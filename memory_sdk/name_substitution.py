@@ -0,0 +1,65 @@
+import re
+from typing import Dict, List, Pattern, Set, Tuple
+
+_placeholder_pattern = re.compile(r"\{([^{}]+)\}")
+
+
+class NameSubstitution:
+    """
+    把 summary 中的说话人名字替换成 {UID} 占位符，替代 const.change_name_to_id 的 LLM 改写
+
+    - 每个 block 构建一次正则自动机，所有名字在一次扫描中完成替换
+    - 名字按长度倒序进入候选，重叠的名字(如 "Ann" 和 "Ann Lee")优先匹配更长的
+    - 忽略大小写，所有格 "Allen's" 只替换名字部分，得到 "{UID}'s"
+    - 拉丁字符名字要求单词边界，避免 "Al" 命中 "Allen"；中日韩等名字不存在空格分词，不做边界限制
+    """
+
+    def __init__(self, name_to_id: Dict[str, str]):
+        self.name_to_id: Dict[str, str] = {}
+        self.origin_name: Dict[str, str] = {}
+        for name, uid in name_to_id.items():
+            if name and name.strip():
+                key = name.strip().lower()
+                self.name_to_id[key] = uid
+                self.origin_name[key] = name
+        self.pattern: Pattern = self._compile()
+
+    def _compile(self) -> Pattern:
+        names = sorted(self.name_to_id.keys(), key=len, reverse=True)
+        alternatives = []
+        for name in names:
+            escaped = re.escape(name)
+            if _need_word_boundary(name):
+                alternatives.append(rf"(?<!\w){escaped}(?!\w)")
+            else:
+                alternatives.append(escaped)
+        if len(alternatives) == 0:
+            # 永远不会匹配的正则
+            return re.compile(r"(?!x)x")
+        return re.compile("|".join(alternatives), re.IGNORECASE)
+
+    def substitute(self, text: str) -> Tuple[str, List[str]]:
+        """
+        :return: 替换后的文本，以及在文本中没有找到的名字
+        """
+        resolved: Set[str] = set()
+
+        def _replace(match: re.Match) -> str:
+            key = match.group(0).lower()
+            resolved.add(key)
+            return f"{{{self.name_to_id[key]}}}"
+
+        replaced = self.pattern.sub(_replace, text)
+        unresolved = [self.origin_name[key] for key in self.name_to_id if key not in resolved]
+        return replaced, unresolved
+
+
+def _need_word_boundary(name: str) -> bool:
+    return all(ord(c) < 0x2E80 for c in name)
+
+
+def fill_placeholders(text: str, id_to_name: Dict[str, str]) -> str:
+    """
+    NameSubstitution 的逆过程，一次扫描把所有 {UID} 占位符替换成名字，未知的占位符保持原样
+    """
+    return _placeholder_pattern.sub(lambda match: id_to_name.get(match.group(1), match.group(0)), text)
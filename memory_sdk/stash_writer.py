@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from common_py.client.azure_mongo import MongoDBClient
+from common_py.client.redis_client import RedisClient
+from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
+from pymongo import UpdateOne
+
+from memory_sdk.journal import MemoryJournal
+
+logger = wrapper_azure_log_handler(
+    wrapper_std_output(
+        logging.getLogger(__name__)
+    )
+)
+
+StashWriter_window = 1.0  # 合并窗口，单位秒
+StashWriter_batch_size = 500  # 单次 bulk_write 的最大操作数
+StashWriter_version_field = "version"  # 与 memory_entity.AI_memory_version 相同
+
+# 逐个更新的降级路径只记录一次告警
+_bulk_fallback_logged = False
+
+# (AID, target_id, target_type)
+StashKey = Tuple[str, str, str]
+
+
+class StashWriter:
+    """
+    UserMemoryEntity.save_stash 的合并写入器
+    redis 在调用时用 pipeline 立即写入，保证读到的是最新值；
+    mongo 按 (AID, target) 合并一个窗口内的字段，所有实体的更新攒成一批 UpdateOne 通过 bulk_write 写入
+    """
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        if not hasattr(self, "_ready"):
+            StashWriter._ready = True
+            self.redis_client = RedisClient()
+            self.mongo_client = MongoDBClient()
+            self._lock = threading.Lock()
+            self._flush_lock = threading.Lock()
+            self._pending: Dict[StashKey, Dict] = {}
+            self._journal_ids: Dict[StashKey, List[int]] = {}
+            self.counters: Dict[str, int] = {
+                "save_count": 0,  # save_stash 调用次数
+                "coalesced_count": 0,  # 合并进已有待写入实体的次数
+                "redis_write_count": 0,
+                "mongo_op_count": 0,  # 实际写入 mongo 的 UpdateOne 数
+                "mongo_batch_count": 0,
+                "mongo_failed_count": 0,
+                "max_batch_size": 0,
+                "last_batch_size": 0,
+            }
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def write(self, redis_key: str, key: StashKey, fields: Dict, journal_ids: List[int]) -> int:
+        """
+        :return: 写入后 hash 的版本号
+        """
+        pipeline = self.redis_client.pipeline()
+        pipeline.hset(redis_key, mapping=fields)
+        pipeline.hincrby(redis_key, StashWriter_version_field, 1)
+        version = pipeline.execute()[1]
+        with self._lock:
+            self.counters["save_count"] += 1
+            self.counters["redis_write_count"] += 1
+            if key in self._pending:
+                self.counters["coalesced_count"] += 1
+                self._pending[key].update(fields)
+            else:
+                self._pending[key] = dict(fields)
+            self._journal_ids.setdefault(key, []).extend(journal_ids)
+        return version
+
+    def flush(self):
+        """
+        立即把合并中的更新写入 mongo，后台线程按窗口调用，也可以在进程退出前手动调用
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                journal_ids, self._journal_ids = self._journal_ids, {}
+            items = list(pending.items())
+            for start in range(0, len(items), StashWriter_batch_size):
+                self._write_batch(items[start:start + StashWriter_batch_size], journal_ids)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["pending_count"] = len(self._pending)
+        return stats
+
+    def _write_batch(self, batch: List[Tuple[StashKey, Dict]], journal_ids: Dict[StashKey, List[int]]):
+        try:
+            bulk_update_reflection(self.mongo_client,
+                                   [(_reflection_filter(key), fields) for key, fields in batch], False)
+        except Exception as e:
+            with self._lock:
+                self.counters["mongo_failed_count"] += len(batch)
+            # 没有 ack 的日志记录会在重启后重放
+            logger.error(f"save stash bulk write error: {e}, keys: {[key for key, _ in batch]}")
+            return
+        with self._lock:
+            self.counters["mongo_op_count"] += len(batch)
+            self.counters["mongo_batch_count"] += 1
+            self.counters["last_batch_size"] = len(batch)
+            self.counters["max_batch_size"] = max(self.counters["max_batch_size"], len(batch))
+        for key, _ in batch:
+            MemoryJournal().ack(*journal_ids.get(key, []))
+
+    def _run(self):
+        while True:
+            time.sleep(StashWriter_window)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    def __new__(cls, *args, **kwargs):
+        if not hasattr(StashWriter, "_instance"):
+            with StashWriter._instance_lock:
+                if not hasattr(StashWriter, "_instance"):
+                    StashWriter._instance = object.__new__(cls)
+        return StashWriter._instance
+
+
+def _reflection_filter(key: StashKey) -> Dict:
+    AID, target_id, target_type = key
+    return {"source_id": AID, "target_id": target_id, "target_type": target_type}
+
+
+def bulk_update_reflection(mongo_client: MongoDBClient, items: List[Tuple[Dict, Dict]], upsert: bool):
+    """
+    一次 bulk_write 把多个 (filter, 字段) 以 $set 写入 AI_memory_reflection
+    客户端暴露 pymongo database 时使用 Collection.bulk_write，否则逐个更新
+    """
+    global _bulk_fallback_logged
+    if len(items) == 0:
+        return
+    db = getattr(mongo_client, 'db', None)
+    if db is not None:
+        operations = [UpdateOne(filter, {'$set': fields}, upsert=upsert) for filter, fields in items]
+        res = db['AI_memory_reflection'].bulk_write(operations, ordered=False)
+        logger.debug(f"AI_memory_reflection bulk write {len(operations)} ops, result: {res.bulk_api_result}")
+        return
+    if not _bulk_fallback_logged:
+        _bulk_fallback_logged = True
+        logger.warning("mongo client has no pymongo database, AI_memory_reflection falls back to per-document update")
+    for filter, fields in items:
+        mongo_client.update_many_document("AI_memory_reflection", filter, {'$set': fields}, upsert)
@@ -0,0 +1,72 @@
+import threading
+from typing import Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+StripedLock_default_stripes = 64
+
+
+class _Flight:
+    """
+    某个 key 正在进行的一次创建，其余请求等待它完成
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+
+class StripedLock:
+    """
+    按 key 的哈希分段的锁，不同 key 的创建大多落在不同的锁上，没有全局锁
+    get_or_create 提供单次创建(single-flight)语义: 同一个 key 的并发请求只有一个执行 factory，其余等待并复用结果
+    分段锁只保护容器和创建中的登记，factory 在锁外执行，落在同一段上的其他 key 不会等待它的 I/O
+    """
+
+    def __init__(self, stripes: int = StripedLock_default_stripes):
+        self._locks: List[threading.Lock] = [threading.Lock() for _ in range(stripes)]
+        # (容器 id, key) -> 正在进行的创建，读写都在对应 key 的分段锁内
+        self._flights: Dict[Tuple[int, Hashable], _Flight] = {}
+
+    def lock_for(self, key: Hashable) -> threading.Lock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    def get_or_create(self, container: Dict, key: Hashable, factory: Callable[[], V],
+                      lock_key: Optional[Hashable] = None) -> V:
+        """
+        :param lock_key: 选择锁用的 key，多个容器共用一个 StripedLock 时用来区分，默认与 key 相同
+        factory 抛出异常时，正在等待的请求收到同一个异常，之后的请求重新创建
+        """
+        # 已经存在时不加锁
+        value = container.get(key, None)
+        if value is not None:
+            return value
+        lock = self.lock_for(key if lock_key is None else lock_key)
+        flight_key = (id(container), key)
+        with lock:
+            value = container.get(key, None)
+            if value is not None:
+                return value
+            flight = self._flights.get(flight_key, None)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[flight_key] = flight
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = factory()
+        except BaseException as e:
+            flight.error = e
+        with lock:
+            if flight.error is None:
+                container[key] = flight.value
+            del self._flights[flight_key]
+        flight.done.set()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
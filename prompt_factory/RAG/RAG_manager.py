@@ -1,11 +1,11 @@
 import datetime
 import logging
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
 
 from common_py.utils.logger import wrapper_azure_log_handler, wrapper_std_output
 
-from memory_sdk.instance_memory_block.event_block import load_block_from_mongo
+from memory_sdk.instance_memory_block.event_block import EventBlock, load_blocks
 from memory_sdk.longterm_memory.long_term_mem_mgr import LongTermMemoryMgr
 from prompt_factory.RAG.env_awareness import EnvRAGMgr
 from prompt_factory.RAG.unichat_knowledge import KnowledgeMgr
@@ -16,6 +16,27 @@ logger = wrapper_azure_log_handler(
     )
 )
 
+# 时间相关的召回，时间表达先走本地规则解析，只有规则无法确定时才调用LLM
+TimeRelevantQuery_enabled = True
+# 长期记忆还在加载时最多等待的时间，单位秒，快加载完的实体不至于没有召回
+LongTermMemory_wait_ready_timeout = 0.3
+
+
+def _format_block_summaries(block_names: List[str], blocks: Dict[str, EventBlock]) -> List[str]:
+    """
+    :param blocks: 调用方一次 load_blocks 得到的 block name -> block
+    """
+    summary_lst = []
+    for block_name in block_names:
+        block = blocks.get(block_name, None)
+        if block is None:
+            continue
+        formatted_time = 'unknown'
+        if block.create_timestamp > 0:
+            formatted_time = datetime.datetime.fromtimestamp(block.create_timestamp).strftime('%Y-%m-%d')
+        summary_lst.append(f"Conversation happened in {formatted_time}: \n {block.get_summary()}")
+    return summary_lst
+
 
 class RAGMgr:
     _instance_lock = threading.Lock()
@@ -30,50 +51,26 @@ class RAGMgr:
         try:
             # 这里内部只有一个io操作，可以先串行
             entity = LongTermMemoryMgr().get_long_term_mem_entity(AID, UID)
+            entity.wait_ready(LongTermMemory_wait_ready_timeout)
             topic_relevant_block_lst = entity.get_block_name_by_text_input(input_message, count=2)
-            # 全量过llm太慢了，优化之后再上，优化方案可以首先过一遍预设的vector db
-            # time_relevant_block_lst = entity.time_relevant_query(input_message, count=2)
-
-            topic_task_lst = []
-            time_task_lst = []
-            with ThreadPoolExecutor(max_workers=4) as executor:
-                def get_summary_by_block_name(_block_name: str) -> (str, str):
-                    block = load_block_from_mongo(_block_name)
-                    if not block:
-                        return ''
-                    formatted_time = 'unknown'
-                    block_create_time = block.create_timestamp
-                    if block_create_time > 0:
-                        formatted_time = datetime.datetime.fromtimestamp(block_create_time).strftime('%Y-%m-%d')
-                    return block.get_summary(), formatted_time
-
-                for block_name in topic_relevant_block_lst:
-                    topic_task_lst.append(executor.submit(get_summary_by_block_name, block_name))
-                # for block_name in time_relevant_block_lst:
-                #     time_task_lst.append(executor.submit(get_summary_by_block_name, block_name))
+            time_relevant_block_lst = []
+            if TimeRelevantQuery_enabled:
+                time_relevant_block_lst = [name for name in entity.time_relevant_query(input_message, count=2)
+                                           if name not in topic_relevant_block_lst]
+            # 话题和时间召回的 block 一次 $in 查询读取
+            blocks = load_blocks(topic_relevant_block_lst + time_relevant_block_lst)
 
-            RAG_result = ''
             topic_summary = ''
-            if len(topic_task_lst) > 0:
+            if len(topic_relevant_block_lst) > 0:
                 topic_summary = "### Historical conversation data related to the current topic \n "
-                summary_lst = []
-                for summary_task in topic_task_lst:
-                    summary, formatted_time = summary_task.result()
-                    formatted_summary = f"Conversation happened in {formatted_time}: \n {summary}"
-                    summary_lst.append(formatted_summary)
-                topic_summary += '\n'.join(summary_lst)
-
+                topic_summary += '\n'.join(_format_block_summaries(topic_relevant_block_lst, blocks))
 
             time_relevant_summary = ''
-            if len(time_task_lst) > 0:
+            if len(time_relevant_block_lst) > 0:
                 time_relevant_summary = "### Memories related to times mentioned in conversations \n "
-                summary_lst = []
-                for summary_task in topic_task_lst:
-                    summary, formatted_time = summary_task.result()
-                    formatted_summary = f"Conversation happened in {formatted_time}: \n {summary}"
-                    summary_lst.append(formatted_summary)
-                time_relevant_summary += '\n'.join(summary_lst)
+                time_relevant_summary += '\n'.join(_format_block_summaries(time_relevant_block_lst, blocks))
 
+            RAG_result = ''
             env_str = self.env_mgr.env_getter(input_message, channel_name)
             knowledge_str = self.knowledge_mgr.query(input_message)
 
@@ -85,6 +82,8 @@ class RAGMgr:
                 RAG_result += env_str + '\n'
             if knowledge_str:
                 RAG_result += knowledge_str + '\n'
+            if time_relevant_summary:
+                return topic_summary + '\n' + time_relevant_summary if topic_summary else time_relevant_summary
             return topic_summary
         except Exception as e:
             logger.exception(e)
@@ -93,7 +93,12 @@ class EnvRAGMgr:
     def _register_getter(self, info_getter: BaseInfoGetter):
         getter_name = info_getter.__class__.__name__
         self._getter_dict[getter_name] = info_getter
+        # 已经写入过的语料不再重复写入，避免每次启动都重新embedding
+        exist_corpus = set(item.meta.get("corpus_text", "") for item in
+                           self._env_getter_vector_collection.get(where={"getter_name": getter_name}))
         for corpus_text in info_getter.corpus_text:
+            if corpus_text in exist_corpus:
+                continue
             self._env_getter_vector_collection.upsert_many([VectorRecordItem(
                 id=str(uuid.uuid4()),
                 documents=corpus_text,
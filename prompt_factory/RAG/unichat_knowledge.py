@@ -1,6 +1,5 @@
 import logging
 import threading
-import uuid
 from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
 from typing import List
@@ -44,22 +43,29 @@ class KnowledgeMgr:
             check_sum = md5(raw_data.encode()).hexdigest()
             if check_sum == self.check_sum:
                 return
+            # 记录id由内容哈希生成，未变化的知识块不重新写入，也就不会被重新embedding
+            new_items = {}
+            for item in knowledge_block:
+                new_items[md5(item.encode()).hexdigest()] = item
             query_results = self.knowledge_vector_collection.get(where={})
-            if len(query_results) > 0:
-
-                all_ids = [item.id for item in query_results]
-                self.knowledge_vector_collection.delete(ids=all_ids)
+            exist_ids = set(item.id for item in query_results)
+            stale_ids = [item_id for item_id in exist_ids if item_id not in new_items]
+            if len(stale_ids) > 0:
+                self.knowledge_vector_collection.delete(ids=stale_ids)
 
             items = []
-            for item in knowledge_block:
+            for item_id, item in new_items.items():
+                if item_id in exist_ids:
+                    continue
                 items.append(VectorRecordItem(
-                    id=str(uuid.uuid4()),
+                    id=item_id,
                     documents=item,
                     meta={
                       "corpus_text": item,
                     }
                 ))
-            self.knowledge_vector_collection.upsert_many(items)
+            if len(items) > 0:
+                self.knowledge_vector_collection.upsert_many(items)
             self.check_sum = check_sum
         except Exception as e:
             logger.exception(f"load knowledge failed: {e}")
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("common_py")
+
+from memory_sdk import hippocampus  # noqa: E402
+from memory_sdk.hippocampus import HippocampusMgr  # noqa: E402
+
+destroyed = []
+
+
+class _FakeHippocampus:
+
+    def __init__(self, AID: str):
+        self.AID = AID
+        self.memory_entities = {}
+
+    def estimate_bytes(self) -> int:
+        return 0
+
+    def on_destroy(self):
+        destroyed.append(self.AID)
+
+
+def test_live_session_is_not_evicted(monkeypatch):
+    monkeypatch.setattr(hippocampus, "Hippocampus", _FakeHippocampus)
+    mgr = HippocampusMgr()
+    monkeypatch.setattr(mgr.eviction, "idle_ttl", -1)
+    AID = "AID_session"
+
+    hippo = mgr.open_session(AID)
+    mgr.eviction.sweep()
+    assert AID not in destroyed
+    assert mgr.get_hippocampus(AID) is hippo
+
+    # 淘汰线程已经选中之后会话才登记，也不会移除
+    mgr._evict(AID)
+    assert mgr.get_hippocampus(AID) is hippo
+
+    mgr.close_session(AID)
+    mgr.eviction.sweep()
+    assert destroyed == [AID]
+    assert AID not in mgr.hippocampus
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("common_py")
+
+from memory_sdk.embedding_cache import pack_vector  # noqa: E402
+from memory_sdk.instance_memory_block.event_block import EventBlock  # noqa: E402
+from memory_sdk.longterm_memory import long_term_mem_entity  # noqa: E402
+from memory_sdk.longterm_memory.long_term_mem_entity import ensure_index_vectors, save_index_questions  # noqa: E402
+
+_dim = 4
+embedded = []
+bulk_writes = []
+
+
+class _FakeEmbeddingCache:
+
+    def get_many(self, texts):
+        embedded.append(list(texts))
+        return [[float(len(text))] * _dim for text in texts]
+
+
+class _FakeCollection:
+
+    def bulk_write(self, operations, ordered=True):
+        bulk_writes.append(operations)
+
+
+class _FakeMongoDBClient:
+    db = {"AI_memory_block": _FakeCollection()}
+
+
+@pytest.fixture(autouse=True)
+def fake_storage(monkeypatch):
+    monkeypatch.setattr(long_term_mem_entity, "EmbeddingCache", _FakeEmbeddingCache)
+    monkeypatch.setattr(long_term_mem_entity, "MongoDBClient", _FakeMongoDBClient)
+    embedded.clear()
+    bulk_writes.clear()
+
+
+def _block(name: str, questions) -> EventBlock:
+    return EventBlock(name=name, raw_summary=f"summary of {name}", index_questions=questions)
+
+
+def test_stored_vectors_are_reused():
+    stored = _block("stored", ["q1"])
+    fresh = _block("fresh", ["q22", "q333"])
+    stored_vectors = {"stored": [pack_vector([9.0] * _dim), pack_vector([8.0] * _dim)]}
+
+    vectors = ensure_index_vectors([stored, fresh], stored_vectors)
+    # 只为没有保存向量的 block 请求一次 embedding，顺序与记录一致: 问题在前，summary 在后
+    assert embedded == [["q22", "q333", "summary of fresh"]]
+    assert vectors[:, 0].tolist() == [9.0, 8.0, 3.0, 4.0, float(len("summary of fresh"))]
+    assert len(bulk_writes) == 1 and len(bulk_writes[0]) == 1
+
+
+def test_save_index_questions_is_one_bulk_write():
+    save_index_questions([_block(f"b{i}", ["q"]) for i in range(300)] + [_block("failed", [])])
+    assert len(bulk_writes) == 1
+    assert len(bulk_writes[0]) == 300
+    assert isinstance(ensure_index_vectors([], {}), np.ndarray)
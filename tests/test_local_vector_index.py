@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("common_py")
+
+from common_py.client.chroma import VectorRecordItem  # noqa: E402
+
+from memory_sdk.longterm_memory import local_vector_index  # noqa: E402
+from memory_sdk.longterm_memory.local_vector_index import LocalVectorIndex  # noqa: E402
+
+_dim = 8
+
+
+class _FakeEmbeddingCache:
+    """
+    每段文本对应一个固定的随机向量
+    """
+
+    def get(self, text: str):
+        return self.get_many([text])[0]
+
+    def get_many(self, texts):
+        return [np.random.default_rng(abs(hash(text)) % (2 ** 32)).standard_normal(_dim).tolist() for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def fake_embedding(monkeypatch):
+    monkeypatch.setattr(local_vector_index, "EmbeddingCache", _FakeEmbeddingCache)
+
+
+def _item(name: str) -> VectorRecordItem:
+    return VectorRecordItem(id=name, meta={"create_time": 1}, documents=name)
+
+
+def _vectors_size(index: LocalVectorIndex) -> int:
+    return os.path.getsize(os.path.join(index.path, local_vector_index._vectors_file))
+
+
+def test_crash_between_vectors_and_records(tmp_path):
+    index = LocalVectorIndex("entity", root=str(tmp_path))
+    index.upsert_many([_item("a"), _item("b")])
+    # 模拟崩溃: 向量已经写入，记录没有写入
+    with open(os.path.join(index.path, local_vector_index._vectors_file), "ab") as f:
+        f.write(np.ones((3, _dim), dtype=np.float32).tobytes())
+
+    index = LocalVectorIndex("entity", root=str(tmp_path))
+    assert index.count() == 2
+    assert _vectors_size(index) == 2 * _dim * 4
+
+    index.upsert_many([_item("c")])
+    index = LocalVectorIndex("entity", root=str(tmp_path))
+    assert index.count() == 3
+    for name in ("a", "b", "c"):
+        assert index.query(name, top_k=1)[0].id == name
+
+
+def test_truncated_record_line(tmp_path):
+    index = LocalVectorIndex("entity", root=str(tmp_path))
+    index.upsert_many([_item("a"), _item("b")])
+    # 模拟崩溃: 最后一条记录只写了一半
+    records_path = os.path.join(index.path, local_vector_index._records_file)
+    with open(records_path, "rb") as f:
+        content = f.read()
+    with open(records_path, "wb") as f:
+        f.write(content[:-5])
+
+    index = LocalVectorIndex("entity", root=str(tmp_path))
+    assert [item.id for item in index.get()] == ["a"]
+    assert _vectors_size(index) == _dim * 4
+
+    index.upsert_many([_item("c")])
+    index = LocalVectorIndex("entity", root=str(tmp_path))
+    assert [item.id for item in index.get()] == ["a", "c"]
+    assert index.query("c", top_k=1)[0].id == "c"
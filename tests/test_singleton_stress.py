@@ -0,0 +1,129 @@
+"""
+记忆单例并发创建的压力测试，验证同一个 key 的并发请求只创建一次对象
+海马体、用户记忆实体、长期记忆实体都替换成本地假的慢对象，快照加载直接完成，不连接任何存储
+"""
+import random
+import threading
+import time
+from collections import Counter
+from typing import List
+
+import pytest
+
+pytest.importorskip("common_py")
+
+from memory_sdk import hippocampus  # noqa: E402
+from memory_sdk.hippocampus import HippocampusMgr  # noqa: E402
+from memory_sdk.longterm_memory import long_term_mem_mgr  # noqa: E402
+from memory_sdk.longterm_memory.long_term_mem_mgr import LongTermMemoryMgr  # noqa: E402
+
+Object_create_latency = 0.02  # 模拟对象创建时的 redis / mongo 读取耗时，单位秒
+Stress_threads = 64
+Stress_keys = 8
+Stress_users = 4
+Stress_rounds = 20
+
+created = Counter()
+_counter_lock = threading.Lock()
+
+
+def _count(name: str):
+    with _counter_lock:
+        created[name] += 1
+
+
+class _FakeHippocampus(hippocampus.Hippocampus):
+
+    def __init__(self, AID: str):
+        _count("hippocampus")
+        time.sleep(Object_create_latency)
+        self.AID = AID
+        self.memory_entities = {}
+
+
+class _FakeUserMemoryEntity:
+
+    def __init__(self, AID: str, target_id: str, target_type: str):
+        _count("memory_entity")
+        time.sleep(Object_create_latency)
+        self.AID = AID
+        self.target_id = target_id
+
+    def reload_if_changed(self) -> bool:
+        return False
+
+
+class _FakeLongTermMemoryEntity:
+
+    def __init__(self, AID: str, target_id: str):
+        _count("long_term_entity")
+        time.sleep(Object_create_latency)
+        self.AID = AID
+        self.target_id = target_id
+        self.ready = False
+        self.record_count = 0
+
+    def set_collection(self, collection):
+        pass
+
+    def set_ready(self):
+        self.ready = True
+
+
+class _FakeChromaDBManager:
+
+    def if_cloud_snapshot_exist(self, name: str) -> bool:
+        _count("long_term_loader")
+        return True
+
+    def get_collection(self, name: str, **kwargs):
+        return None
+
+
+def _worker(barrier: threading.Barrier, keys: List[str], users: List[str], rounds: int, errors: List[str]):
+    barrier.wait()
+    for _ in range(rounds):
+        AID = random.choice(keys)
+        UID = random.choice(users)
+        try:
+            hippo = HippocampusMgr().get_hippocampus(AID)
+            if hippo is None or hippo.AID != AID:
+                errors.append(f"wrong hippocampus for {AID}")
+                continue
+            entity = hippo.load_memory_of_user(UID, force_update=random.random() < 0.5)
+            if entity is None or entity.target_id != UID:
+                errors.append(f"wrong memory entity for {AID} {UID}")
+            long_term = LongTermMemoryMgr().get_long_term_mem_entity(AID, UID)
+            if long_term.AID != AID or long_term.target_id != UID:
+                errors.append(f"wrong long term entity for {AID} {UID}")
+        except Exception as e:
+            errors.append(str(e))
+
+
+def test_concurrent_creation_is_single_flight(monkeypatch):
+    monkeypatch.setattr(hippocampus, "Hippocampus", _FakeHippocampus)
+    monkeypatch.setattr(hippocampus, "UserMemoryEntity", _FakeUserMemoryEntity)
+    monkeypatch.setattr(long_term_mem_mgr, "LongTermMemoryEntity", _FakeLongTermMemoryEntity)
+    monkeypatch.setattr(long_term_mem_mgr, "ChromaDBManager", _FakeChromaDBManager)
+    monkeypatch.setattr(LongTermMemoryMgr, "load_from_blob", lambda self, entity_name, entity: entity.set_ready())
+
+    keys = [f"AID_{i}" for i in range(Stress_keys)]
+    users = [f"UID_{i}" for i in range(Stress_users)]
+    errors: List[str] = []
+    barrier = threading.Barrier(Stress_threads)
+    threads = [threading.Thread(target=_worker, args=(barrier, keys, users, Stress_rounds, errors))
+               for _ in range(Stress_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 等待长期记忆的加载线程结束
+    time.sleep(Object_create_latency * 5)
+
+    assert errors == []
+    long_term_count = len(LongTermMemoryMgr().mem_map)
+    assert created["hippocampus"] == len(HippocampusMgr().hippocampus)
+    assert created["memory_entity"] == sum(len(hippo.memory_entities)
+                                           for hippo in HippocampusMgr().hippocampus.values())
+    assert created["long_term_entity"] == long_term_count
+    assert created["long_term_loader"] == long_term_count
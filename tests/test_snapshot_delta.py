@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("common_py")
+
+from common_py.client.chroma import VectorRecordItem  # noqa: E402
+
+from memory_sdk.longterm_memory import local_vector_index, snapshot_delta  # noqa: E402
+from memory_sdk.longterm_memory.snapshot_delta import SnapshotWithDelta, append_delta, clear_delta, \
+    load_delta  # noqa: E402
+
+_dim = 8
+embedded = []
+
+
+class _FakeEmbeddingCache:
+
+    def get(self, text: str):
+        return self.get_many([text])[0]
+
+    def get_many(self, texts):
+        embedded.extend(texts)
+        return [np.random.default_rng(abs(hash(text)) % (2 ** 32)).standard_normal(_dim).tolist() for text in texts]
+
+
+class _FakeMongoDBClient:
+    """
+    只有一个 delta 文档，支持 snapshot_delta 用到的更新操作
+    """
+    doc = None
+
+    def find_one_from_collection(self, collection, filter):
+        return _FakeMongoDBClient.doc
+
+    def update_many_document(self, collection, filter, update, upsert):
+        doc = _FakeMongoDBClient.doc
+        if doc is None:
+            doc = _FakeMongoDBClient.doc = {"store_key": filter["store_key"], "block_names": [], "records": {}}
+        for name in update.get("$addToSet", {}).get("block_names", {}).get("$each", []):
+            if name not in doc["block_names"]:
+                doc["block_names"].append(name)
+        for key, value in update.get("$set", {}).items():
+            if key.startswith("records."):
+                doc["records"][key[len("records."):]] = value
+        doc["block_names"] = [name for name in doc["block_names"]
+                              if name not in update.get("$pullAll", {}).get("block_names", [])]
+        for key in update.get("$unset", {}):
+            doc["records"].pop(key[len("records."):], None)
+
+
+class _FakeBase:
+
+    def get_collection_name(self) -> str:
+        return "entity"
+
+    def query(self, input_data, meta_filter=None, top_k=3, threshold=0.0):
+        return [VectorRecordItem(id="base", meta={"block_name": "base"}, documents="base", score=0.0)]
+
+    def get(self, where=None, limit=None):
+        return [VectorRecordItem(id="base", meta={"block_name": "base"}, documents="base")]
+
+
+@pytest.fixture(autouse=True)
+def fake_storage(monkeypatch, tmp_path):
+    monkeypatch.setattr(local_vector_index, "EmbeddingCache", _FakeEmbeddingCache)
+    monkeypatch.setattr(snapshot_delta, "MongoDBClient", _FakeMongoDBClient)
+    monkeypatch.setattr(snapshot_delta, "SnapshotDelta_local_dir", str(tmp_path))
+    _FakeMongoDBClient.doc = None
+    embedded.clear()
+
+
+def _item(block_name: str, question: str) -> VectorRecordItem:
+    return VectorRecordItem(id=question, meta={"block_name": block_name, "create_time": 1}, documents=question)
+
+
+def test_delta_reload_does_not_embed():
+    collection = SnapshotWithDelta(_FakeBase(), "entity")
+    collection.upsert_many([_item("b1", "q1"), _item("b1", "q2"), _item("b2", "q3")])
+    record_lst, vectors = collection.delta.export()
+    append_delta("entity", record_lst, vectors)
+    collection.close()
+    embedded.clear()
+
+    block_names, record_lst, vectors = load_delta("entity")
+    assert block_names == ["b1", "b2"]
+    reloaded = SnapshotWithDelta(_FakeBase(), "entity")
+    reloaded.delta.upsert_vectors(record_lst, vectors)
+    assert reloaded.delta.count() == 3
+    # 只有查询文本需要 embedding，delta 记录直接使用保存的向量
+    assert reloaded.query("q3", top_k=1)[0].id == "q3"
+    assert embedded == ["q3"]
+    assert [item.id for item in reloaded.get()] == ["base", "q1", "q2", "q3"]
+    reloaded.close()
+
+
+def test_clear_keeps_later_blocks():
+    append_delta("entity", [_item("b1", "q1"), _item("b2", "q2")], np.ones((2, _dim), dtype=np.float32))
+    clear_delta("entity", ["b1"])
+    block_names, record_lst, _ = load_delta("entity")
+    assert block_names == ["b2"]
+    assert [record.id for record in record_lst] == ["q2"]
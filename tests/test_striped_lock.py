@@ -0,0 +1,56 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from memory_sdk.striped_lock import StripedLock
+
+
+def test_factory_runs_outside_stripe_lock():
+    # 只有一个分段，所有 key 都落在同一把锁上
+    locks = StripedLock(stripes=1)
+    container = {}
+    release = threading.Event()
+
+    def slow_factory():
+        release.wait(5)
+        return "slow"
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        slow = executor.submit(locks.get_or_create, container, "a", slow_factory)
+        # 另一个 key 不需要等待 a 的 factory
+        assert executor.submit(locks.get_or_create, container, "b", lambda: "fast").result(timeout=1) == "fast"
+        release.set()
+        assert slow.result(timeout=1) == "slow"
+
+
+def test_single_flight():
+    locks = StripedLock()
+    container = {}
+    calls = []
+    release = threading.Event()
+
+    def factory():
+        calls.append(1)
+        release.wait(5)
+        return object()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(locks.get_or_create, container, "a", factory) for _ in range(8)]
+        release.set()
+        values = {id(future.result(timeout=5)) for future in futures}
+    assert len(calls) == 1
+    assert values == {id(container["a"])}
+
+
+def test_factory_error_is_not_cached():
+    locks = StripedLock()
+    container = {}
+
+    def broken():
+        raise ValueError("load failed")
+
+    with pytest.raises(ValueError):
+        locks.get_or_create(container, "a", broken)
+    assert "a" not in container
+    assert locks.get_or_create(container, "a", lambda: 1) == 1
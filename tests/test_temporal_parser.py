@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import pytest
+
+from memory_sdk.longterm_memory.temporal_parser import has_temporal_cue, parse_time_expression
+
+# 2026-10-18 是周日
+_now = datetime(2026, 10, 18, 15, 0)
+
+
+@pytest.mark.parametrize("content", [
+    "之前说过的那家店", "以前我住在上海", "当时我很难过", "那时候还小", "那天下雨了",
+    "what did I say last time", "at last we made it", "the last one", "I ate 1/2 of it", "score was 10/3",
+    "周末一起去玩吧", "二十号见", "I'll call you tomorrow", "long ago",
+])
+def test_no_cue(content):
+    assert not has_temporal_cue(content)
+
+
+@pytest.mark.parametrize("content", [
+    "昨天吃了什么", "上周五去哪了", "三天前", "10月5号", "去年夏天", "what did we do last friday",
+    "two weeks ago", "back in 2019", "in march", "last weekend", "中秋节那天",
+])
+def test_cue(content):
+    assert has_temporal_cue(content)
+
+
+@pytest.mark.parametrize("content, expected", [
+    ("what did we do last friday", ("day", "2026-10-16")),
+    ("last sunday", ("day", "2026-10-11")),
+    ("last saturday", ("day", "2026-10-17")),
+    ("on friday", ("day", "2026-10-16")),
+    ("sunday", ("day", "2026-10-18")),
+    ("上周五", ("day", "2026-10-09")),
+    ("周五", ("day", "2026-10-16")),
+])
+def test_weekday(content, expected):
+    assert parse_time_expression(content, _now) == expected
+
+
+@pytest.mark.parametrize("content, expected", [
+    ("昨天", ("day", "2026-10-17")),
+    ("三天前", ("day", "2026-10-15")),
+    ("上个月", ("month", "2026-09")),
+    ("去年", ("year", "2025")),
+    ("12月3号", ("day", "2025-12-03")),
+    ("christmas", ("day", "2025-12-25")),
+    ("一年前的今天", ("day", "2025-10-18")),
+    ("a year ago today", ("day", "2025-10-18")),
+    ("去年的昨天", ("day", "2025-10-17")),
+])
+def test_relative(content, expected):
+    assert parse_time_expression(content, _now) == expected
+
+
+def test_year_ago_on_leap_day():
+    assert parse_time_expression("一年前的今天", datetime(2028, 2, 29, 12, 0)) == ("day", "2027-02-28")
+
+
+def test_lunar_holiday_unresolved():
+    assert has_temporal_cue("春节的时候")
+    assert parse_time_expression("春节的时候", _now) is None
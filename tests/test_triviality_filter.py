@@ -0,0 +1,31 @@
+import pytest
+
+pytest.importorskip("common_py")
+
+from memory_sdk.instance_memory_block.triviality_filter import TrivialityFilter_keyword_lexicon, \
+    count_keyword_hits, lexical_diversity  # noqa: E402
+
+
+@pytest.mark.parametrize("text, hits", [
+    ("whatever, give me a moment", 0),
+    ("i hate waiting", 1),
+    ("my mom's birthday", 1),
+    ("her mom and dad", 2),
+    ("下周是妈妈的生日", 2),
+])
+def test_keyword_whole_token(text, hits):
+    assert count_keyword_hits(text, TrivialityFilter_keyword_lexicon) == hits
+
+
+def test_lexical_diversity_not_length_biased():
+    vocabulary = [f"w{i}" for i in range(40)]
+    short = vocabulary[:30]
+    long = (vocabulary * 25)[:1000]
+    # 原始比例会从 1.0 降到 0.04，滑动窗口的比例保持在同一水平
+    assert lexical_diversity(short) == 1.0
+    assert lexical_diversity(long) > 0.7
+
+
+def test_lexical_diversity_repetitive():
+    assert lexical_diversity(["haha"] * 200) < 0.05
+    assert lexical_diversity([]) == 0.0